@@ -1,5 +1,18 @@
-from django.contrib import admin
-from .models import Customer, Product, OrderItem, Order, Address, Payment, Coupon, Refund
+import io
+from django.contrib import admin, messages
+from django.core.exceptions import PermissionDenied
+from django.db import transaction
+from django.http import StreamingHttpResponse
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.urls import path
+from django.utils import timezone
+from shop.exports import FORMATS, order_lines, export_lines
+from shop.forms import ProductImportForm
+from shop.pricing import active_rules, apply_rules
+from shop.product_import import import_products
+from .models import (Customer, Product, OrderItem, Order, Address, Payment, Coupon, Refund, StockHold, MediaBlob,
+                     BrandStats, PricingRule)
 
 
 def refund_accepted(request, modeladmin, queryset):
@@ -16,13 +29,89 @@ def update_order_sent(request, modeladmin, queryset):
 update_order_sent.short_description = 'Update orders to order sent'
 
 
+def export_orders(export_format):
+    # Returns an action streaming the lines of the selected orders in the format (see shop.exports)
+    def action(modeladmin, request, queryset):
+        content_type = FORMATS[export_format][1]
+        response = StreamingHttpResponse(export_lines(export_format, order_lines(queryset)),
+                                         content_type=content_type)
+        filename = f'orders-{timezone.now():%Y%m%d-%H%M%S}.{export_format}'
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
+    action.__name__ = f'export_orders_{export_format}'
+    action.short_description = f'Export order lines as {export_format.upper()}'
+    return action
+
+
 class OrderAdmin(admin.ModelAdmin):
     list_display = ['customer', 'transaction_id', 'complete', 'order_sent', 'order_received',
                     'refund_requested', 'refund_granted']
     list_filter = ['complete', 'order_sent', 'order_received', 'refund_requested', 'refund_granted']
     list_display_links = ['customer', 'transaction_id']
     search_fields = ['customer__name', 'transaction_id']
-    actions = [refund_accepted, update_order_sent]
+    date_hierarchy = 'date_ordered'
+    actions = [refund_accepted, update_order_sent, export_orders('csv'), export_orders('jsonl')]
+
+
+class ProductAdmin(admin.ModelAdmin):
+    list_display = ['name', 'sku', 'brand', 'price', 'discount_price', 'promotion', 'quantity']
+    search_fields = ['name', 'sku', 'brand']
+    readonly_fields = ['promotion']
+
+    # A discount price entered by hand is kept, the others follow the pricing rules (see shop.pricing)
+    def save_model(self, request, obj, form, change):
+        if 'discount_price' in form.changed_data:
+            obj.promotion = None
+        apply_rules(obj, active_rules())
+        super().save_model(request, obj, form, change)
+
+    def get_urls(self):
+        urls = [path('import/', self.admin_site.admin_view(self.import_view), name='shop_product_import')]
+        return urls + super().get_urls()
+
+    # Creates and updates products from an uploaded catalog (see shop.product_import)
+    def import_view(self, request):
+        if not (self.has_add_permission(request) and self.has_change_permission(request)):
+            raise PermissionDenied
+        form = ProductImportForm(request.POST or None, request.FILES or None)
+        if request.method == 'POST' and form.is_valid():
+            lines = io.TextIOWrapper(form.cleaned_data['file'].file, encoding='utf-8-sig', newline='')
+            try:
+                report = import_products(lines, form.cleaned_data['format'],
+                                         queue_images=form.cleaned_data['queue_images'])
+            except UnicodeDecodeError as e:
+                form.add_error('file', f'The file isn\'t UTF-8 text: {e}')
+            else:
+                messages.success(request, report.summary())
+                for line, message in report.errors:
+                    messages.warning(request, f'Line {line}: {message}')
+                return redirect('admin:shop_product_changelist')
+
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': 'Import products',
+            'form': form,
+        }
+        return TemplateResponse(request, 'admin/shop/product/import.html', context)
+
+
+class PricingRuleAdmin(admin.ModelAdmin):
+    list_display = ['name', 'brand', 'min_price', 'max_price', 'percent_off', 'starts_at', 'ends_at', 'active']
+    list_filter = ['active', 'brand']
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if getattr(obj, '_repricing_deferred', False):
+            messages.info(request, 'The rule concerns too many products to reprice them now. They are '
+                                   'repriced by the next run of apply_pricing_rules.')
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        if getattr(obj, '_repricing_deferred', False):
+            messages.info(request, 'The rule discounted too many products to reprice them now. They are '
+                                   'repriced with the other rules by the next run of apply_pricing_rules.')
 
 
 class AddressAdmin(admin.ModelAdmin):
@@ -36,18 +125,56 @@ class PaymentAdmin(admin.ModelAdmin):
 
 
 class OrderItemAdmin(admin.ModelAdmin):
-    list_display = ['product', 'quantity', 'order']
+    list_display = ['product', 'quantity', 'price', 'order']
+
+    # Keeping the running totals of the affected orders up to date
+    def save_model(self, request, obj, form, change):
+        with transaction.atomic():
+            # A line moved to another order changes the totals of both
+            previous = OrderItem.objects.filter(pk=obj.pk).values_list('order_id', flat=True).first()
+            super().save_model(request, obj, form, change)
+            Order.objects.filter(pk__in=[pk for pk in (previous, obj.order_id) if pk is not None]).rebuild_totals()
+
+    def delete_model(self, request, obj):
+        with transaction.atomic():
+            super().delete_model(request, obj)
+            Order.objects.filter(pk=obj.order_id).rebuild_totals()
+
+    def delete_queryset(self, request, queryset):
+        with transaction.atomic():
+            order_ids = list(queryset.values_list('order_id', flat=True))
+            super().delete_queryset(request, queryset)
+            Order.objects.filter(pk__in=order_ids).rebuild_totals()
 
 
 class RefundAdmin(admin.ModelAdmin):
     list_display = ['order', 'refund_accepted']
 
 
+class StockHoldAdmin(admin.ModelAdmin):
+    list_display = ['product', 'quantity', 'order', 'expires_at']
+
+
+class MediaBlobAdmin(admin.ModelAdmin):
+    list_display = ['name', 'size', 'references', 'created']
+    readonly_fields = ['digest', 'name', 'size', 'references', 'created']
+
+
+class BrandStatsAdmin(admin.ModelAdmin):
+    list_display = ['brand', 'product_count', 'in_stock_count', 'discounted_count', 'min_price', 'max_price',
+                    'updated']
+    readonly_fields = list_display
+
+
 admin.site.register(Customer)
-admin.site.register(Product)
+admin.site.register(Product, ProductAdmin)
 admin.site.register(OrderItem, OrderItemAdmin)
 admin.site.register(Order, OrderAdmin)
 admin.site.register(Address, AddressAdmin)
 admin.site.register(Payment, PaymentAdmin)
 admin.site.register(Coupon)
 admin.site.register(Refund, RefundAdmin)
+admin.site.register(StockHold, StockHoldAdmin)
+admin.site.register(MediaBlob, MediaBlobAdmin)
+admin.site.register(BrandStats, BrandStatsAdmin)
+admin.site.register(PricingRule, PricingRuleAdmin)
@@ -0,0 +1,8 @@
+from django.db.backends.postgresql import base
+from shop.db import HealthCheckMixin
+
+# PostgreSQL with the health checks of reused connections of shop.db
+
+
+class DatabaseWrapper(HealthCheckMixin, base.DatabaseWrapper):
+    pass
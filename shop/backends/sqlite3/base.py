@@ -0,0 +1,17 @@
+from django.db.backends.sqlite3 import base
+from shop.db import HealthCheckMixin
+
+# SQLite with transactions that take the write lock when they begin. Django starts them deferred,
+# taking the lock at the first write, and a transaction that reads before it writes (locking rows
+# with select_for_update(), which SQLite ignores, or get_or_create()) can't take it while another
+# one writes: SQLite fails it at once with 'database is locked' rather than waiting, since they
+# could otherwise wait on each other. Beginning with the lock, transactions wait their turn up to
+# the connection's timeout instead, as transaction_mode IMMEDIATE does in later Django versions.
+# Queries outside of transactions still read concurrently.
+# Reused connections are checked as shop.db describes.
+
+
+class DatabaseWrapper(HealthCheckMixin, base.DatabaseWrapper):
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute('BEGIN IMMEDIATE')
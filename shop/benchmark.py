@@ -0,0 +1,263 @@
+import datetime
+import math
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer
+import requests
+import stripe
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.servers.basehttp import WSGIRequestHandler
+from django.core.wsgi import get_wsgi_application
+from django.db import connection, connections
+from django.test.utils import override_settings
+from shop.models import Product
+from shop.payments import run_worker
+from shop.stripe_stub import StripeStubServer
+
+# Benchmark of the checkout funnel. Virtual customers browse the store, add products to their
+# cart, check out and pay, each in its own thread, against the shop served by a threaded WSGI
+# server in this process. Charges go to the Stripe stub and a payment worker thread completes
+# them, as manage.py process_payments would. Runs in a throwaway test database of the configured
+# database (set DATABASE_URL to benchmark PostgreSQL), so nothing is left behind.
+
+# Password of the benchmark customers
+PASSWORD = 'benchmark-password'
+
+
+class BenchmarkServer(ThreadingMixIn, WSGIServer):
+    # Serves every request in a new thread, closing its database connections afterwards
+    daemon_threads = True
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            connections.close_all()
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Recorder:
+    # Latencies and failures of the requests per endpoint name
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, name, seconds, ok):
+        with self.lock:
+            self.latencies[name].append(seconds)
+            if not ok:
+                self.errors[name] += 1
+
+    def report(self, duration):
+        # Returns the request count, errors, throughput and latency percentiles per endpoint
+        report = {}
+        with self.lock:
+            for name, latencies in sorted(self.latencies.items()):
+                latencies = sorted(latencies)
+                report[name] = {
+                    'requests': len(latencies),
+                    'errors': self.errors[name],
+                    'throughput': round(len(latencies) / duration, 2),
+                    'mean_ms': round(sum(latencies) / len(latencies) * 1000, 2),
+                    **{f'p{percent}_ms': round(percentile(latencies, percent) * 1000, 2)
+                       for percent in (50, 90, 95, 99)},
+                    'max_ms': round(latencies[-1] * 1000, 2),
+                }
+        return report
+
+
+def percentile(ordered, percent):
+    # Returns the nearest-rank percentile of sorted values
+    return ordered[max(math.ceil(len(ordered) * percent / 100) - 1, 0)]
+
+
+class Customer:
+    # A virtual customer with their own session, going through the checkout funnel
+
+    def __init__(self, base_url, username, recorder):
+        self.base_url = base_url
+        self.username = username
+        self.recorder = recorder
+        self.session = requests.Session()
+
+    def request(self, name, method, path, ok_statuses=(200, 302), **kwargs):
+        headers = kwargs.pop('headers', {})
+        if method == 'POST':
+            headers['X-CSRFToken'] = self.session.cookies.get('csrftoken', '')
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.base_url + path, headers=headers,
+                                            allow_redirects=False, **kwargs)
+            ok = response.status_code in ok_statuses
+        except requests.RequestException:
+            response, ok = None, False
+        self.recorder.record(name, time.perf_counter() - start, ok)
+        return response
+
+    def log_in(self):
+        self.session.get(self.base_url + '/accounts/login/')
+        self.session.post(self.base_url + '/accounts/login/', data={
+            'username': self.username,
+            'password': PASSWORD,
+            'csrfmiddlewaretoken': self.session.cookies.get('csrftoken', ''),
+        }, allow_redirects=False)
+
+    def shop(self, product_ids, pages, cart_size):
+        # Browses the store, fills the cart, checks out and pays
+        response = self.request('store', 'GET', '/')
+        for _ in range(pages - 1):
+            cursor = response.text.split('?after=')[1].split('"')[0] if response and '?after=' in response.text else ''
+            if not cursor:
+                break
+            response = self.request('store', 'GET', f'/?after={cursor}')
+
+        for product_id in product_ids[:cart_size]:
+            self.request('update-item', 'POST', '/update_item/', json={'productId': product_id, 'action': 'add'})
+        self.request('cart', 'GET', '/cart/')
+        self.request('checkout', 'GET', '/checkout/')
+        self.request('checkout-post', 'POST', '/checkout/', data={
+            'shipping_address1': '1 Oxford Street',
+            'shipping_city': 'Accra',
+            'shipping_country': 'GH',
+            'shipping_zip': '00233',
+            'same_billing_address': 'on',
+            'payment_option': 'S',
+        })
+        response = self.request('payment-post', 'POST', '/payment/stripe', data={'stripeToken': 'tok_visa'})
+
+        # Polling the status page like the browser does, until the worker has charged the card
+        location = response.headers.get('Location', '') if response is not None else ''
+        for _ in range(200):
+            if '/payment_status/' not in location:
+                break
+            response = self.request('payment-status', 'GET', location)
+            if response is None or response.status_code != 200:
+                break
+            time.sleep(0.05)
+
+
+def seed(products, customers):
+    # Creates the catalog and the customers, returning the product ids
+    Product.objects.bulk_create([
+        Product(name=f'Sneaker {i}', slug=f'sneaker-{i}', brand=f'Brand {i % 12}', price=50 + i % 200,
+                discount_price=40 + i % 200 if i % 4 == 0 else None, quantity=10 ** 6, image=f'sneaker{i}.jpg')
+        for i in range(products)
+    ], batch_size=500)
+    for i in range(customers):
+        User.objects.create_user(f'customer{i}', password=PASSWORD)
+    return list(Product.objects.order_by('id').values_list('id', flat=True))
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=settings.BASE_DIR, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(concurrency=8, rounds=5, products=500, pages=3, cart_size=3, stripe_latency=0.0, log=print):
+    # Runs the funnel with concurrency customers, rounds times each, returning the report. The
+    # settings changed for the run are restored afterwards.
+    # The templates link the static files without a collectstatic manifest
+    static_files = override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    test_database = settings.DATABASES['default'].setdefault('TEST', {})
+    test_name = test_database.get('NAME')
+    static_files.enable()
+    try:
+        if connection.vendor == 'sqlite':
+            # Threads can't share an in-memory database
+            test_database['NAME'] = os.path.join(tempfile.mkdtemp(), 'benchmark.sqlite3')
+        return run_in_test_database(concurrency, rounds, products, pages, cart_size, stripe_latency, log)
+    finally:
+        test_database['NAME'] = test_name
+        static_files.disable()
+
+
+def run_in_test_database(concurrency, rounds, products, pages, cart_size, stripe_latency, log):
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    stub = StripeStubServer(latency=stripe_latency).start()
+    old_api_base, stripe.api_base = stripe.api_base, stub.url
+    server = BenchmarkServer(('127.0.0.1', 0), QuietRequestHandler)
+    server.set_app(get_wsgi_application())
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    stop_worker = threading.Event()
+
+    def worker():
+        while not stop_worker.is_set():
+            try:
+                run_worker(poll_interval=0.05, once=True)
+            except Exception as e:
+                # e.g. SQLite's 'database is locked' under concurrent writes; the process_payments
+                # command would be restarted, the benchmark carries on
+                log(f'Payment worker error: {e}')
+                connections.close_all()
+            time.sleep(0.05)
+        connections.close_all()
+
+    worker_thread = threading.Thread(target=worker, daemon=True)
+    try:
+        log(f'Seeding {products} products and {concurrency} customers in {connection.vendor}')
+        product_ids = seed(products, concurrency)
+        connections.close_all()
+        server_thread.start()
+        worker_thread.start()
+        base_url = 'http://%s:%s' % server.server_address[:2]
+
+        recorder = Recorder()
+        customers = [Customer(base_url, f'customer{i}', recorder) for i in range(concurrency)]
+        for customer in customers:
+            customer.log_in()
+
+        def shop(index, customer):
+            for round_number in range(rounds):
+                start = (index * rounds + round_number) * cart_size % len(product_ids)
+                customer.shop(product_ids[start:] + product_ids[:start], pages, cart_size)
+
+        log(f'Running {rounds} checkouts for each of {concurrency} concurrent customers')
+        threads = [threading.Thread(target=shop, args=(i, customer)) for i, customer in enumerate(customers)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.perf_counter() - started
+
+        return {
+            'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'revision': git_revision(),
+            'database': connection.vendor,
+            'concurrency': concurrency,
+            'rounds': rounds,
+            'products': products,
+            'pages': pages,
+            'cart_size': cart_size,
+            'stripe_latency': stripe_latency,
+            'duration_s': round(duration, 2),
+            'endpoints': recorder.report(duration),
+        }
+    finally:
+        stop_worker.set()
+        if worker_thread.is_alive():
+            worker_thread.join()
+        if server_thread.is_alive():
+            server.shutdown()
+        server.server_close()
+        stripe.api_base = old_api_base
+        stub.stop()
+        connections.close_all()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
@@ -0,0 +1,83 @@
+import logging
+from django.db import transaction, DatabaseError
+from django.db.models import Q, Count, Min, Max
+from django.db.models.functions import Coalesce
+from shop.models import Product, BrandStats
+
+# Catalog aggregates per brand (product, in stock and discounted counts, price range) stored in
+# the BrandStats table, so the brand sidebar of the store reads one small indexed table instead
+# of grouping the whole catalog on every page load. Only the brands of the products that changed
+# are recomputed: on Product save and delete (see shop.signals) and when payments take products
+# out of stock or put them back (see shop.stock). Changes that send no signals, like
+# QuerySet.update(), need a manage.py refresh_brand_stats.
+
+logger = logging.getLogger(__name__)
+
+# Product fields the stats depend on
+STATS_FIELDS = {'brand', 'price', 'discount_price', 'quantity'}
+
+
+def brand_aggregates(brands=None):
+    # Returns the stats of the brands (default: all) computed from their products, by brand
+    products = Product.objects.exclude(brand__isnull=True).exclude(brand='')
+    if brands is not None:
+        products = products.filter(brand__in=brands)
+    price = Coalesce('discount_price', 'price')
+    rows = products.order_by().values('brand').annotate(
+        product_count=Count('id'),
+        in_stock_count=Count('id', filter=Q(quantity__gt=0)),
+        discounted_count=Count('id', filter=Q(discount_price__isnull=False)),
+        min_price=Min(price),
+        max_price=Max(price),
+    )
+    return {row.pop('brand'): row for row in rows}
+
+
+def refresh_brand_stats(brands):
+    # Recomputes the stats of the brands, dropping those left without products
+    brands = {brand for brand in brands if brand}
+    if not brands:
+        return
+    aggregates = brand_aggregates(brands)
+    with transaction.atomic():
+        for brand, values in aggregates.items():
+            BrandStats.objects.update_or_create(brand=brand, defaults=values)
+        BrandStats.objects.filter(brand__in=brands - set(aggregates)).delete()
+
+
+def refresh_after_commit(load_brands):
+    # Refreshes the brands returned by load_brands() once the current transaction commits. The
+    # change is committed by then, so a failure is logged rather than failing the change (e.g. a
+    # payment); the brand's stats are fixed by its next refresh or manage.py refresh_brand_stats.
+    def refresh():
+        try:
+            refresh_brand_stats(load_brands())
+        except DatabaseError:
+            logger.exception('Refreshing the brand stats failed')
+
+    transaction.on_commit(refresh)
+
+
+def refresh_brand_stats_on_commit(brands):
+    brands = set(brands)
+    refresh_after_commit(lambda: brands)
+
+
+def refresh_product_brands_on_commit(product_ids, condition=None):
+    # Refreshes the brands of the products (those meeting the condition once the current
+    # transaction commits), e.g. the products that stock changes sold out
+    products = Product.objects.filter(pk__in=list(product_ids))
+    if condition is not None:
+        products = products.filter(condition)
+    if product_ids:
+        refresh_after_commit(lambda: products.values_list('brand', flat=True).distinct())
+
+
+def rebuild_brand_stats():
+    # Recomputes the stats of every brand, returning the number of brands
+    aggregates = brand_aggregates()
+    with transaction.atomic():
+        BrandStats.objects.exclude(brand__in=aggregates).delete()
+        for brand, values in aggregates.items():
+            BrandStats.objects.update_or_create(brand=brand, defaults=values)
+    return len(aggregates)
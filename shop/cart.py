@@ -0,0 +1,169 @@
+import time
+from django.contrib import messages
+from django.db import transaction
+from shop.models import Product, Order, OrderItem
+from shop.stock import CartHolds, extend_holds
+
+# The navbar badge reads the cart quantity from the session, which is loaded on every
+# request anyway, so rendering it doesn't cost a query. Views that change the cart
+# update the stored value in place.
+CART_QUANTITY_SESSION_KEY = 'cart_quantity'
+
+# How long a stored quantity is trusted before it is reloaded, so carts changed
+# from another device or session eventually show up in the badge.
+CART_QUANTITY_MAX_AGE = 60 * 5
+
+
+def load_cart_quantity(user):
+    # Returns the total quantity of products in the user's open cart from the database.
+    quantity = Order.objects.filter(
+        customer__user=user,
+        complete=False,
+    ).values_list('item_count', flat=True).first()
+    return quantity or 0
+
+
+def get_cart_quantity(request):
+    # Returns the quantity of products in cart stored in the session, loading it
+    # from the database when it is missing or too old.
+    if not request.user.is_authenticated:
+        return 0
+
+    stored = request.session.get(CART_QUANTITY_SESSION_KEY)
+    if stored is None or stored['expires'] < time.time():
+        return set_cart_quantity(request, load_cart_quantity(request.user))
+    return stored['quantity']
+
+
+def set_cart_quantity(request, quantity):
+    # Stores the quantity of products in cart in the session.
+    request.session[CART_QUANTITY_SESSION_KEY] = {
+        'quantity': quantity,
+        'expires': time.time() + CART_QUANTITY_MAX_AGE,
+    }
+    return quantity
+
+
+def adjust_cart_quantity(request, delta):
+    # Adds delta to the stored quantity of products in cart. Nothing is stored when the
+    # session has no quantity yet; it is loaded the next time the badge renders.
+    stored = request.session.get(CART_QUANTITY_SESSION_KEY)
+    if stored is not None and delta:
+        stored['quantity'] = max(stored['quantity'] + delta, 0)
+        request.session[CART_QUANTITY_SESSION_KEY] = stored
+
+
+CART_ACTIONS = ('add', 'remove', 'clear')
+
+# Largest number of operations accepted in one batch
+MAX_CART_OPERATIONS = 100
+
+
+class InvalidCartOperation(ValueError):
+    # Raised when a cart operation sent by the client can't be understood.
+    pass
+
+
+def parse_cart_operations(data):
+    # Validates a list of {productId, action, qty} operations sent by cart.js and returns
+    # them as (product id, action, quantity) tuples.
+    if not isinstance(data, list) or not 0 < len(data) <= MAX_CART_OPERATIONS:
+        raise InvalidCartOperation(f'Expected a list of 1 to {MAX_CART_OPERATIONS} operations')
+
+    operations = []
+    for operation in data:
+        try:
+            product_id = int(operation['productId'])
+            action = operation['action']
+            quantity = int(operation.get('qty', 1))
+        except (KeyError, TypeError, ValueError, AttributeError):
+            raise InvalidCartOperation(f'Invalid operation: {operation!r}')
+        if action not in CART_ACTIONS or quantity < 1:
+            raise InvalidCartOperation(f'Invalid operation: {operation!r}')
+        operations.append((product_id, action, quantity))
+    return operations
+
+
+def update_cart(request, operations):
+    # Applies the (product id, action, quantity) operations to the customer's open cart in one
+    # transaction, fetching the products, order lines and stock holds in bulk and writing the
+    # changed lines and holds back in bulk. Returns the order with its running totals up to date.
+    customer = request.user.customer
+    product_ids = {product_id for product_id, action, quantity in operations}
+
+    with transaction.atomic():
+        # Gets customer's order with items or creates one if none available.
+        # The order is locked so concurrent changes update its totals one at a time.
+        order, created = Order.objects.select_for_update().get_or_create(customer=customer, complete=False)
+        if order.paymentattempt_set.filter(status__in=['P', 'R']).exists():
+            # The amount being charged was taken from the cart as it is
+            messages.warning(request, 'Your payment is being processed')
+            return order
+
+        products = Product.objects.in_bulk(product_ids)
+        items = {item.product_id: item for item in order.orderitem_set.filter(product_id__in=product_ids)}
+        previous_quantities = {product_id: item.quantity for product_id, item in items.items()}
+        # Holding the pairs for the customer while they are in their cart, for all the
+        # products at once
+        holds = CartHolds(order, products)
+
+        for product_id, action, quantity in operations:
+            product = products.get(product_id)
+            if product is None:
+                messages.warning(request, 'This product is no longer available')
+                continue
+            item = items.get(product_id)
+
+            if action == 'add':
+                if holds.hold(product_id, quantity):
+                    if item is None:
+                        item = items[product_id] = OrderItem(order=order, product=product, quantity=0)
+                    item.quantity += quantity
+                    messages.info(request, 'Item added to cart')
+                else:
+                    messages.warning(request, 'Out of stock')
+
+            elif item is None or item.quantity <= 0:
+                messages.warning(request, 'This product is not in your cart')
+
+            elif action == 'remove':
+                quantity = min(quantity, item.quantity)
+                item.quantity -= quantity
+                holds.release(product_id, quantity)
+                messages.info(request, 'Item removed from cart')
+
+            elif action == 'clear':
+                item.quantity = 0
+                holds.release(product_id)
+
+        holds.save()
+        OrderItem.objects.bulk_create([
+            item for item in items.values() if item.pk is None and item.quantity > 0
+        ])
+        OrderItem.objects.bulk_update([
+            item for product_id, item in items.items()
+            if item.pk is not None and item.quantity > 0 and item.quantity != previous_quantities[product_id]
+        ], ['quantity'])
+        OrderItem.objects.filter(pk__in=[
+            item.pk for item in items.values() if item.pk is not None and item.quantity <= 0
+        ]).delete()
+
+        order.update_totals()
+        extend_holds(order)
+
+    # Keeping the navbar badge in step with the cart
+    previous_total = sum(previous_quantities.values())
+    adjust_cart_quantity(request, sum(max(item.quantity, 0) for item in items.values()) - previous_total)
+    return order
+
+
+def cart_summary_data(order):
+    # Returns the cart summary of the order in a JSON serializable form, amounts as decimal
+    # strings like DjangoJSONEncoder writes decimals
+    summary = order.cart_summary()
+    return {
+        'items': summary.items,
+        'subtotal': str(summary.subtotal),
+        'total': str(summary.total),
+        'shipping': summary.shipping,
+    }
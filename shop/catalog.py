@@ -0,0 +1,139 @@
+import threading
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from shop.models import Product
+
+# Read-through cache of the product catalog. Products are stored as plain dicts of their field
+# values in the 'catalog' cache (local memory with LRU eviction by default, or a shared backend
+# set with CATALOG_CACHE_URL) and turned back into unsaved-looking Product instances on reads,
+# so pages built from the cache make no queries for products.
+#
+# Records are keyed by product id, with a slug -> id index for the product pages. Listings
+# are keyed by a catalog version that is bumped whenever any product changes, which expires
+# every cached listing at once without having to know which pages held the product.
+
+CATALOG_CACHE = 'catalog'
+
+# Fields stored for a product record. Not reserved, which stock holds change without invalidating
+# the product: read it, and available, from the database, never from a cached product.
+PRODUCT_FIELDS = ('id', 'sku', 'name', 'brand', 'price', 'quantity', 'discount_price', 'promotion_id', 'digital',
+                  'image', 'image_derivatives', 'description', 'slug', 'updated')
+
+_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+_stats_lock = threading.Lock()
+
+
+def catalog_cache():
+    return caches[CATALOG_CACHE]
+
+
+def count(stat, amount=1):
+    with _stats_lock:
+        _stats[stat] += amount
+
+
+def cache_stats():
+    # Returns the hit, miss and invalidation counters of this process
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else None
+    return stats
+
+
+def product_key(pk):
+    return f'product:id:{pk}'
+
+
+def slug_key(slug):
+    return f'product:slug:{slug}'
+
+
+def serialize(product, fields=PRODUCT_FIELDS):
+    # Returns the field values of the product as a dict that can be cached
+    record = {field: getattr(product, field) for field in fields}
+    if 'image' in record:
+        record['image'] = record['image'].name if record['image'] else None
+    return record
+
+
+def deserialize(record):
+    # Rebuilds a product from its cached record without touching the database
+    product = Product(**record)
+    product._state.adding = False
+    product._state.db = 'default'
+    return product
+
+
+def get_product(slug):
+    # Returns the product with the slug from the cache, loading and caching it on a miss.
+    # Raises Product.DoesNotExist when there is no such product.
+    cache = catalog_cache()
+    pk = cache.get(slug_key(slug))
+    record = cache.get(product_key(pk)) if pk is not None else None
+
+    # A stale slug index entry (e.g. after a rename) points at a record with another slug
+    if record is not None and record['slug'] == slug:
+        count('hits')
+        return deserialize(record)
+
+    count('misses')
+    product = Product.objects.get(slug=slug)
+    cache.set_many({
+        product_key(product.pk): serialize(product),
+        slug_key(product.slug): product.pk,
+    })
+    return product
+
+
+def catalog_version():
+    # Returns the current version of the catalog listings
+    cache = catalog_cache()
+    version = cache.get('catalog:version')
+    if version is None:
+        cache.add('catalog:version', 1, timeout=None)
+        version = cache.get('catalog:version', 1)
+    return version
+
+
+def get_listing(name, load, fields):
+    # Returns a cached listing of products (e.g. a storefront page) called name, calling load()
+    # for the products and caching the given fields of them on a miss.
+    cache = catalog_cache()
+    key = f'listing:{catalog_version()}:{name}'
+    records = cache.get(key)
+    if records is not None:
+        count('hits')
+        return [deserialize(record) for record in records]
+
+    count('misses')
+    products = list(load())
+    cache.set(key, [serialize(product, fields) for product in products])
+    return products
+
+
+def invalidate_products(product_ids):
+    # Drops the cached records of the products and expires every cached listing
+    cache = catalog_cache()
+    cache.delete_many([product_key(pk) for pk in product_ids])
+    try:
+        cache.incr('catalog:version')
+    except ValueError:
+        # No listings cached since the version expired
+        pass
+    # Keeping the catalog reads on the primary until the replicas have the change (see shop.routers)
+    cache.set('catalog:written', True, timeout=settings.REPLICA_PIN_SECONDS)
+    count('invalidations', len(product_ids))
+
+
+def catalog_recently_written():
+    # Returns whether a product changed in the last REPLICA_PIN_SECONDS
+    return bool(catalog_cache().get('catalog:written'))
+
+
+def invalidate_products_on_commit(product_ids):
+    # Invalidates the products once the current transaction commits, so a concurrent
+    # read can't cache the old values again before the change is visible
+    product_ids = list(product_ids)
+    transaction.on_commit(lambda: invalidate_products(product_ids))
@@ -0,0 +1,41 @@
+# Health checks of persistent database connections. With CONN_MAX_AGE, a connection outlives the
+# request that opened it, and the database server may have closed it in the meantime (a restart,
+# a failover to the replica or PgBouncer recycling its server connections). Django 3.1 only notices
+# when the next query fails, so the connections of the databases with CONN_HEALTH_CHECKS are pinged
+# before their first use in a request (or a poll of the payment worker) that reuses them, and
+# reopened if that fails, as Django 4.1 does. Connections a request doesn't use aren't pinged.
+# The backends of shop.backends mix this in.
+
+
+class HealthCheckMixin:
+    # Mixed into a DatabaseWrapper
+    health_check_done = False
+
+    @property
+    def health_check_enabled(self):
+        return self.settings_dict.get('CONN_HEALTH_CHECKS', False)
+
+    def connect(self):
+        super().connect()
+        self.health_check_done = True
+
+    def close_if_unusable_or_obsolete(self):
+        # Called by close_old_connections() as requests start and finish; a connection kept open
+        # is checked when it is next used
+        super().close_if_unusable_or_obsolete()
+        self.health_check_done = False
+
+    def ensure_connection(self):
+        self.close_if_health_check_failed()
+        super().ensure_connection()
+
+    def close_if_health_check_failed(self):
+        # Closes the connection if the server no longer answers on it, so that it reconnects
+        if self.connection is None or not self.health_check_enabled or self.health_check_done:
+            return
+        # A connection in a transaction can't be replaced, its next query fails instead
+        if self.in_atomic_block:
+            return
+        if not self.is_usable():
+            self.close()
+        self.health_check_done = True
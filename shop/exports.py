@@ -0,0 +1,145 @@
+import csv
+import datetime
+import json
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.db.models import ExpressionWrapper, F
+from django.utils import timezone
+from shop.models import OrderItem
+from shop.money import Money, MoneyField
+from shop.routers import REPLICA
+
+# Streaming export of orders for accounting, one row per order line with the order, its payment,
+# addresses and coupon. Rows are read in chunks and written out as they come, so exporting any
+# number of orders takes the same memory: used by the 'Export' actions of OrderAdmin, which stream
+# the file to the browser, and by manage.py export_orders. Reads go to the replica when there is
+# one, since a few seconds of replication lag don't matter to an export.
+#
+# Line prices are the unit prices recorded on the lines at checkout, so later price changes of
+# the products don't change past orders; lines checked out before prices were recorded have none.
+# The amount actually charged for the order, after its coupon, is in payment_amount. Amounts are
+# written with two decimals, as strings in JSON lines so they stay exact.
+
+# Column name -> lookup from the order line, in the order of the columns
+COLUMNS = {
+    'order_id': 'order_id',
+    'transaction_id': 'order__transaction_id',
+    'date_ordered': 'order__date_ordered',
+    'customer': 'order__customer__user__username',
+    'email': 'order__customer__user__email',
+    'coupon': 'order__coupon__code',
+    'coupon_amount': 'order__coupon__amount',
+    'order_subtotal': 'order__subtotal',
+    'payment_charge_id': 'order__payment__charge_id',
+    'payment_amount': 'order__payment__amount',
+    'payment_date': 'order__payment__timestamp',
+    'shipping_country': 'order__shipping_address__country',
+    'shipping_city': 'order__shipping_address__city',
+    'shipping_street_address': 'order__shipping_address__street_address',
+    'shipping_apartment_address': 'order__shipping_address__apartment_address',
+    'shipping_zip_code': 'order__shipping_address__zip_code',
+    'billing_country': 'order__billing_address__country',
+    'billing_city': 'order__billing_address__city',
+    'billing_street_address': 'order__billing_address__street_address',
+    'billing_apartment_address': 'order__billing_address__apartment_address',
+    'billing_zip_code': 'order__billing_address__zip_code',
+    'line_id': 'id',
+    'product_id': 'product_id',
+    'product': 'product__name',
+    'quantity': 'quantity',
+    'unit_price': 'price',
+}
+
+# Columns computed by the database
+EXPRESSIONS = {
+    'line_total': ExpressionWrapper(F('quantity') * F('price'), output_field=MoneyField()),
+}
+
+CHUNK_SIZE = 2000
+
+
+def export_database():
+    return REPLICA if REPLICA in connections.databases else 'default'
+
+
+def order_lines(orders=None, since=None, until=None):
+    # Returns the export rows of the lines of the orders (default: the completed ones) paid
+    # between the dates since and until, both included
+    lines = OrderItem.objects.using(export_database())
+    if orders is None:
+        lines = lines.filter(order__complete=True)
+    else:
+        lines = lines.filter(order__in=orders.values('pk'))
+    if since:
+        lines = lines.filter(order__payment__timestamp__gte=start_of_day(since))
+    if until:
+        lines = lines.filter(order__payment__timestamp__lt=start_of_day(until + datetime.timedelta(days=1)))
+    return lines.values(*COLUMNS.values(), **EXPRESSIONS)
+
+
+def start_of_day(date):
+    return timezone.make_aware(datetime.datetime.combine(date, datetime.time()))
+
+
+def iterate(rows, chunk_size=CHUNK_SIZE):
+    # Yields the rows in order line order, holding at most chunk_size of them at a time. Without
+    # server side cursors (PgBouncer's transaction pooling), PostgreSQL would send iterator() the
+    # whole result at once, so the rows are fetched a chunk per query instead.
+    rows = rows.order_by('id')
+    if not connections[rows.db].settings_dict.get('DISABLE_SERVER_SIDE_CURSORS'):
+        yield from rows.iterator(chunk_size=chunk_size)
+        return
+    last_id = 0
+    while True:
+        chunk = list(rows.filter(id__gt=last_id)[:chunk_size])
+        yield from chunk
+        if len(chunk) < chunk_size:
+            return
+        last_id = chunk[-1]['id']
+
+
+def named(row):
+    # Returns the row with its export column names, in column order
+    values = {name: row[lookup] for name, lookup in COLUMNS.items()}
+    values.update((name, row[name]) for name in EXPRESSIONS)
+    return values
+
+
+class Echo:
+    # File-like object returning what is written, for csv.writer to produce lines one at a time
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow([*COLUMNS, *EXPRESSIONS])
+    for row in rows:
+        yield writer.writerow(named(row).values())
+
+
+class ExportEncoder(DjangoJSONEncoder):
+
+    def default(self, o):
+        if isinstance(o, Money):
+            return str(o)
+        return super().default(o)
+
+
+def jsonl_lines(rows):
+    for row in rows:
+        yield json.dumps(named(row), cls=ExportEncoder) + '\n'
+
+
+# Format -> (function turning rows into lines, content type)
+FORMATS = {
+    'csv': (csv_lines, 'text/csv'),
+    'jsonl': (jsonl_lines, 'application/x-ndjson'),
+}
+
+
+def export_lines(export_format, rows, chunk_size=CHUNK_SIZE):
+    # Yields the lines of the export of the rows in the format
+    lines, content_type = FORMATS[export_format]
+    return lines(iterate(rows, chunk_size))
@@ -1,4 +1,6 @@
 from django import forms
+from django.conf import settings
+from django.template.defaultfilters import filesizeformat
 from django_countries.fields import CountryField
 from django_countries.widgets import CountrySelectWidget
 from .models import Customer
@@ -53,3 +55,18 @@ class RefundForm(forms.Form):
     message = forms.CharField(widget=forms.Textarea)
     email = forms.EmailField()
 
+
+class ProductImportForm(forms.Form):
+    file = forms.FileField(help_text='CSV with a header row or JSON lines, one product per row keyed by sku. '
+                                     'Use manage.py import_products for catalogs too large to upload.')
+    format = forms.ChoiceField(choices=(('csv', 'CSV'), ('jsonl', 'JSON lines')))
+    queue_images = forms.BooleanField(required=False, initial=True, label='Generate resized images')
+
+    def clean_file(self):
+        # The import runs within the request, so it is kept to what a request can get through
+        file = self.cleaned_data['file']
+        limit = settings.PRODUCT_IMPORT_MAX_UPLOAD_SIZE
+        if file.size > limit:
+            raise forms.ValidationError(f'The file is larger than {filesizeformat(limit)}. '
+                                        f'Import it with manage.py import_products instead.')
+        return file
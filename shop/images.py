@@ -0,0 +1,144 @@
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction, close_old_connections
+from django.utils import timezone
+from PIL import Image, ImageOps
+from shop.models import Product
+from shop.catalog import invalidate_products
+
+# Product images are uploaded as large originals. Smaller copies of each (derivatives) are
+# generated in a background thread pool once the product is saved, in WebP and JPEG, and
+# stored next to the original in the product's storage. Their names are recorded in
+# Product.image_derivatives as {size: {'width': ..., 'webp': name, 'jpeg': name}} along with
+# the name of the original they were made from, and the templates offer them to browsers
+# with srcset (see templatetags/image_tags.py), falling back to the original until they exist.
+
+# Largest width and height of each derivative
+DERIVATIVE_SIZES = {
+    'thumb': 150,
+    'card': 400,
+    'detail': 800,
+}
+
+# Pillow format and encoder options per file extension
+DERIVATIVE_FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def executor():
+    # Returns the pool generating derivatives, started on first use
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.IMAGE_DERIVATIVE_WORKERS,
+                thread_name_prefix='image-derivatives',
+            )
+    return _executor
+
+
+def needs_derivatives(product):
+    # Returns whether the product's image has changed since its derivatives were made
+    source = product.image.name if product.image else None
+    return (product.image_derivatives or {}).get('source') != source
+
+
+def encode(img, extension):
+    # Returns the image encoded in the format of the extension
+    image_format, options = DERIVATIVE_FORMATS[extension]
+    if image_format == 'JPEG' and img.mode != 'RGB':
+        img = img.convert('RGB')
+    output = io.BytesIO()
+    img.save(output, image_format, **options)
+    return output.getvalue()
+
+
+def make_derivatives(storage, name):
+    # Resizes the original image to every derivative size and format, saving them next to it.
+    # Returns the image_derivatives record of the product.
+    with storage.open(name) as f:
+        original = Image.open(f)
+        original = ImageOps.exif_transpose(original)
+        original.load()
+
+    root = os.path.splitext(name)[0]
+    derivatives = {'source': name}
+    for size, dimension in DERIVATIVE_SIZES.items():
+        img = original.copy()
+        img.thumbnail((dimension, dimension), Image.LANCZOS)
+        derivative = {'width': img.width}
+        for extension in DERIVATIVE_FORMATS:
+            derivative[extension] = storage.save(f'{root}_{size}.{extension}', ContentFile(encode(img, extension)))
+        derivatives[size] = derivative
+    return derivatives
+
+
+def derivative_names(derivatives):
+    # Returns the names of the files of an image_derivatives record
+    return [
+        derivative[extension]
+        for size, derivative in (derivatives or {}).items() if size in DERIVATIVE_SIZES
+        for extension in DERIVATIVE_FORMATS if extension in derivative
+    ]
+
+
+def build_derivatives(product_id, force=False):
+    # Generates the derivatives of the product's current image and records them, deleting the
+    # derivatives of the previous image. The record is only written if the product wasn't saved
+    # meanwhile; that save queued another build, so this one's files are deleted instead.
+    # Returns whether the derivatives were recorded. With force, derivatives are made even if
+    # the current ones are up to date, e.g. after changing the sizes.
+    product = Product.objects.only('image', 'image_derivatives', 'updated').filter(pk=product_id).first()
+    if product is None or not (force or needs_derivatives(product)):
+        return False
+
+    storage = product.image.storage
+    if product.image:
+        derivatives = make_derivatives(storage, product.image.name)
+    else:
+        derivatives = {'source': None}
+
+    # Setting updated as well expires the cached pages showing the product
+    recorded = Product.objects.filter(pk=product_id, updated=product.updated).update(
+        image_derivatives=derivatives,
+        updated=timezone.now(),
+    )
+    if not recorded:
+        old_names = derivative_names(derivatives)
+    else:
+        old_names = derivative_names(product.image_derivatives)
+        invalidate_products([product_id])
+
+    for name in old_names:
+        storage.delete(name)
+    return bool(recorded)
+
+
+def run_build_derivatives(product_id):
+    # Builds the derivatives in a pool thread, which keeps its own database connection
+    close_old_connections()
+    try:
+        build_derivatives(product_id)
+    except Exception:
+        logger.exception('Building the image derivatives of product %s failed', product_id)
+    finally:
+        close_old_connections()
+
+
+def queue_derivatives(product):
+    # Generates the product's derivatives in the background once the current transaction
+    # commits, so the worker reads the saved image.
+    product_id = product.pk
+    transaction.on_commit(lambda: executor().submit(run_build_derivatives, product_id))
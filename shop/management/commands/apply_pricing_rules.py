@@ -0,0 +1,18 @@
+import time
+from django.core.management.base import BaseCommand
+from shop.pricing import CHUNK_SIZE, reprice_products
+
+
+class Command(BaseCommand):
+    help = ('Gives the products the discount prices of the running pricing rules. Meant to run every few '
+            'minutes, so that rules start and end on time.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                            help='Products read and repriced at a time.')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        repriced = reprice_products(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Repriced {repriced} products in {time.perf_counter() - started:.1f}s'))
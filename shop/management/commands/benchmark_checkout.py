@@ -0,0 +1,36 @@
+import json
+from django.core.management.base import BaseCommand
+from shop.benchmark import run_benchmark
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks the checkout funnel (store, add to cart, checkout, payment) with concurrent customers '
+            'against a local server, a Stripe stub and a throwaway copy of the configured database. '
+            'Prints the throughput and latency percentiles of every endpoint as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=8, help='Number of customers shopping at once.')
+        parser.add_argument('--rounds', type=int, default=5, help='Number of orders each customer pays for.')
+        parser.add_argument('--products', type=int, default=500, help='Size of the catalog.')
+        parser.add_argument('--pages', type=int, default=3, help='Store pages browsed before each order.')
+        parser.add_argument('--cart-size', type=int, default=3, help='Products added to each cart.')
+        parser.add_argument('--stripe-latency', type=float, default=0,
+                            help='Seconds every Stripe request takes, to simulate a slow payment provider.')
+        parser.add_argument('--output', help='File the results are written to, to compare them between commits.')
+
+    def handle(self, *args, **options):
+        report = run_benchmark(
+            concurrency=options['concurrency'],
+            rounds=options['rounds'],
+            products=options['products'],
+            pages=options['pages'],
+            cart_size=options['cart_size'],
+            stripe_latency=options['stripe_latency'],
+            log=lambda message: self.stderr.write(message),
+        )
+        results = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(results + '\n')
+            self.stderr.write(self.style.SUCCESS(f'Results written to {options["output"]}'))
+        self.stdout.write(results)
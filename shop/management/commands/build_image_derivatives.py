@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from shop.models import Product
+from shop.images import build_derivatives, needs_derivatives
+
+
+class Command(BaseCommand):
+    help = 'Generates the resized copies of product images that are missing, e.g. for products added before them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='Regenerate the copies of every product image, e.g. after changing the sizes.')
+
+    def handle(self, *args, **options):
+        built = failed = 0
+        products = Product.objects.only('image', 'image_derivatives').order_by('pk')
+        for product in products.iterator():
+            if not (options['all'] or needs_derivatives(product)):
+                continue
+            try:
+                if build_derivatives(product.pk, force=options['all']):
+                    built += 1
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f'Product {product.pk} ({product.image.name}): {e}')
+
+        self.stdout.write(self.style.SUCCESS(f'Built the image derivatives of {built} products'))
+        if failed:
+            self.stdout.write(self.style.WARNING(f'Failed for {failed} products'))
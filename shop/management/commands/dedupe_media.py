@@ -0,0 +1,116 @@
+import os
+from collections import Counter, defaultdict
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from shop.catalog import invalidate_products
+from shop.images import DERIVATIVE_SIZES, DERIVATIVE_FORMATS, derivative_names
+from shop.models import Product, MediaBlob
+from shop.storage import content_digest
+
+
+def walk(storage, path=''):
+    # Yields the names of every file in the storage under path
+    directories, files = storage.listdir(path)
+    for name in files:
+        yield os.path.join(path, name) if path else name
+    for directory in directories:
+        yield from walk(storage, os.path.join(path, directory) if path else directory)
+
+
+def replace_names(product, names):
+    # Points the product's image and derivatives at the kept copies, returning whether any changed
+    changed = False
+    if product.image.name in names:
+        product.image.name = names[product.image.name]
+        changed = True
+    derivatives = product.image_derivatives or {}
+    if derivatives.get('source') in names:
+        derivatives['source'] = names[derivatives['source']]
+        changed = True
+    for size in DERIVATIVE_SIZES:
+        for extension in DERIVATIVE_FORMATS:
+            name = derivatives.get(size, {}).get(extension)
+            if name in names:
+                derivatives[size][extension] = names[name]
+                changed = True
+    return changed
+
+
+def referenced_names(product):
+    # Returns the names of the files the product refers to
+    names = [product.image.name] if product.image else []
+    return names + derivative_names(product.image_derivatives)
+
+
+class Command(BaseCommand):
+    help = ('Finds media files with the same content, points products at a single copy of each and '
+            'deletes the others. Also records every file as a blob of the content addressed storage, '
+            'with its references recounted from the products.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report the duplicates that would be removed.')
+        parser.add_argument('--prune', action='store_true',
+                            help='Also delete the files no product refers to.')
+
+    def handle(self, *args, **options):
+        storage = default_storage
+        blobs = {blob.digest: blob.name for blob in MediaBlob.objects.all()}
+
+        # Grouping the files by content
+        files = defaultdict(list)
+        sizes = {}
+        for name in walk(storage):
+            with storage.open(name) as f:
+                digest = content_digest(f)
+                sizes[digest] = f.size
+            files[digest].append(name)
+
+        # Keeping the blob's file of each content, or else the copy with the shortest name
+        kept = {}
+        names = {}
+        for digest, group in files.items():
+            kept[digest] = blobs[digest] if blobs.get(digest) in group else min(group, key=lambda n: (len(n), n))
+            for name in group:
+                if name != kept[digest]:
+                    names[name] = kept[digest]
+
+        duplicate_bytes = sum(sizes[digest] * (len(group) - 1) for digest, group in files.items())
+        self.stdout.write(f'{sum(map(len, files.values()))} files, {len(files)} unique, '
+                          f'{len(names)} duplicates taking {duplicate_bytes / 1024 / 1024:.1f} MB')
+        if options['dry_run']:
+            return
+
+        with transaction.atomic():
+            products = list(Product.objects.select_for_update().only('image', 'image_derivatives'))
+            changed = [product for product in products if replace_names(product, names)]
+            now = timezone.now()
+            for product in changed:
+                # Expiring the cached pages showing the product
+                product.updated = now
+            Product.objects.bulk_update(changed, ['image', 'image_derivatives', 'updated'], batch_size=500)
+
+            references = Counter(name for product in products for name in referenced_names(product))
+            for digest, name in kept.items():
+                MediaBlob.objects.update_or_create(digest=digest, defaults={
+                    'name': name,
+                    'size': sizes[digest],
+                    'references': references[name],
+                })
+        invalidate_products([product.pk for product in changed])
+        self.stdout.write(self.style.SUCCESS(f'Pointed {len(changed)} products at the kept copies'))
+
+        # Deleting the copies once nothing refers to them
+        delete = getattr(storage, 'delete_file', storage.delete)
+        for name in names:
+            delete(name)
+        self.stdout.write(self.style.SUCCESS(f'Deleted {len(names)} duplicate files'))
+
+        if options['prune']:
+            unused = MediaBlob.objects.filter(references=0)
+            for name in unused.values_list('name', flat=True):
+                delete(name)
+            unused.delete()
+            self.stdout.write(self.style.SUCCESS('Deleted the files no product refers to'))
@@ -0,0 +1,62 @@
+import re
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+from shop.models import Product, Order, OrderItem, Address, Coupon, PaymentAttempt, StockHold
+
+# Plan lines of a full table scan, per database. SQLite reports 'SCAN <table>' (without
+# 'USING ... INDEX', which is an index scan) and PostgreSQL reports 'Seq Scan on <table>'.
+FULL_SCAN_PATTERNS = {
+    'sqlite': re.compile(r'\bSCAN (?!.*\bUSING\b.*\bINDEX\b)'),
+    'postgresql': re.compile(r'\bSeq Scan on\b'),
+}
+
+
+def canonical_queries():
+    # Returns the hot queries of the shop by name. The values looked up don't need to exist,
+    # only the shape of the queries matters to their plans.
+    now = timezone.now()
+    return {
+        'open cart': Order.objects.filter(customer_id=1, complete=False),
+        'cart lines': OrderItem.objects.filter(order_id=1).with_totals(),
+        'cart line of a product': OrderItem.objects.filter(order_id=1, product_id=1),
+        'default address': Address.objects.filter(customer_id=1, address_type='S', default=True),
+        'order by transaction id': Order.objects.filter(transaction_id='2021011', complete=True),
+        'coupon by code': Coupon.objects.filter(code='SUMMER'),
+        'product by slug': Product.objects.filter(slug='air-jordan-1'),
+        'store page': Product.objects.filter(id__gt=0).order_by('id')[:13],
+        'payment queue': PaymentAttempt.objects.filter(status='P').order_by('created', 'pk')[:10],
+        'expired stock holds': StockHold.objects.filter(expires_at__lte=now).order_by('expires_at')[:1000],
+    }
+
+
+class Command(BaseCommand):
+    help = ('Prints the query plans of the hot queries of the shop and flags those scanning a whole table. '
+            'PostgreSQL prefers scans on small tables, so check its plans against production-sized data.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fail-on-scan', action='store_true',
+                            help='Exit with an error when a query scans a whole table, e.g. in CI.')
+
+    def handle(self, *args, **options):
+        pattern = FULL_SCAN_PATTERNS.get(connection.vendor)
+        scans = []
+        for name, queryset in canonical_queries().items():
+            plan = queryset.explain()
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            self.stdout.write(str(queryset.query))
+            self.stdout.write(plan)
+            if pattern and pattern.search(plan):
+                scans.append(name)
+                self.stdout.write(self.style.WARNING('Full table scan'))
+            self.stdout.write('')
+
+        if pattern is None:
+            self.stdout.write(self.style.WARNING(f'Full scans are not detected on {connection.vendor}'))
+        elif scans:
+            message = f'{len(scans)} queries scan a whole table: {", ".join(scans)}'
+            if options['fail_on_scan']:
+                raise CommandError(message)
+            self.stdout.write(self.style.WARNING(message))
+        else:
+            self.stdout.write(self.style.SUCCESS('No query scans a whole table'))
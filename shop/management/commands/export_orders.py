@@ -0,0 +1,38 @@
+import datetime
+from django.core.management.base import BaseCommand, CommandError
+from shop.exports import FORMATS, CHUNK_SIZE, order_lines, export_lines
+
+
+def date(value):
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise CommandError(f'Invalid date {value!r}, expected YYYY-MM-DD')
+
+
+class Command(BaseCommand):
+    help = ('Exports the lines of the completed orders with their payments and addresses for accounting, '
+            'streaming them so any number of orders takes the same memory.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=sorted(FORMATS), default='csv')
+        parser.add_argument('--since', type=date, help='First payment date to export, YYYY-MM-DD.')
+        parser.add_argument('--until', type=date, help='Last payment date to export, YYYY-MM-DD.')
+        parser.add_argument('--output', help='File to write, instead of standard output.')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                            help='Rows fetched from the database at a time.')
+
+    def handle(self, *args, **options):
+        rows = order_lines(since=options['since'], until=options['until'])
+        lines = export_lines(options['format'], rows, options['chunk_size'])
+        if not options['output']:
+            for line in lines:
+                self.stdout.write(line, ending='')
+            return
+
+        count = -1 if options['format'] == 'csv' else 0
+        with open(options['output'], 'w', newline='', encoding='utf-8') as f:
+            for line in lines:
+                f.write(line)
+                count += 1
+        self.stderr.write(self.style.SUCCESS(f'Exported {count} order lines to {options["output"]}'))
@@ -0,0 +1,39 @@
+import os
+from django.core.management.base import BaseCommand, CommandError
+from shop.product_import import FORMATS, CHUNK_SIZE, import_products
+
+
+class Command(BaseCommand):
+    help = ('Creates and updates products from a CSV or JSON lines catalog keyed by sku, streaming it in '
+            'chunks so catalogs of any size take the same memory.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV file with a header row, or JSON lines file.')
+        parser.add_argument('--format', choices=sorted(FORMATS),
+                            help='Format of the file, by default its extension.')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                            help='Rows written to the database in one transaction.')
+        parser.add_argument('--skip-images', action='store_true',
+                            help="Don't generate the resized images, e.g. to run build_image_derivatives later.")
+
+    def handle(self, *args, **options):
+        import_format = options['format'] or os.path.splitext(options['path'])[1].lstrip('.').lower()
+        if import_format not in FORMATS:
+            raise CommandError(f'Unknown format {import_format!r}, pass --format')
+
+        def progress(report):
+            if options['verbosity'] > 1:
+                self.stderr.write(f'{report.rows} rows, {report.rows_per_second:.0f} rows/s')
+
+        try:
+            with open(options['path'], newline='', encoding='utf-8-sig') as f:
+                report = import_products(f, import_format, options['chunk_size'],
+                                         queue_images=not options['skip_images'], progress=progress)
+        except (OSError, UnicodeDecodeError) as e:
+            raise CommandError(f'Reading {options["path"]} failed: {e}')
+
+        self.stdout.write(self.style.SUCCESS(report.summary()))
+        for line, message in report.errors:
+            self.stderr.write(self.style.WARNING(f'Line {line}: {message}'))
+        if report.invalid > len(report.errors):
+            self.stderr.write(self.style.WARNING(f'... and {report.invalid - len(report.errors)} more invalid rows'))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from shop.payments import run_worker
+
+
+class Command(BaseCommand):
+    help = 'Runs the payment worker, charging the payments submitted at checkout.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once there are no pending payments left instead of waiting for new ones.')
+        parser.add_argument('--poll-interval', type=float, default=None,
+                            help='Seconds to wait before checking for new payments again.')
+
+    def handle(self, *args, **options):
+        run_worker(poll_interval=options['poll_interval'], once=options['once'])
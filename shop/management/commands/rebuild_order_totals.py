@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from shop.models import Order
+
+
+class Command(BaseCommand):
+    help = 'Verifies the running cart totals stored on orders and rebuilds the ones that are out of date.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='Only report orders with stale totals and exit with an error if there are any.')
+        parser.add_argument('--open-only', action='store_true',
+                            help='Only look at orders that have not been completed yet.')
+
+    def handle(self, *args, **options):
+        orders = Order.objects.all()
+        if options['open_only']:
+            orders = orders.filter(complete=False)
+
+        with transaction.atomic():
+            stale_ids = list(orders.stale_totals().values_list('pk', flat=True))
+            for order_id in stale_ids:
+                self.stdout.write(f'Order {order_id} has stale totals')
+
+            if options['check']:
+                if stale_ids:
+                    raise CommandError(f'{len(stale_ids)} orders have stale totals')
+                self.stdout.write(self.style.SUCCESS('All order totals are up to date'))
+                return
+
+            rebuilt = Order.objects.filter(pk__in=stale_ids).rebuild_totals()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt the totals of {rebuilt} orders'))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from shop.models import Product
+from shop.search import search_backend, index_products
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds the product search index from the products, e.g. after changing them in bulk '
+            'with QuerySet.update() or bulk_create(), which don\'t update it.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        backend = search_backend()
+        if backend is None:
+            raise CommandError(f'Products are searched without an index on {connection.vendor}')
+
+        products = Product.objects.only('name', 'brand', 'description').order_by('pk')
+        batch = []
+        count = 0
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                backend.clear(cursor)
+            for product in products.iterator(chunk_size=options['batch_size']):
+                batch.append(product)
+                if len(batch) == options['batch_size']:
+                    index_products(batch)
+                    count += len(batch)
+                    batch = []
+            index_products(batch)
+            count += len(batch)
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} products'))
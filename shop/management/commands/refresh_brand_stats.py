@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from shop.brand_stats import rebuild_brand_stats
+
+
+class Command(BaseCommand):
+    help = ('Recomputes the catalog stats of every brand, e.g. after changing products in bulk with '
+            'QuerySet.update(), which doesn\'t refresh them.')
+
+    def handle(self, *args, **options):
+        count = rebuild_brand_stats()
+        self.stdout.write(self.style.SUCCESS(f'Refreshed the stats of {count} brands'))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from shop.stock import release_expired_holds, recount_reserved
+
+
+class Command(BaseCommand):
+    help = 'Releases the stock held by carts whose holds have expired. Meant to run every few minutes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recount', action='store_true',
+                            help='Also recompute the units reserved of every product from the remaining holds.')
+
+    def handle(self, *args, **options):
+        released = release_expired_holds()
+        self.stdout.write(self.style.SUCCESS(f'Released {released} expired holds'))
+
+        if options['recount']:
+            recount_reserved()
+            self.stdout.write(self.style.SUCCESS('Recounted reserved stock'))
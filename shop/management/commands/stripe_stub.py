@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from shop.stripe_stub import StripeStubServer
+
+
+class Command(BaseCommand):
+    help = 'Runs a local stand-in for the Stripe charges API. Point STRIPE_API_BASE at it.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=12111)
+        parser.add_argument('--latency', type=float, default=0,
+                            help='Seconds every request takes, to simulate a slow payment provider.')
+
+    def handle(self, *args, **options):
+        stub = StripeStubServer(port=options['port'], latency=options['latency'])
+        self.stdout.write(f'Stripe stub listening on {stub.url}')
+        try:
+            stub.httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stub.httpd.server_close()
@@ -0,0 +1,53 @@
+# Generated by Django 3.1.4 on 2026-10-18 12:47
+
+from django.db import migrations, models
+from django.db.models import F, Sum, Exists, OuterRef, Subquery, FloatField, ExpressionWrapper
+from django.db.models.functions import Coalesce
+
+
+def populate_running_totals(apps, schema_editor):
+    # Fills the running totals of existing orders from their lines in a single UPDATE
+    Order = apps.get_model('shop', 'Order')
+    OrderItem = apps.get_model('shop', 'OrderItem')
+
+    lines = OrderItem.objects.filter(order=OuterRef('pk')).order_by().values('order')
+    line_total = ExpressionWrapper(
+        F('quantity') * Coalesce('product__discount_price', 'product__price'),
+        output_field=FloatField(),
+    )
+    Order.objects.update(
+        item_count=Coalesce(Subquery(lines.annotate(items=Sum('quantity')).values('items')), 0),
+        subtotal=Coalesce(Subquery(lines.annotate(subtotal=Sum(line_total)).values('subtotal'),
+                                   output_field=FloatField()), 0.0),
+        requires_shipping=Exists(OrderItem.objects.filter(order=OuterRef('pk'), product__digital=False)),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='product',
+            name='date_posted',
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='item_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='requires_shipping',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='subtotal',
+            field=models.FloatField(default=0),
+        ),
+        migrations.RunPython(populate_running_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 3.1.4 on 2026-10-18 13:32
+
+from django.db import migrations, models
+
+
+def populate_idempotency_keys(apps, schema_editor):
+    # Numbers the existing attempts of each order and gives them their idempotency key
+    PaymentAttempt = apps.get_model('shop', 'PaymentAttempt')
+    numbers = {}
+    for attempt in PaymentAttempt.objects.order_by('order_id', 'created', 'pk'):
+        attempt.number = numbers[attempt.order_id] = numbers.get(attempt.order_id, 0) + 1
+        attempt.idempotency_key = f'order-{attempt.order_id}-attempt-{attempt.number}'
+        attempt.save(update_fields=['number', 'idempotency_key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0004_payment_attempts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paymentattempt',
+            name='number',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='paymentattempt',
+            name='idempotency_key',
+            field=models.CharField(default='', max_length=100),
+            preserve_default=False,
+        ),
+        migrations.RunPython(populate_idempotency_keys, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='paymentattempt',
+            name='idempotency_key',
+            field=models.CharField(max_length=100, unique=True),
+        ),
+        migrations.AddConstraint(
+            model_name='paymentattempt',
+            constraint=models.UniqueConstraint(fields=('order', 'number'), name='unique_payment_attempt_number'),
+        ),
+    ]
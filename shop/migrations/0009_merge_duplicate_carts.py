@@ -0,0 +1,90 @@
+from django.db import migrations
+from django.db.models import Count
+
+
+def merge_lines(OrderItem, StockHold, order, into):
+    # Moves the lines and stock holds of an order into another, adding up the quantities
+    # of a product found in both
+    for model in (OrderItem, StockHold):
+        existing = {row.product_id: row for row in model.objects.filter(order=into) if row.product_id}
+        for row in model.objects.filter(order=order):
+            if row.product_id in existing:
+                kept = existing[row.product_id]
+                kept.quantity = (kept.quantity or 0) + (row.quantity or 0)
+                kept.save(update_fields=['quantity'])
+                row.delete()
+            else:
+                row.order = into
+                row.save(update_fields=['order'])
+
+
+def merge_attempts(PaymentAttempt, orders, into):
+    # Moves the payment attempts of the orders into another, keeping their idempotency keys, so
+    # they aren't deleted along with the orders. All the attempts are renumbered past the highest
+    # number in the order they were made, so the last attempt by number is still the latest one.
+    attempts = list(PaymentAttempt.objects.filter(order__in=[into] + orders).order_by('created', 'pk'))
+    last = max((attempt.number for attempt in attempts), default=0)
+    for number, attempt in enumerate(attempts, start=last + 1):
+        attempt.order = into
+        attempt.number = number
+        attempt.save(update_fields=['order', 'number'])
+
+
+def update_totals(OrderItem, order):
+    items = list(OrderItem.objects.filter(order=order).select_related('product'))
+    order.item_count = sum(item.quantity or 0 for item in items if item.product)
+    order.subtotal = sum(
+        (item.quantity or 0) * (item.product.discount_price or item.product.price)
+        for item in items if item.product
+    )
+    order.requires_shipping = any(not item.product.digital for item in items if item.product)
+    order.save(update_fields=['item_count', 'subtotal', 'requires_shipping'])
+
+
+def merge_duplicates(apps, schema_editor):
+    # Leaves every customer a single open cart and every cart a single line per product,
+    # as required by the constraints added next
+    Order = apps.get_model('shop', 'Order')
+    OrderItem = apps.get_model('shop', 'OrderItem')
+    StockHold = apps.get_model('shop', 'StockHold')
+    Coupon = apps.get_model('shop', 'Coupon')
+    PaymentAttempt = apps.get_model('shop', 'PaymentAttempt')
+
+    # Merging open carts into the customer's latest one
+    customers = (Order.objects.filter(complete=False, customer__isnull=False).values('customer')
+                 .annotate(carts=Count('id')).filter(carts__gt=1).values_list('customer', flat=True))
+    for customer in list(customers):
+        latest, *others = Order.objects.filter(customer=customer, complete=False).order_by('-pk')
+        if PaymentAttempt.objects.filter(order__in=others).exists():
+            merge_attempts(PaymentAttempt, others, latest)
+        for order in others:
+            merge_lines(OrderItem, StockHold, order, latest)
+            order.delete()
+        update_totals(OrderItem, latest)
+
+    # Merging repeated lines of a product into the first one
+    repeated = (OrderItem.objects.filter(order__isnull=False, product__isnull=False)
+                .values('order', 'product').annotate(lines=Count('id')).filter(lines__gt=1))
+    for line in list(repeated):
+        first, *others = OrderItem.objects.filter(order=line['order'], product=line['product']).order_by('pk')
+        first.quantity = sum(item.quantity or 0 for item in [first] + others)
+        first.save(update_fields=['quantity'])
+        OrderItem.objects.filter(pk__in=[item.pk for item in others]).delete()
+
+    # Repeated coupon codes could never be redeemed, the copies are renamed
+    codes = Coupon.objects.values('code').annotate(coupons=Count('id')).filter(coupons__gt=1)
+    for code in list(codes.values_list('code', flat=True)):
+        for coupon in Coupon.objects.filter(code=code).order_by('pk')[1:]:
+            coupon.code = f'{code[:12]}-{coupon.pk}'
+            coupon.save(update_fields=['code'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0008_media_blobs'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.4 on 2026-10-18 13:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0010_lookup_indexes_and_constraints'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='payment',
+            name='timestamp',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,47 @@
+from django.db import migrations
+
+# The search index of shop.search, which the ORM has no field for: an FTS5 table on SQLite and a
+# tsvector column with a GIN index on PostgreSQL. Other databases search without an index.
+
+SQLITE_CREATE = [
+    "CREATE VIRTUAL TABLE shop_product_search USING fts5(name, brand, description, tokenize='porter unicode61')",
+    "INSERT INTO shop_product_search (rowid, name, brand, description) "
+    "SELECT id, name, coalesce(brand, ''), coalesce(description, '') FROM shop_product",
+]
+
+POSTGRES_CREATE = [
+    "CREATE TABLE shop_product_search ("
+    "product_id integer PRIMARY KEY REFERENCES shop_product (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+    "document tsvector NOT NULL)",
+    "CREATE INDEX shop_product_search_document_idx ON shop_product_search USING GIN (document)",
+    "INSERT INTO shop_product_search (product_id, document) "
+    "SELECT id, setweight(to_tsvector('english', name), 'A') || "
+    "setweight(to_tsvector('english', coalesce(brand, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(description, '')), 'B') FROM shop_product",
+]
+
+STATEMENTS = {
+    'sqlite': SQLITE_CREATE,
+    'postgresql': POSTGRES_CREATE,
+}
+
+
+def create_search_index(apps, schema_editor):
+    for statement in STATEMENTS.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(statement)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor in STATEMENTS:
+        schema_editor.execute('DROP TABLE shop_product_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0011_payment_timestamp_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
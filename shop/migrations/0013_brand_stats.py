@@ -0,0 +1,51 @@
+# Generated by Django 3.1.4 on 2026-10-18 13:28
+
+from django.db import migrations, models
+from django.db.models import Q, Count, Min, Max
+from django.db.models.functions import Coalesce
+
+
+def compute_brand_stats(apps, schema_editor):
+    Product = apps.get_model('shop', 'Product')
+    BrandStats = apps.get_model('shop', 'BrandStats')
+    price = Coalesce('discount_price', 'price')
+    rows = Product.objects.exclude(brand__isnull=True).exclude(brand='').order_by().values('brand').annotate(
+        product_count=Count('id'),
+        in_stock_count=Count('id', filter=Q(quantity__gt=0)),
+        discounted_count=Count('id', filter=Q(discount_price__isnull=False)),
+        min_price=Min(price),
+        max_price=Max(price),
+    )
+    BrandStats.objects.bulk_create([BrandStats(**row) for row in rows])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0012_product_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BrandStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('brand', models.CharField(max_length=100, unique=True)),
+                ('product_count', models.IntegerField(default=0)),
+                ('in_stock_count', models.IntegerField(default=0)),
+                ('discounted_count', models.IntegerField(default=0)),
+                ('min_price', models.FloatField(null=True)),
+                ('max_price', models.FloatField(null=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': 'Brand stats',
+            },
+        ),
+        migrations.AlterField(
+            model_name='product',
+            name='brand',
+            field=models.CharField(blank=True, db_index=True, max_length=100, null=True),
+        ),
+        migrations.RunPython(compute_brand_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,90 @@
+from django.db import migrations
+from django.db.models import F
+from django.db.models.functions import Round
+import shop.money
+
+# Model -> amount fields, stored as floats of major units until now
+MONEY_FIELDS = {
+    'Product': ['price', 'discount_price'],
+    'BrandStats': ['min_price', 'max_price'],
+    'PricingRule': ['min_price', 'max_price'],
+    'Coupon': ['amount'],
+    'Payment': ['amount'],
+    'Order': ['subtotal'],
+    'PaymentAttempt': ['amount'],
+}
+
+
+def to_cents(apps, schema_editor):
+    # Turns the amounts into cents while the columns still hold floats, so the integer columns
+    # they are altered into next get the rounded cents
+    for model_name, fields in MONEY_FIELDS.items():
+        model = apps.get_model('shop', model_name)
+        model.objects.update(**{field: Round(F(field) * 100) for field in fields})
+
+
+def to_units(apps, schema_editor):
+    for model_name, fields in MONEY_FIELDS.items():
+        model = apps.get_model('shop', model_name)
+        model.objects.update(**{field: F(field) / 100.0 for field in fields})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0015_pricing_rules'),
+    ]
+
+    operations = [
+        migrations.RunPython(to_cents, to_units),
+        migrations.AlterField(
+            model_name='brandstats',
+            name='max_price',
+            field=shop.money.MoneyField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='brandstats',
+            name='min_price',
+            field=shop.money.MoneyField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='coupon',
+            name='amount',
+            field=shop.money.MoneyField(),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='subtotal',
+            field=shop.money.MoneyField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='amount',
+            field=shop.money.MoneyField(),
+        ),
+        migrations.AlterField(
+            model_name='paymentattempt',
+            name='amount',
+            field=shop.money.MoneyField(),
+        ),
+        migrations.AlterField(
+            model_name='pricingrule',
+            name='max_price',
+            field=shop.money.MoneyField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='pricingrule',
+            name='min_price',
+            field=shop.money.MoneyField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='product',
+            name='discount_price',
+            field=shop.money.MoneyField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='product',
+            name='price',
+            field=shop.money.MoneyField(),
+        ),
+    ]
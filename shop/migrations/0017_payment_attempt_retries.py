@@ -0,0 +1,23 @@
+# Generated by Django 3.1.4 on 2026-10-18 14:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0016_money_in_cents'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paymentattempt',
+            name='retries',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='paymentattempt',
+            name='retry_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.1.4 on 2026-10-18 14:43
+
+from django.db import migrations
+import shop.money
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0017_payment_attempt_retries'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderitem',
+            name='price',
+            field=shop.money.MoneyField(blank=True, null=True),
+        ),
+    ]
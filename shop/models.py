@@ -1,11 +1,15 @@
+from collections import namedtuple
+from decimal import Decimal
 from django.db import models
-from django.db.models import F
-from PIL import Image
+from django.db.models import F, Sum, Exists, OuterRef, Subquery, ExpressionWrapper
+from django.db.models.functions import Coalesce
 from autoslug import AutoSlugField
 from django.contrib.auth.models import User
+from django.core.validators import MinValueValidator, MaxValueValidator
 from django.utils import timezone
 from django.shortcuts import reverse
 from django_countries.fields import CountryField
+from shop.money import Money, MoneyField
 
 
 ADDRESS_CHOICES = (
@@ -13,17 +17,49 @@ ADDRESS_CHOICES = (
     ('S', "Shipping"),
 )
 
+PAYMENT_STATUS_CHOICES = (
+    ('P', 'Pending'),
+    ('R', 'Processing'),
+    ('S', 'Succeeded'),
+    ('F', 'Failed'),
+)
+
+# Quantity, amounts and shipping requirement of a cart
+CartSummary = namedtuple('CartSummary', ['items', 'subtotal', 'total', 'shipping'])
+
+
+def line_total(prefix=''):
+    # Returns an expression for the price of an order line: the product's discount price
+    # (or price when it has none) times the quantity. The prefix is the lookup path from
+    # the queried model to the order item.
+    return ExpressionWrapper(
+        F(f'{prefix}quantity') * Coalesce(f'{prefix}product__discount_price', f'{prefix}product__price'),
+        output_field=MoneyField(),
+    )
+
 
 class Product(models.Model):
+    # Stock keeping unit of the supplier's catalog, which product imports are keyed by (see shop.product_import)
+    sku = models.CharField(max_length=64, unique=True, null=True, blank=True)
     name = models.CharField(max_length=200)
-    brand = models.CharField(max_length=100, null=True, blank=True)
-    price = models.FloatField()
+    # Indexed for refreshing the stats of a brand (see shop.brand_stats)
+    brand = models.CharField(max_length=100, null=True, blank=True, db_index=True)
+    price = MoneyField()
     quantity = models.IntegerField(default=1)
-    discount_price = models.FloatField(null=True, blank=True)
+    # Units held by customers' carts, see shop.stock
+    reserved = models.IntegerField(default=0)
+    discount_price = MoneyField(null=True, blank=True)
+    # Rule that set the discount price, which is then the engine's to change (see shop.pricing).
+    # Discount prices set by hand have none and are left alone.
+    promotion = models.ForeignKey('PricingRule', on_delete=models.SET_NULL, null=True, blank=True, editable=False)
     digital = models.BooleanField(default=False)
     image = models.ImageField(null=True)
+    # Resized copies of the image, see shop.images
+    image_derivatives = models.JSONField(default=dict, blank=True, editable=False)
     description = models.TextField(null=True, blank=True)
     slug = AutoSlugField(populate_from='name', unique=True)
+    # Part of the keys of cached pages and fragments showing the product
+    updated = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.name
@@ -31,29 +67,67 @@ class Product(models.Model):
     def get_absolute_url(self):
         return reverse('product', kwargs={'slug': self.slug})
 
-    # def save(self, *args, **kwargs):
-    #     # resizing images before saving
-    #     super().save(*args, **kwargs)
-    #
-    #     with Image.open(self.image.path) as img:
-    #         if (img.height or img.width) > 1000:
-    #             output_size = (800, 800)
-    #             img.thumbnail(output_size)
-    #             img.save(self.image.path)
-
-
+    @property
+    def available(self):
+        # Returns the quantity in stock that isn't held by a cart
+        return max(self.quantity - self.reserved, 0)
 
     @property
     def discount(self):
         if self.discount_price:
-            return int(((self.price - self.discount_price) / self.price) * 100)
+            return (self.price.cents - self.discount_price.cents) * 100 // self.price.cents
         else:
             return 0
 
 
+class BrandStats(models.Model):
+    # Catalog aggregates of a brand, kept up to date by shop.brand_stats
+    brand = models.CharField(max_length=100, unique=True)
+    product_count = models.IntegerField(default=0)
+    in_stock_count = models.IntegerField(default=0)
+    discounted_count = models.IntegerField(default=0)
+    # Lowest and highest price of the brand's products, their discount price when they have one
+    min_price = MoneyField(null=True)
+    max_price = MoneyField(null=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.brand
+
+    class Meta:
+        verbose_name_plural = 'Brand stats'
+
+
+class PricingRule(models.Model):
+    # A promotion discounting the products it applies to while it runs, see shop.pricing
+    name = models.CharField(max_length=100)
+    # Products of the brand, or of every brand when blank
+    brand = models.CharField(max_length=100, null=True, blank=True)
+    # Products priced from min_price (included) to max_price (excluded), when given
+    min_price = MoneyField(null=True, blank=True)
+    max_price = MoneyField(null=True, blank=True)
+    percent_off = models.FloatField(validators=[MinValueValidator(0), MaxValueValidator(100)])
+    # Runs from starts_at to ends_at, or without end
+    starts_at = models.DateTimeField(null=True, blank=True)
+    ends_at = models.DateTimeField(null=True, blank=True)
+    active = models.BooleanField(default=True)
+
+    def __str__(self):
+        return self.name
+
+    def applies_to(self, brand, price):
+        return ((not self.brand or self.brand == brand) and
+                (self.min_price is None or price >= self.min_price) and
+                (self.max_price is None or price < self.max_price))
+
+    def discounted(self, price):
+        # Returns the discount price of a product at the price, rounded to the cent
+        return price * ((100 - Decimal(str(self.percent_off))) / 100)
+
+
 class Coupon(models.Model):
-    code = models.CharField(max_length=20)
-    amount = models.FloatField()
+    code = models.CharField(max_length=20, unique=True)
+    amount = MoneyField()
 
     def __str__(self):
         return self.code
@@ -87,23 +161,69 @@ class Address(models.Model):
 
     class Meta:
         verbose_name_plural = 'Addresses'
+        indexes = [
+            # Looking up a customer's default shipping or billing address at checkout
+            models.Index(fields=['customer', 'address_type', 'default'], name='address_default_idx'),
+        ]
 
 
 class Payment(models.Model):
     charge_id = models.CharField(max_length=50)
     customer = models.ForeignKey(Customer, on_delete=models.SET_NULL, blank=True, null=True)
-    amount = models.FloatField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    amount = MoneyField()
+    # Accounting exports select payments by date (see shop.exports)
+    timestamp = models.DateTimeField(auto_now_add=True, db_index=True)
 
     def __str__(self):
         return f'Ghc{self.amount:.2f}'
 
 
+def cart_summary_expressions():
+    # Returns the expressions computing an order's cart quantity, subtotal and shipping
+    # requirement from its lines, for use in annotations or updates of orders.
+    lines = OrderItem.objects.filter(order=OuterRef('pk')).order_by().values('order')
+    items = lines.annotate(items=Sum('quantity')).values('items')
+    subtotal = lines.annotate(subtotal=Sum(line_total())).values('subtotal')
+    physical_items = OrderItem.objects.filter(order=OuterRef('pk'), product__digital=False)
+
+    return {
+        'item_count': Coalesce(Subquery(items), 0),
+        'subtotal': Coalesce(Subquery(subtotal, output_field=MoneyField()), 0, output_field=MoneyField()),
+        'requires_shipping': Exists(physical_items),
+    }
+
+
+class OrderQuerySet(models.QuerySet):
+
+    def with_cart_summary(self):
+        # Annotates each order with its cart quantity, subtotal and shipping requirement
+        # computed from the order lines, all in the same query that fetches the order.
+        expressions = cart_summary_expressions()
+        return self.annotate(
+            summary_items=expressions['item_count'],
+            summary_subtotal=expressions['subtotal'],
+            summary_shipping=expressions['requires_shipping'],
+        )
+
+    def stale_totals(self):
+        # Returns the orders whose stored running totals don't match their lines.
+        return self.with_cart_summary().exclude(
+            item_count=F('summary_items'),
+            subtotal=F('summary_subtotal'),
+            requires_shipping=F('summary_shipping'),
+        )
+
+    def rebuild_totals(self):
+        # Recomputes the stored running totals of the orders from their lines in a single UPDATE.
+        return self.update(**cart_summary_expressions())
+
+
 class Order(models.Model):
     customer = models.ForeignKey(Customer, on_delete=models.SET_NULL, null=True, blank=True)
     date_ordered = models.DateTimeField(auto_now_add=True)
     complete = models.BooleanField(default=False, null=True, blank=False)
-    transaction_id = models.CharField(max_length=200, null=True)
+    # Looked up by customers requesting a refund
+    transaction_id = models.CharField(max_length=200, null=True, db_index=True)
     billing_address = models.ForeignKey(Address, related_name='billing_address', on_delete=models.SET_NULL,
                                         null=True, blank=True)
     shipping_address = models.ForeignKey(Address, related_name='shipping_address', on_delete=models.SET_NULL,
@@ -115,56 +235,170 @@ class Order(models.Model):
     refund_requested = models.BooleanField(default=False, null=True, blank=False)
     refund_granted = models.BooleanField(default=False, null=True, blank=False)
 
+    # Running totals of the cart, kept up to date with update_totals() whenever its lines change
+    item_count = models.IntegerField(default=0)
+    subtotal = MoneyField(default=0)
+    requires_shipping = models.BooleanField(default=False)
+
+    objects = OrderQuerySet.as_manager()
+
     def __str__(self):
         if self.transaction_id:
             return self.transaction_id
         else:
             return "N/A"
 
+    def update_totals(self):
+        # Recomputes the running totals from the order lines. Call it in the same
+        # transaction as the change to the lines so the totals never drift.
+        Order.objects.filter(pk=self.pk).rebuild_totals()
+        self.refresh_from_db(fields=['item_count', 'subtotal', 'requires_shipping'])
+
+    def cart_summary(self):
+        # Returns the cart summary from the running totals stored on the order.
+        total = self.subtotal
+        if self.coupon_id:
+            total = max(total - self.coupon.amount, Money(0))
+        return CartSummary(
+            items=self.item_count,
+            subtotal=self.subtotal,
+            total=total,
+            shipping=self.requires_shipping,
+        )
+
     def shipping(self):
         # Returns a boolean as to whether a product is digital or not
         # and has to be shipped.
-        items = self.orderitem_set.all()
-        for i in items:
-            if not i.product.digital:
-                return True
-        return False
+        return self.cart_summary().shipping
 
     def cart_total(self):
         # Returns the total amount of products in cart.
-        try:
-            total = sum([item.total() for item in self.orderitem_set.all()])
-            total -= self.coupon.amount
-            if total < 0:
-                return 0
-            return total
-        except AttributeError:
-            total = sum([item.total() for item in self.orderitem_set.all()])
-            return total
+        return self.cart_summary().total
 
     def cart_items(self):
         # Returns the total quantity of products in cart.
-        total = sum([item.quantity for item in self.orderitem_set.all()])
-        return total
+        return self.cart_summary().items
+
+    class Meta:
+        indexes = [
+            # Finding a customer's open cart, or their completed orders
+            models.Index(fields=['customer', 'complete'], name='order_customer_complete_idx'),
+        ]
+        constraints = [
+            # A customer has a single open cart, even when two requests create it at once
+            models.UniqueConstraint(fields=['customer'], condition=models.Q(complete=False),
+                                    name='unique_open_order_per_customer'),
+        ]
+
+
+class OrderItemQuerySet(models.QuerySet):
+
+    def with_totals(self):
+        # Loads the product with each line and annotates the line total,
+        # so rendering a cart costs one query regardless of its size.
+        return self.select_related('product').annotate(line_total=line_total())
+
+    def record_prices(self):
+        # Stores the product's current discount price (or price) on each line, in one UPDATE,
+        # as the price the line is charged at
+        products = Product.objects.filter(pk=OuterRef('product_id'))
+        return self.update(price=Subquery(products.values(unit_price=Coalesce('discount_price', 'price'))[:1]))
 
 
 class OrderItem(models.Model):
     product = models.ForeignKey(Product, on_delete=models.SET_NULL, null=True, blank=True)
     quantity = models.IntegerField(default=0, null=True, blank=True)
     order = models.ForeignKey(Order, on_delete=models.CASCADE, null=True)
+    # Unit price the line was checked out at, while the product's price may change afterwards.
+    # None until checkout, and for lines checked out before prices were recorded.
+    price = MoneyField(null=True, blank=True)
     date_added = models.DateTimeField(auto_now_add=True)
 
+    objects = OrderItemQuerySet.as_manager()
+
     def __str__(self):
         return self.product.name
 
     def total(self):
         # Returns the total price of the quantity of products in cart
+        if hasattr(self, 'line_total'):
+            return self.line_total
         try:
             total = self.product.discount_price * self.quantity
         except TypeError:
             total = self.product.price * self.quantity
         return total
 
+    class Meta:
+        constraints = [
+            # A cart has one line per product, whose quantity is changed
+            models.UniqueConstraint(fields=['order', 'product'], name='unique_order_item_product'),
+        ]
+
+
+class PaymentAttempt(models.Model):
+    # A charge submitted at checkout, made by the payment worker (see shop.payments)
+    order = models.ForeignKey(Order, on_delete=models.CASCADE)
+    customer = models.ForeignKey(Customer, on_delete=models.SET_NULL, null=True, blank=True)
+    # Attempts of an order are numbered from 1, a new one is only made after the last one failed
+    number = models.PositiveIntegerField(default=1)
+    # Sent to Stripe with the charge, so retrying an attempt can never charge twice
+    idempotency_key = models.CharField(max_length=100, unique=True)
+    amount = MoneyField()
+    token = models.CharField(max_length=255)
+    status = models.CharField(max_length=1, choices=PAYMENT_STATUS_CHOICES, default='P')
+    error_message = models.CharField(max_length=255, blank=True)
+    payment = models.ForeignKey(Payment, on_delete=models.SET_NULL, null=True, blank=True)
+    # Times the charge was retried after Stripe couldn't take it, and when it is tried next
+    retries = models.PositiveSmallIntegerField(default=0)
+    retry_at = models.DateTimeField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.get_status_display()} payment of Ghc{self.amount:.2f} for order {self.order_id}'
+
+    @property
+    def in_progress(self):
+        return self.status in ('P', 'R')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'created'], name='payment_attempt_queue_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['order', 'number'], name='unique_payment_attempt_number'),
+        ]
+
+
+class StockHold(models.Model):
+    # Units of a product held for an open cart until expires_at
+    order = models.ForeignKey(Order, on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    quantity = models.IntegerField(default=0)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f'{self.quantity} x {self.product} for order {self.order_id}'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['order', 'product'], name='unique_stock_hold_per_order_product'),
+        ]
+
+
+class MediaBlob(models.Model):
+    # A unique uploaded file of the content addressed storage (see shop.storage), shared by
+    # every upload with the same content. The file is deleted with its last reference.
+    digest = models.CharField(max_length=64, unique=True)
+    name = models.CharField(max_length=255, unique=True)
+    size = models.BigIntegerField()
+    references = models.PositiveIntegerField(default=1)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.name
+
 
 class Refund(models.Model):
     order = models.ForeignKey(Order, on_delete=models.SET_NULL, null=True, blank=True)
@@ -0,0 +1,180 @@
+from decimal import Decimal, ROUND_HALF_UP, InvalidOperation
+from django import forms
+from django.core import exceptions
+from django.db import models
+from django.db.models.query_utils import DeferredAttribute
+
+# Amounts of money (prices, coupons, payments, cart totals) as a whole number of cents. They are
+# stored in integer columns by MoneyField, so sums and comparisons in SQL are exact and a cart
+# total is charged for the cents it shows, where adding up floats drifted off by fractions of a
+# cent. Amounts are given in major units (Money.parse('19.99'), or 19.99 assigned to a field) and
+# shown with two decimals; Stripe is sent the cents.
+
+CENT = Decimal('0.01')
+
+
+class Money:
+    # An amount of money, in cents. Immutable; adding or subtracting takes other Money,
+    # multiplying takes a number and rounds to the cent.
+    __slots__ = ('cents',)
+
+    def __init__(self, cents=0):
+        if not isinstance(cents, int):
+            raise TypeError(f'cents must be an int, not {type(cents).__name__}')
+        object.__setattr__(self, 'cents', cents)
+
+    @classmethod
+    def parse(cls, value):
+        # Returns the amount of major units (a Money, number or numeric string), rounded
+        # half up to the cent. Raises ValueError when the value isn't a finite amount.
+        if isinstance(value, Money):
+            return value
+        if isinstance(value, bool):
+            raise ValueError(f'{value!r} is not an amount')
+        try:
+            # str() gives the shortest repr of a float, so 0.1 is read as 0.10 rather than as
+            # the binary fraction it stands for
+            amount = Decimal(value if isinstance(value, (int, Decimal)) else str(value).strip())
+        except InvalidOperation:
+            raise ValueError(f'{value!r} is not an amount')
+        if not amount.is_finite():
+            raise ValueError(f'{value!r} is not an amount')
+        return cls(int(amount.quantize(CENT, rounding=ROUND_HALF_UP).scaleb(2)))
+
+    @property
+    def decimal(self):
+        return Decimal(self.cents).scaleb(-2)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Money is immutable')
+
+    def __reduce__(self):
+        return Money, (self.cents,)
+
+    def __repr__(self):
+        return f"Money('{self}')"
+
+    def __str__(self):
+        return str(self.decimal)
+
+    def __format__(self, spec):
+        return format(self.decimal, spec)
+
+    def __float__(self):
+        return float(self.decimal)
+
+    def __bool__(self):
+        return self.cents != 0
+
+    def __hash__(self):
+        # Equal numbers hash alike, so it matches that of an equal Decimal or int
+        return hash(self.decimal)
+
+    def _compared(self, other):
+        # Returns what to compare the other operand's value with, or NotImplemented
+        if isinstance(other, Money):
+            return Decimal(other.cents).scaleb(-2)
+        if isinstance(other, (int, float, Decimal)) and not isinstance(other, bool):
+            return other
+        return NotImplemented
+
+    def __eq__(self, other):
+        other = self._compared(other)
+        return NotImplemented if other is NotImplemented else self.decimal == other
+
+    def __lt__(self, other):
+        other = self._compared(other)
+        return NotImplemented if other is NotImplemented else self.decimal < other
+
+    def __le__(self, other):
+        other = self._compared(other)
+        return NotImplemented if other is NotImplemented else self.decimal <= other
+
+    def __gt__(self, other):
+        other = self._compared(other)
+        return NotImplemented if other is NotImplemented else self.decimal > other
+
+    def __ge__(self, other):
+        other = self._compared(other)
+        return NotImplemented if other is NotImplemented else self.decimal >= other
+
+    def __add__(self, other):
+        if isinstance(other, Money):
+            return Money(self.cents + other.cents)
+        return NotImplemented
+
+    def __radd__(self, other):
+        # Starting value of sum()
+        if other == 0 and not isinstance(other, bool):
+            return self
+        return NotImplemented
+
+    def __sub__(self, other):
+        if isinstance(other, Money):
+            return Money(self.cents - other.cents)
+        return NotImplemented
+
+    def __neg__(self):
+        return Money(-self.cents)
+
+    def __mul__(self, factor):
+        if isinstance(factor, bool):
+            return NotImplemented
+        if isinstance(factor, int):
+            return Money(self.cents * factor)
+        if isinstance(factor, (float, Decimal)):
+            cents = Decimal(self.cents) * Decimal(str(factor) if isinstance(factor, float) else factor)
+            return Money(int(cents.quantize(Decimal(1), rounding=ROUND_HALF_UP)))
+        return NotImplemented
+
+    __rmul__ = __mul__
+
+
+class MoneyAttribute(DeferredAttribute):
+    # Turns the amounts assigned to a MoneyField into Money, so an instance created with
+    # price=190 has the price it is saved with
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = self.field.to_python(value)
+
+
+class MoneyField(models.Field):
+    # An amount of money stored as an integer number of cents
+    descriptor_class = MoneyAttribute
+    description = 'Amount of money, in cents'
+    empty_strings_allowed = False
+    default_error_messages = {
+        'invalid': '“%(value)s” is not an amount of money.',
+    }
+
+    def get_internal_type(self):
+        return 'BigIntegerField'
+
+    def from_db_value(self, value, expression, connection):
+        return None if value is None else Money(int(value))
+
+    def to_python(self, value):
+        if value is None or isinstance(value, Money) or hasattr(value, 'resolve_expression'):
+            return value
+        try:
+            return Money.parse(value)
+        except ValueError:
+            raise exceptions.ValidationError(self.error_messages['invalid'], code='invalid', params={'value': value})
+
+    def get_prep_value(self, value):
+        value = super().get_prep_value(value)
+        if value is None:
+            return None
+        return self.to_python(value).cents
+
+    def value_to_string(self, obj):
+        value = self.value_from_object(obj)
+        return None if value is None else str(value)
+
+    def formfield(self, **kwargs):
+        return super().formfield(**{
+            'form_class': forms.DecimalField,
+            'decimal_places': 2,
+            'max_digits': 17,
+            **kwargs,
+        })
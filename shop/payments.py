@@ -0,0 +1,205 @@
+import datetime
+import time
+import logging
+import uuid
+import stripe
+from django.conf import settings
+from django.db import transaction, close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+from shop.models import Order, Payment, PaymentAttempt
+from shop.stock import decrement_stock, restore_stock
+
+# Checkout only records a PaymentAttempt and returns. The Stripe charge is made by a separate
+# worker process (manage.py process_payments), so a slow payment provider ties up the worker
+# rather than the web workers serving pages. The customer's browser polls the attempt's
+# status page until the worker has completed or failed it.
+
+stripe.api_key = settings.STRIPE_SECRET_KEY
+stripe.api_base = settings.STRIPE_API_BASE
+
+logger = logging.getLogger(__name__)
+
+# Errors that fail the same way however often the charge is made: the card was declined or
+# the request was invalid. Attempts failing with other Stripe errors (Stripe couldn't be
+# reached, was rate limiting or failed on its side) are retried later with the same
+# idempotency key, so a charge Stripe did make is never made twice.
+FINAL_ERRORS = (stripe.error.CardError, stripe.error.InvalidRequestError)
+
+
+def idempotency_key(order, number):
+    # Returns the key identifying the charge of an order's attempt to Stripe. The random part
+    # keeps keys from clashing when order ids are reused, e.g. by another database sharing
+    # the Stripe account; retries reuse the key stored on the attempt.
+    return f'order-{order.pk}-attempt-{number}-{uuid.uuid4().hex[:12]}'
+
+
+def submit_payment(order, token):
+    # Queues the charge of the order's cart total for the payment worker, taking the ordered
+    # quantities out of stock. Returns the order's last attempt instead when it hasn't failed,
+    # so a double-clicked or retried submission never makes a second charge. The order is
+    # locked so concurrent submissions are handled one at a time. Raises OutOfStock.
+    with transaction.atomic():
+        Order.objects.select_for_update().only('pk').get(pk=order.pk)
+        previous = order.paymentattempt_set.order_by('-number').first()
+        if previous and previous.status != 'F':
+            return previous
+
+        # Taking the ordered quantities out of stock before charging, so the
+        # last pairs can't be sold to two customers at once
+        decrement_stock(list(order.orderitem_set.all()))
+        # Recording the prices the lines are charged at, for the order's records
+        order.orderitem_set.record_prices()
+
+        number = previous.number + 1 if previous else 1
+        return PaymentAttempt.objects.create(
+            order=order,
+            customer=order.customer,
+            number=number,
+            idempotency_key=idempotency_key(order, number),
+            amount=order.cart_total(),
+            token=token or '',
+        )
+
+
+def charge_error_message(error):
+    # Returns the message shown to the customer when a charge fails
+    if isinstance(error, stripe.error.CardError):
+        # Since it's a decline, stripe.error.CardError will be caught
+        return f'{error.user_message}'
+    elif isinstance(error, stripe.error.RateLimitError):
+        # Too many requests made to the API too quickly
+        return 'Rate Limit Error'
+    elif isinstance(error, stripe.error.InvalidRequestError):
+        # Invalid parameters were supplied to Stripe's API
+        return 'Invalid Parameters'
+    elif isinstance(error, stripe.error.AuthenticationError):
+        # Authentication with Stripe's API failed
+        # (maybe you changed API keys recently)
+        return 'Not Authenticated'
+    elif isinstance(error, stripe.error.APIConnectionError):
+        # Network communication with Stripe failed
+        return 'Network Error'
+    # Display a very generic error to the user
+    return 'Something went wrong, you were not charged. Please try again.'
+
+
+def requeue_stalled_attempts():
+    # Puts attempts whose worker stopped while processing them back in the queue
+    stalled_since = timezone.now() - datetime.timedelta(seconds=settings.PAYMENT_ATTEMPT_TIMEOUT)
+    return PaymentAttempt.objects.filter(status='R', updated__lt=stalled_since).update(status='P')
+
+
+def claim_next_attempt():
+    # Claims the oldest pending attempt for this worker. The claim is a conditional UPDATE,
+    # so two workers never process the same attempt. Returns None when the queue is empty.
+    # Attempts waiting to be retried are left until their time comes
+    now = timezone.now()
+    pending = PaymentAttempt.objects.filter(Q(retry_at__isnull=True) | Q(retry_at__lte=now), status='P')
+    for attempt_id in pending.order_by('created', 'pk').values_list('pk', flat=True)[:10]:
+        # Claiming restarts the clock of requeue_stalled_attempts(), however long the attempt waited
+        if PaymentAttempt.objects.filter(pk=attempt_id, status='P').update(status='R', updated=now):
+            return PaymentAttempt.objects.select_related('order', 'customer').get(pk=attempt_id)
+    return None
+
+
+def fail_attempt(attempt, message):
+    # Marks the attempt as failed and puts the stock taken at checkout back
+    with transaction.atomic():
+        attempt.status = 'F'
+        attempt.error_message = message[:255]
+        attempt.save(update_fields=['status', 'error_message', 'updated'])
+        restore_stock(list(attempt.order.orderitem_set.all()))
+
+
+def retry_attempt(attempt):
+    # Puts the attempt back in the queue to be charged again later, waiting twice as long
+    # after every retry
+    attempt.retries += 1
+    delay = settings.PAYMENT_RETRY_DELAY * 2 ** (attempt.retries - 1)
+    attempt.retry_at = timezone.now() + datetime.timedelta(seconds=delay)
+    attempt.status = 'P'
+    attempt.save(update_fields=['status', 'retries', 'retry_at', 'updated'])
+
+
+def complete_order(attempt, charge):
+    # Records the payment and completes the order once the charge went through
+    with transaction.atomic():
+        # Creating a payment, once per charge even if the attempt was retried
+        payment, created = Payment.objects.get_or_create(charge_id=charge['id'], defaults={
+            'customer': attempt.customer,
+            'amount': attempt.amount,
+        })
+
+        # Creating a transaction id
+        order = Order.objects.select_for_update().get(pk=attempt.order_id)
+        now = datetime.datetime.now()
+        year = now.strftime('%Y')
+        month = now.strftime('%m')
+        transaction_id = f'{year}{month}{order.id}'
+
+        # Changing the status of the order after completion
+        order.payment = payment
+        order.transaction_id = transaction_id
+        order.complete = True
+        order.save()
+
+        # Associating coupon with customer so it can't be used by same customer again
+        if order.coupon_id and attempt.customer:
+            attempt.customer.coupons.add(order.coupon_id)
+
+        attempt.status = 'S'
+        attempt.payment = payment
+        attempt.save(update_fields=['status', 'payment', 'updated'])
+
+
+def process_attempt(attempt):
+    # Creates the Stripe charge for a claimed attempt and completes or fails it
+    try:
+        # Creates a stripe charge
+        charge = stripe.Charge.create(
+            amount=attempt.amount.cents,   # Stripe amounts are in cents
+            currency="usd",
+            source=attempt.token,
+            idempotency_key=attempt.idempotency_key,
+        )
+    except FINAL_ERRORS as e:
+        fail_attempt(attempt, charge_error_message(e))
+        return attempt
+    except stripe.error.StripeError as e:
+        if attempt.retries >= settings.PAYMENT_MAX_RETRIES:
+            fail_attempt(attempt, charge_error_message(e))
+        else:
+            logger.warning('Charging payment attempt %s failed, retrying: %s', attempt.pk, e)
+            retry_attempt(attempt)
+        return attempt
+    except Exception:
+        # Something else happened, completely unrelated to Stripe
+        logger.exception('Charging payment attempt %s failed', attempt.pk)
+        fail_attempt(attempt, 'An error occurred. We have ben notified')
+        return attempt
+
+    complete_order(attempt, charge)
+    return attempt
+
+
+def process_next_attempt():
+    # Processes the oldest pending attempt, returning it, or None when there is none
+    attempt = claim_next_attempt()
+    if attempt is not None:
+        process_attempt(attempt)
+    return attempt
+
+
+def run_worker(poll_interval=None, once=False):
+    # Processes attempts as they are queued. With once, returns when the queue is empty.
+    poll_interval = settings.PAYMENT_WORKER_POLL_INTERVAL if poll_interval is None else poll_interval
+    while True:
+        # Dropping connections that went stale while waiting, and checking the others before
+        # their next use, as Django does between requests
+        close_old_connections()
+        requeue_stalled_attempts()
+        if process_next_attempt() is None:
+            if once:
+                return
+            time.sleep(poll_interval)
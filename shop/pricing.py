@@ -0,0 +1,146 @@
+from collections import defaultdict
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from shop.models import Product, PricingRule, Order
+from shop.brand_stats import refresh_brand_stats
+from shop.catalog import invalidate_products_on_commit
+
+# Catalog-wide promotions. A PricingRule takes a percentage off the products of a brand (or of
+# every brand), optionally within a price tier, while it runs. The engine gives each product the
+# discount price of the best running rule that applies to it and takes it away again once none
+# does. Discount prices set by hand have no promotion and are left alone.
+#
+# The catalog is repriced in chunks read by primary key. Discount prices are computed in Python
+# against the few running rules, and only the products whose discount changes are written: the
+# products of a chunk given the same discount price by the same rule share one UPDATE, so a
+# brand-wide sale costs an UPDATE per price point of the brand rather than a save per product.
+# Like saving the products would, repricing sets updated (expiring the cached pages), drops the
+# cached products, rebuilds the open carts holding them and refreshes the stats of their brands.
+#
+# Rules are applied when one is saved or deleted (see shop.signals), to the products saved in the
+# admin or imported, and by manage.py apply_pricing_rules, which should run every few minutes so
+# that rules start and end on time. Saving a rule reprices the products it concerns, only when it
+# prices them differently, and leaves catalogs of more than PRICING_RULE_REPRICE_LIMIT products
+# to apply_pricing_rules rather than repricing them within the request. Deleting a rule over the
+# limit only takes its discount prices away (see withdraw_rule()).
+
+CHUNK_SIZE = 1000
+
+# Products whose discount price is the engine's to change
+ENGINE_PRICED = Q(promotion__isnull=False) | Q(discount_price__isnull=True)
+
+# Product fields the discount price of a rule depends on
+PRICING_FIELDS = {'brand', 'price', 'discount_price'}
+
+# Rule fields the discount prices it gives depend on
+RULE_FIELDS = ('brand', 'min_price', 'max_price', 'percent_off', 'starts_at', 'ends_at', 'active')
+
+
+def active_rules(now=None):
+    # Returns the rules running at the time, the largest discount first
+    now = now or timezone.now()
+    return list(PricingRule.objects.filter(
+        Q(starts_at__isnull=True) | Q(starts_at__lte=now),
+        Q(ends_at__isnull=True) | Q(ends_at__gt=now),
+        active=True,
+    ).order_by('-percent_off', 'pk'))
+
+
+def promotion_price(rules, brand, price, discount_price, promotion_id):
+    # Returns the discount price and the promotion the rules give a product
+    if promotion_id is None and discount_price is not None:
+        return discount_price, None
+    for rule in rules:
+        if rule.applies_to(brand, price):
+            return rule.discounted(price), rule.pk
+    return None, None
+
+
+def rule_changed(rule, previous):
+    # Returns whether the rule prices products differently than its previous version, if any
+    return previous is None or any(getattr(rule, field) != getattr(previous, field) for field in RULE_FIELDS)
+
+
+def rule_products(*rules):
+    # Returns the products the rules can change the price of: those of their brands (of every
+    # brand when one has none) and those they discount
+    if any(not rule.brand for rule in rules):
+        return Product.objects.all()
+    return Product.objects.filter(Q(brand__in={rule.brand for rule in rules}) | Q(promotion__in=rules))
+
+
+def reprices_in_request(products):
+    # Returns whether repricing the products is quick enough to do within a request
+    return not products.all()[settings.PRICING_RULE_REPRICE_LIMIT:].exists()
+
+
+def apply_rules(product, rules):
+    # Gives the unsaved product the discount price of the rules, returning whether it changed
+    current = (product.discount_price, product.promotion_id)
+    product.discount_price, product.promotion_id = promotion_price(rules, product.brand, product.price, *current)
+    return (product.discount_price, product.promotion_id) != current
+
+
+def write_prices(groups):
+    # Writes the discount prices of the products, grouped by (discount price, promotion id)
+    now = timezone.now()
+    product_ids = [pk for ids in groups.values() for pk in ids]
+    with transaction.atomic():
+        for (discount_price, promotion_id), ids in groups.items():
+            # Unless a discount price was set by hand meanwhile
+            Product.objects.filter(ENGINE_PRICED, pk__in=ids).update(
+                discount_price=discount_price,
+                promotion_id=promotion_id,
+                updated=now,
+            )
+        Order.objects.filter(complete=False, orderitem__product__in=product_ids).rebuild_totals()
+        invalidate_products_on_commit(product_ids)
+
+
+def withdraw_rule(rule):
+    # Takes the discount prices of a rule about to be deleted away from its products, leaving
+    # them to the other rules at the next run of apply_pricing_rules, in a few queries however
+    # many products there are. Returns the number of products.
+    products = Product.objects.filter(promotion=rule)
+    product_ids = list(products.values_list('pk', flat=True))
+    brands = set(products.values_list('brand', flat=True).distinct())
+    with transaction.atomic():
+        carts = list(Order.objects.filter(complete=False, orderitem__product__promotion=rule)
+                     .values_list('pk', flat=True).distinct())
+        products.update(discount_price=None, promotion=None, updated=timezone.now())
+        Order.objects.filter(pk__in=carts).rebuild_totals()
+        invalidate_products_on_commit(product_ids)
+    refresh_brand_stats(brands)
+    return len(product_ids)
+
+
+def reprice_products(products=None, rules=None, chunk_size=CHUNK_SIZE):
+    # Applies the rules (default: the running ones) to the products (default: all of them),
+    # returning the number of products repriced
+    products = Product.objects.all() if products is None else products
+    rules = active_rules() if rules is None else rules
+    repriced = 0
+    brands = set()
+    last_pk = 0
+    try:
+        while True:
+            chunk = list(products.filter(pk__gt=last_pk).order_by('pk').values_list(
+                'pk', 'brand', 'price', 'discount_price', 'promotion_id')[:chunk_size])
+            if not chunk:
+                break
+            last_pk = chunk[-1][0]
+
+            groups = defaultdict(list)
+            for pk, brand, price, discount_price, promotion_id in chunk:
+                priced = promotion_price(rules, brand, price, discount_price, promotion_id)
+                if priced != (discount_price, promotion_id):
+                    groups[priced].append(pk)
+                    brands.add(brand)
+            if groups:
+                write_prices(groups)
+                repriced += sum(len(ids) for ids in groups.values())
+    finally:
+        refresh_brand_stats(brands)
+    return repriced
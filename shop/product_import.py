@@ -0,0 +1,388 @@
+import csv
+import json
+import time
+from collections import Counter, defaultdict
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from shop.models import Product, Order, MediaBlob
+from shop.money import Money
+from shop.brand_stats import STATS_FIELDS, refresh_brand_stats
+from shop.catalog import invalidate_products_on_commit
+from shop.images import needs_derivatives, queue_derivatives
+from shop.pricing import PRICING_FIELDS, active_rules, apply_rules
+from shop.search import SEARCH_FIELDS, index_products
+from shop.signals import CART_TOTAL_FIELDS, release_files
+
+# Bulk import of supplier catalogs, as CSV with a header row or as JSON lines, one product per row
+# keyed by its sku. Rows are parsed as they are read and written a chunk at a time, each chunk in
+# its own transaction: one query loads the chunk's existing products, the changed ones are saved
+# with bulk_update() and the new ones inserted together, with slugs made unique in memory (see
+# SlugAllocator). The memory taken is that of a chunk whatever the size of the file, and the time
+# grows linearly with it. Used by manage.py import_products and the 'Import' page of ProductAdmin.
+#
+# Bulk writes send no model signals, so the import does what the signals would: it indexes the
+# products for search, applies the pricing rules (see shop.pricing), expires their cached copies,
+# rebuilds the totals of the open carts holding repriced products, counts the references to their
+# images and queues the resized copies of the images. The stats of the brands involved are
+# refreshed once, at the end. A discount_price column is a discount set by hand.
+#
+# Every column but sku is optional: existing products keep the values of the columns a file leaves
+# out, new ones need a name and a price. An image is the name of a file already in the media storage.
+
+CHUNK_SIZE = 1000
+
+# Products looked up by slug in one query
+SLUG_QUERY_SIZE = 500
+
+# Errors kept for the report, the others are only counted
+MAX_ERRORS = 20
+
+TRUE_VALUES = {'1', 'true', 'yes', 'y'}
+FALSE_VALUES = {'0', 'false', 'no', 'n', ''}
+
+
+class InvalidRow(ValueError):
+    pass
+
+
+def optional_text(value):
+    value = '' if value is None else str(value).strip()
+    return value or None
+
+
+def required_text(value):
+    value = optional_text(value)
+    if value is None:
+        raise ValueError('is required')
+    return value
+
+
+def price(value):
+    if optional_text(value) is None:
+        raise ValueError('is required')
+    amount = Money.parse(value)
+    if amount < 0:
+        raise ValueError(f'{value!r} is not a price')
+    return amount
+
+
+def optional_price(value):
+    return None if optional_text(value) is None else price(value)
+
+
+def quantity(value):
+    if optional_text(value) is None:
+        raise ValueError('is required')
+    # int() would cut a JSON number like 3.7 down to 3
+    if isinstance(value, bool) or isinstance(value, float) and not value.is_integer():
+        raise ValueError(f'{value!r} is not a whole number')
+    number = int(value)
+    if number < 0:
+        raise ValueError(f'{value!r} is not a quantity')
+    return number
+
+
+def boolean(value):
+    if isinstance(value, bool):
+        return value
+    value = (optional_text(value) or '').lower()
+    if value not in TRUE_VALUES | FALSE_VALUES:
+        raise ValueError(f'{value!r} is not a yes or no')
+    return value in TRUE_VALUES
+
+
+# Column -> function returning the value of the product field from that of the row
+COLUMNS = {
+    'sku': required_text,
+    'name': required_text,
+    'brand': optional_text,
+    'price': price,
+    'discount_price': optional_price,
+    'quantity': quantity,
+    'digital': boolean,
+    'description': optional_text,
+    'image': optional_text,
+}
+
+# Columns a new product can't do without
+REQUIRED_COLUMNS = ('name', 'price')
+
+
+def csv_rows(lines):
+    # Yields the line number and the row of each record
+    reader = csv.DictReader(lines)
+    for row in reader:
+        yield reader.line_num, row
+
+
+def jsonl_rows(lines):
+    # Yields the line number and the object of each non-blank line, or the error making it invalid
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield number, InvalidRow(f'invalid JSON: {e}')
+            continue
+        yield number, row if isinstance(row, dict) else InvalidRow('not a JSON object')
+
+
+FORMATS = {
+    'csv': csv_rows,
+    'jsonl': jsonl_rows,
+}
+
+
+def clean_row(row):
+    # Returns the product field values of a row, ignoring the columns that aren't product fields
+    if isinstance(row, InvalidRow):
+        raise row
+    values = {}
+    for column, value in row.items():
+        if column not in COLUMNS:
+            continue
+        try:
+            value = COLUMNS[column](value)
+        except (TypeError, ValueError) as e:
+            raise InvalidRow(f'{column}: {e}')
+        max_length = Product._meta.get_field(column).max_length
+        if isinstance(value, str) and max_length and len(value) > max_length:
+            raise InvalidRow(f'{column}: longer than {max_length} characters')
+        values[column] = value
+    if 'sku' not in values:
+        raise InvalidRow('sku: is required')
+    return values
+
+
+def field_value(product, field):
+    # Returns the value of the product's field as clean_row() would
+    if field == 'image':
+        return product.image.name or None
+    return getattr(product, field)
+
+
+class SlugAllocator:
+    # Gives new products unique slugs the way AutoSlugField does (the slugified name, then name-2,
+    # name-3, ... cropped to the field's length), checking the slugs of a whole chunk in one query.
+    # The numbers used for names that came up more than once are remembered for the next chunks,
+    # so a name repeated through a file doesn't go over its earlier slugs again.
+
+    # Names whose next number is remembered, at most
+    max_remembered = 10000
+
+    def __init__(self):
+        self.field = Product._meta.get_field('slug')
+        self.next_index = {}
+
+    def base(self, name):
+        slug = self.field.slugify(name) or Product._meta.model_name
+        return slug[:self.field.max_length]
+
+    def candidate(self, base, index):
+        if index == 1:
+            return base
+        tail = f'{self.field.index_sep}{index}'
+        return base[:self.field.max_length - len(tail)] + tail
+
+    def taken(self, slugs):
+        taken = set()
+        for start in range(0, len(slugs), SLUG_QUERY_SIZE):
+            batch = slugs[start:start + SLUG_QUERY_SIZE]
+            taken.update(Product.objects.filter(slug__in=batch).values_list('slug', flat=True))
+        return taken
+
+    def allocate(self, names):
+        # Returns a unique slug for each of the names
+        bases = [self.base(name) for name in names]
+        needed = Counter(bases)
+        tries = dict(needed)
+        claimed = set()
+        free = defaultdict(list)
+        while needed:
+            candidates = {}
+            for base in needed:
+                start = self.next_index.get(base, 1)
+                candidates[base] = [(index, self.candidate(base, index))
+                                    for index in range(start, start + tries[base])]
+            taken = self.taken([slug for tried in candidates.values() for index, slug in tried])
+
+            for base, tried in candidates.items():
+                next_index = tried[-1][0] + 1
+                for index, slug in tried:
+                    if needed[base] and slug not in taken and slug not in claimed:
+                        free[base].append(slug)
+                        claimed.add(slug)
+                        needed[base] -= 1
+                        next_index = index + 1
+                if next_index > 2 or needed[base]:
+                    if len(self.next_index) >= self.max_remembered:
+                        self.next_index.clear()
+                    self.next_index[base] = next_index
+                # Trying twice as many numbers while they're taken, e.g. by an earlier import
+                tries[base] = max(needed[base], tries[base] * 2)
+            needed = +needed
+
+        for slugs in free.values():
+            slugs.reverse()
+        return [free[base].pop() for base in bases]
+
+
+class ImportReport:
+    # Row counts and throughput of an import, with the first errors
+
+    def __init__(self):
+        self.rows = self.created = self.updated = self.unchanged = self.invalid = self.images_queued = 0
+        self.errors = []
+        self.started = time.perf_counter()
+        self.seconds = 0.0
+
+    def error(self, line, message):
+        self.invalid += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append((line, str(message)))
+
+    def finish(self):
+        self.seconds = time.perf_counter() - self.started
+
+    @property
+    def rows_per_second(self):
+        seconds = self.seconds or time.perf_counter() - self.started
+        return self.rows / seconds if seconds else 0.0
+
+    def summary(self):
+        return (f'Imported {self.rows} rows in {self.seconds:.1f}s ({self.rows_per_second:.0f} rows/s): '
+                f'{self.created} created, {self.updated} updated, {self.unchanged} unchanged, '
+                f'{self.invalid} invalid, {self.images_queued} images queued')
+
+
+def count_image_references(added, replaced):
+    # Adds the references of the products to their new images and drops those to the images they
+    # replace, like saving them would with a reference counting storage (see shop.storage)
+    storage = Product._meta.get_field('image').storage
+    if not getattr(storage, 'reference_counted', False):
+        return
+    for name, count in added.items():
+        MediaBlob.objects.filter(name=name).update(references=F('references') + count)
+    if replaced:
+        transaction.on_commit(lambda: release_files(storage, replaced))
+
+
+def write_chunk(rows, report, slugs, rules, queue_images=True):
+    # Creates and updates the products of the rows (sku -> (line, values)) in one transaction.
+    # Returns the brands whose stats changed.
+    now = timezone.now()
+    brands = set()
+    created, changed = [], []
+    changed_fields = set()
+    repriced, reindexed = [], []
+    added_images, replaced_images = Counter(), []
+
+    with transaction.atomic():
+        existing = {product.sku: product for product in Product.objects.filter(sku__in=list(rows))}
+        for sku, (line, values) in rows.items():
+            product = existing.get(sku)
+            if product is None:
+                missing = [column for column in REQUIRED_COLUMNS if column not in values]
+                if missing:
+                    report.error(line, f'{", ".join(missing)}: required for a new product')
+                    continue
+                product = Product(**values)
+                apply_rules(product, rules)
+                created.append(product)
+                brands.add(product.brand)
+                if product.image:
+                    added_images[product.image.name] += 1
+                continue
+
+            fields = {field for field, value in values.items() if field_value(product, field) != value}
+            previous_brand = product.brand
+            replaced_image = field_value(product, 'image')
+            pricing = (product.discount_price, product.promotion_id)
+            for field in fields:
+                setattr(product, field, values[field])
+            if 'discount_price' in fields:
+                product.promotion_id = None
+            if PRICING_FIELDS.intersection(fields):
+                apply_rules(product, rules)
+                # Only changed if it ends up different, e.g. not when the rules give back a cleared discount
+                fields.discard('discount_price')
+                if (product.discount_price, product.promotion_id) != pricing:
+                    fields |= {'discount_price', 'promotion'}
+            if not fields:
+                report.unchanged += 1
+                continue
+            # bulk_update() doesn't set auto_now fields
+            product.updated = now
+            changed.append(product)
+            changed_fields |= fields
+            if STATS_FIELDS.intersection(fields):
+                brands |= {previous_brand, product.brand}
+            if CART_TOTAL_FIELDS.intersection(fields):
+                repriced.append(product.pk)
+            if SEARCH_FIELDS.intersection(fields):
+                reindexed.append(product)
+            if 'image' in fields:
+                if product.image:
+                    added_images[product.image.name] += 1
+                if replaced_image:
+                    replaced_images.append(replaced_image)
+
+        for product, slug in zip(created, slugs.allocate([product.name for product in created])):
+            product.slug = slug
+        # AutoSlugField keeps the slugs given, still checking each of them with a query
+        Product.objects.bulk_create(created, batch_size=CHUNK_SIZE)
+        ids = dict(Product.objects.filter(sku__in=[product.sku for product in created]).values_list('sku', 'pk'))
+        for product in created:
+            product.pk = ids[product.sku]
+        if changed:
+            Product.objects.bulk_update(changed, changed_fields | {'updated'})
+
+        index_products(created + reindexed)
+        invalidate_products_on_commit([product.pk for product in created + changed])
+        if repriced:
+            Order.objects.filter(complete=False, orderitem__product__in=repriced).rebuild_totals()
+        count_image_references(added_images, replaced_images)
+        if queue_images:
+            for product in created + changed:
+                if needs_derivatives(product):
+                    queue_derivatives(product)
+                    report.images_queued += 1
+
+    report.created += len(created)
+    report.updated += len(changed)
+    return brands
+
+
+def import_products(lines, import_format='csv', chunk_size=CHUNK_SIZE, queue_images=True, progress=None):
+    # Creates and updates the products of the lines of a file in the format, returning the report.
+    # progress(report), when given, is called after each chunk. A chunk that fails is rolled back
+    # and the error raised; the chunks before it stay imported.
+    report = ImportReport()
+    slugs = SlugAllocator()
+    rules = active_rules()
+    brands = set()
+    chunk = {}
+    try:
+        for line, row in FORMATS[import_format](lines):
+            report.rows += 1
+            try:
+                values = clean_row(row)
+            except InvalidRow as e:
+                report.error(line, e)
+                continue
+            # A later row of the same product overrides the columns it has
+            previous = chunk.get(values['sku'], (line, {}))[1]
+            chunk[values['sku']] = (line, {**previous, **values})
+            if len(chunk) >= chunk_size:
+                brands |= write_chunk(chunk, report, slugs, rules, queue_images)
+                chunk = {}
+                if progress:
+                    progress(report)
+        if chunk:
+            brands |= write_chunk(chunk, report, slugs, rules, queue_images)
+    finally:
+        refresh_brand_stats(brands)
+        report.finish()
+    return report
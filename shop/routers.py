@@ -0,0 +1,89 @@
+import threading
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connections
+from shop.catalog import catalog_recently_written
+
+# Routes the catalog reads of the storefront pages to the read replica, when DATABASE_REPLICA_URL
+# configures one. Only code running inside replica_reads() reads from it, which the catalog views
+# wrap themselves in; everything else, including every write and the reads of the cart, order and
+# payment views, goes to the primary.
+#
+# Replicas lag behind the primary, so reads stick to the primary for REPLICA_PIN_SECONDS after a
+# write, for the visitor who wrote (e.g. after update_item or PaymentView.post) so they never see
+# their cart or the stock they took as it was before, and for everyone after a product changes
+# so the shared catalog and page caches aren't filled again with its previous version.
+
+REPLICA = 'replica'
+
+# Models the catalog pages read
+REPLICA_MODELS = {'shop.product'}
+
+# Cookie pinning a visitor who wrote to the primary, expiring after REPLICA_PIN_SECONDS
+PIN_COOKIE = 'primary_pin'
+
+_local = threading.local()
+
+
+@contextmanager
+def replica_reads():
+    # Sends the catalog reads of the current thread to the replica
+    previous = getattr(_local, 'replica_reads', False)
+    _local.replica_reads = True
+    try:
+        yield
+    finally:
+        _local.replica_reads = previous
+
+
+class ReplicaReadMixin:
+    # Serves the view's catalog reads from the replica
+
+    def dispatch(self, request, *args, **kwargs):
+        with replica_reads():
+            return super().dispatch(request, *args, **kwargs)
+
+
+class PrimaryPinMiddleware:
+    # Pins visitors to the primary for a while after their requests wrote to the database
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _local.pinned = PIN_COOKIE in request.COOKIES
+        _local.wrote = False
+        try:
+            response = self.get_response(request)
+        finally:
+            wrote = _local.wrote
+            _local.pinned = _local.wrote = False
+        if wrote:
+            response.set_cookie(PIN_COOKIE, '1', max_age=settings.REPLICA_PIN_SECONDS, httponly=True,
+                                samesite='Lax')
+        return response
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        if not getattr(_local, 'replica_reads', False) or model._meta.label_lower not in REPLICA_MODELS:
+            return 'default'
+        if REPLICA not in connections.databases or connections['default'].in_atomic_block:
+            # Reads in a transaction on the primary see its writes
+            return 'default'
+        if getattr(_local, 'pinned', False) or getattr(_local, 'wrote', False) or catalog_recently_written():
+            return 'default'
+        return REPLICA
+
+    def db_for_write(self, model, **hints):
+        _local.wrote = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The replica receives the schema from the primary
+        return db != REPLICA
@@ -0,0 +1,232 @@
+import re
+from django.db import connections
+from django.db.models import Q, Count, FloatField
+from django.db.models.expressions import RawSQL
+from shop.models import Product
+
+# Full-text product search over the name, brand and description of products. The words of
+# products are kept in an inverted index next to the product table (see migration 0012): an FTS5
+# virtual table on SQLite and a tsvector column with a GIN index on PostgreSQL, both in the
+# shop_product_search table. The product save and delete signals keep it current; bulk changes
+# (QuerySet.update(), bulk_create()) don't send them, so rebuild it with manage.py
+# rebuild_search_index after those. Other databases fall back to unindexed icontains lookups.
+#
+# Results can be narrowed down by brand, price band, discounted products and digital products.
+# The count of results for every choice of these facets is computed by facet_counts() in a single
+# query grouped by brand, with conditional counts for the other facets.
+
+SEARCH_TABLE = 'shop_product_search'
+
+# Product fields whose changes are indexed
+SEARCH_FIELDS = {'name', 'brand', 'description'}
+
+# Key -> (label, lowest price included, highest price excluded) of the price facet. The price of a
+# discounted product is its discount price.
+PRICE_BANDS = {
+    'under-50': ('Under 50', None, 50),
+    '50-100': ('50 to 100', 50, 100),
+    '100-200': ('100 to 200', 100, 200),
+    '200-up': ('200 and up', 200, None),
+}
+
+
+def search_words(query):
+    # Returns the words of the query, without the characters the index query syntaxes use
+    return re.findall(r'\w+', query.lower())[:10]
+
+
+class SQLiteSearch:
+    # FTS5 table whose rowids are the product ids
+
+    def index(self, cursor, products):
+        self.remove(cursor, [product.pk for product in products])
+        cursor.executemany(
+            f'INSERT INTO {SEARCH_TABLE} (rowid, name, brand, description) VALUES (%s, %s, %s, %s)',
+            [(product.pk, product.name, product.brand or '', product.description or '') for product in products],
+        )
+
+    def remove(self, cursor, product_ids):
+        cursor.executemany(f'DELETE FROM {SEARCH_TABLE} WHERE rowid = %s', [(pk,) for pk in product_ids])
+
+    def clear(self, cursor):
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE}')
+
+    def match_query(self, words):
+        # Every word, or a word starting with it
+        return ' '.join(f'"{word}"*' for word in words)
+
+    def matches(self):
+        return f'SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s'
+
+    def rank(self):
+        # bm25() is lower for better matches, with name and brand weighing more than the description
+        return (f'SELECT bm25({SEARCH_TABLE}, 10.0, 10.0, 1.0) FROM {SEARCH_TABLE} '
+                f'WHERE {SEARCH_TABLE} MATCH %s AND rowid = shop_product.id')
+
+
+class PostgresSearch:
+    # tsvector of each product, weighing the name and brand (A) more than the description (B)
+
+    document = ("setweight(to_tsvector('english', %s), 'A') || setweight(to_tsvector('english', %s), 'A') || "
+                "setweight(to_tsvector('english', %s), 'B')")
+
+    def index(self, cursor, products):
+        cursor.executemany(
+            f'INSERT INTO {SEARCH_TABLE} (product_id, document) VALUES (%s, {self.document}) '
+            f'ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document',
+            [(product.pk, product.name, product.brand or '', product.description or '') for product in products],
+        )
+
+    def remove(self, cursor, product_ids):
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE} WHERE product_id = ANY(%s)', [list(product_ids)])
+
+    def clear(self, cursor):
+        cursor.execute(f'TRUNCATE {SEARCH_TABLE}')
+
+    def match_query(self, words):
+        return ' & '.join(f'{word}:*' for word in words)
+
+    def matches(self):
+        return f"SELECT product_id FROM {SEARCH_TABLE} WHERE document @@ to_tsquery('english', %s)"
+
+    def rank(self):
+        # Negated, so better matches sort first like with bm25()
+        return (f"SELECT -ts_rank(document, to_tsquery('english', %s)) FROM {SEARCH_TABLE} "
+                f"WHERE product_id = shop_product.id")
+
+
+BACKENDS = {
+    'sqlite': SQLiteSearch(),
+    'postgresql': PostgresSearch(),
+}
+
+
+def search_backend(using='default'):
+    return BACKENDS.get(connections[using].vendor)
+
+
+def index_products(products, using='default'):
+    # Adds or updates the products in the search index
+    backend = search_backend(using)
+    if backend and products:
+        with connections[using].cursor() as cursor:
+            backend.index(cursor, products)
+
+
+def remove_products(product_ids, using='default'):
+    backend = search_backend(using)
+    if backend and product_ids:
+        with connections[using].cursor() as cursor:
+            backend.remove(cursor, product_ids)
+
+
+def search_products(query, queryset=None):
+    # Returns the products matching every word of the query, best matches first
+    queryset = Product.objects.all() if queryset is None else queryset
+    words = search_words(query)
+    if not words:
+        return queryset.none()
+    backend = search_backend(queryset.db)
+    if backend is None:
+        for word in words:
+            queryset = queryset.filter(Q(name__icontains=word) | Q(brand__icontains=word) |
+                                       Q(description__icontains=word))
+        return queryset.order_by('name', 'id')
+
+    match = backend.match_query(words)
+    rank = RawSQL(backend.rank(), [match], output_field=FloatField())
+    return queryset.filter(id__in=RawSQL(backend.matches(), [match])).order_by(rank.asc(), 'id')
+
+
+class SearchFilters:
+    # The facet choices of a search, read from the query string
+
+    def __init__(self, brands=(), price='', discounted=False, digital=False):
+        self.brands = [brand for brand in brands if brand]
+        self.price = price if price in PRICE_BANDS else ''
+        self.discounted = discounted
+        self.digital = digital
+
+    @classmethod
+    def from_query(cls, params):
+        return cls(params.getlist('brand'), params.get('price', ''), bool(params.get('discounted')),
+                   bool(params.get('digital')))
+
+    def conditions(self):
+        # Returns the condition of each chosen facet
+        conditions = {}
+        if self.brands:
+            conditions['brand'] = Q(brand__in=self.brands)
+        if self.price:
+            conditions['price'] = price_band(self.price)
+        if self.discounted:
+            conditions['discounted'] = DISCOUNTED
+        if self.digital:
+            conditions['digital'] = DIGITAL
+        return conditions
+
+    def apply(self, queryset):
+        for condition in self.conditions().values():
+            queryset = queryset.filter(condition)
+        return queryset
+
+
+DISCOUNTED = Q(discount_price__isnull=False)
+DIGITAL = Q(digital=True)
+
+
+def price_band(key):
+    # Returns the condition of the products whose (discount) price is in the band
+    label, low, high = PRICE_BANDS[key]
+    discounted, regular = Q(discount_price__isnull=False), Q(discount_price__isnull=True)
+    if low is not None:
+        discounted &= Q(discount_price__gte=low)
+        regular &= Q(price__gte=low)
+    if high is not None:
+        discounted &= Q(discount_price__lt=high)
+        regular &= Q(price__lt=high)
+    return discounted | regular
+
+
+def facet_counts(matches, filters):
+    # Returns the result count of each facet choice among the matches, counting the results of the
+    # other chosen facets, so a count is what choosing it (too) would return. One query, grouped by
+    # brand, with a conditional count per price band, discounted, digital and the results.
+    conditions = filters.conditions()
+
+    def count(*facets, condition=None):
+        # Counts the products meeting the condition and the chosen facets except the given ones
+        combined = Q()
+        for facet, chosen in conditions.items():
+            if facet not in facets:
+                combined &= chosen
+        if condition is not None:
+            combined &= condition
+        return Count('id', filter=combined) if combined else Count('id')
+
+    aggregates = {
+        'total_count': count(),
+        'brand_count': count('brand'),
+        'discounted_count': count('discounted', condition=DISCOUNTED),
+        'digital_count': count('digital', condition=DIGITAL),
+        **{f'price_{key}_count': count('price', condition=price_band(key)) for key in PRICE_BANDS},
+    }
+    rows = matches.order_by().values('brand').annotate(**aggregates)
+
+    facets = {
+        'total': 0,
+        'brands': [],
+        'prices': {key: 0 for key in PRICE_BANDS},
+        'discounted': 0,
+        'digital': 0,
+    }
+    for row in rows:
+        facets['total'] += row['total_count']
+        if row['brand'] and row['brand_count']:
+            facets['brands'].append((row['brand'], row['brand_count']))
+        facets['discounted'] += row['discounted_count']
+        facets['digital'] += row['digital_count']
+        for key in PRICE_BANDS:
+            facets['prices'][key] += row[f'price_{key}_count']
+    facets['brands'].sort(key=lambda brand: (-brand[1], brand[0]))
+    return facets
@@ -0,0 +1,139 @@
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
+from django.dispatch import receiver
+from shop.models import Product, Order, PricingRule
+from shop.brand_stats import STATS_FIELDS, refresh_brand_stats_on_commit
+from shop.catalog import invalidate_products_on_commit
+from shop.images import needs_derivatives, queue_derivatives, derivative_names
+from shop.pricing import (active_rules, reprice_products, rule_changed, rule_products, reprices_in_request,
+                          withdraw_rule)
+from shop.search import SEARCH_FIELDS, index_products, remove_products
+
+# Product fields that the running totals of a cart depend on
+CART_TOTAL_FIELDS = {'price', 'discount_price', 'digital'}
+
+
+@receiver(post_save, sender=Product)
+def update_cart_totals(sender, instance, update_fields, **kwargs):
+    # Recomputes the running totals of open carts holding the product when its price changes
+    if update_fields is not None and not CART_TOTAL_FIELDS.intersection(update_fields):
+        return
+    Order.objects.filter(complete=False, orderitem__product=instance).rebuild_totals()
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_catalog_cache(sender, instance, **kwargs):
+    # Drops the cached copy of the product when it is edited or deleted
+    invalidate_products_on_commit([instance.pk])
+
+
+@receiver(post_save, sender=Product)
+def update_search_index(sender, instance, update_fields, using, **kwargs):
+    # Indexes the product's words in the same transaction as the change
+    if update_fields is not None and not SEARCH_FIELDS.intersection(update_fields):
+        return
+    index_products([instance], using=using)
+
+
+@receiver(post_delete, sender=Product)
+def remove_from_search_index(sender, instance, using, **kwargs):
+    remove_products([instance.pk], using=using)
+
+
+@receiver(pre_save, sender=Product)
+def remember_previous_brand(sender, instance, update_fields, **kwargs):
+    # Notes the brand the product had, whose stats change too when it moves to another brand
+    instance._previous_brand = None
+    if instance.pk and (update_fields is None or 'brand' in update_fields):
+        instance._previous_brand = Product.objects.filter(pk=instance.pk).values_list('brand', flat=True).first()
+
+
+@receiver(post_save, sender=Product)
+def update_brand_stats(sender, instance, update_fields, **kwargs):
+    if update_fields is not None and not STATS_FIELDS.intersection(update_fields):
+        return
+    refresh_brand_stats_on_commit({instance.brand, getattr(instance, '_previous_brand', None)})
+
+
+@receiver(post_delete, sender=Product)
+def remove_from_brand_stats(sender, instance, **kwargs):
+    refresh_brand_stats_on_commit({instance.brand})
+
+
+@receiver(post_save, sender=Product)
+def build_image_derivatives(sender, instance, **kwargs):
+    # Resizes a newly uploaded image in the background
+    if needs_derivatives(instance):
+        queue_derivatives(instance)
+
+
+@receiver(pre_save, sender=Product)
+def remember_replaced_image(sender, instance, **kwargs):
+    # Notes the image a save replaces, when its storage counts references to files. A new upload
+    # adds a reference even when it has the same content, so the previous one is always dropped.
+    instance._replaced_image = None
+    if instance.pk and getattr(instance.image.storage, 'reference_counted', False):
+        previous = Product.objects.filter(pk=instance.pk).values_list('image', flat=True).first()
+        uploading = instance.image and not instance.image._committed
+        if previous and (uploading or previous != instance.image.name):
+            instance._replaced_image = previous
+
+
+def release_files(storage, names):
+    for name in names:
+        storage.delete(name)
+
+
+@receiver(post_save, sender=Product)
+def release_replaced_image(sender, instance, **kwargs):
+    # Drops the reference to the replaced image (its derivatives are released by shop.images)
+    replaced = getattr(instance, '_replaced_image', None)
+    if replaced:
+        storage = instance.image.storage
+        transaction.on_commit(lambda: release_files(storage, [replaced]))
+
+
+@receiver(post_delete, sender=Product)
+def release_deleted_images(sender, instance, **kwargs):
+    # Drops the references of a deleted product to its image and its derivatives
+    storage = instance.image.storage
+    if getattr(storage, 'reference_counted', False):
+        names = [instance.image.name] if instance.image else []
+        names += derivative_names(instance.image_derivatives)
+        transaction.on_commit(lambda: release_files(storage, names))
+
+
+@receiver(pre_save, sender=PricingRule)
+def remember_previous_rule(sender, instance, **kwargs):
+    # Notes the rule as it was, whose products may need repricing too
+    instance._previous_rule = PricingRule.objects.filter(pk=instance.pk).first() if instance.pk else None
+
+
+@receiver(post_save, sender=PricingRule)
+def apply_pricing_rule(sender, instance, **kwargs):
+    # Reprices the products the rule's change concerns once it commits, when it changes how they
+    # are priced. Too many products to reprice within a request are left to apply_pricing_rules.
+    previous = getattr(instance, '_previous_rule', None)
+    instance._repricing_deferred = False
+    if not rule_changed(instance, previous):
+        return
+    products = rule_products(*[rule for rule in (instance, previous) if rule])
+    if not reprices_in_request(products):
+        instance._repricing_deferred = True
+        return
+    transaction.on_commit(lambda: reprice_products(products))
+
+
+@receiver(pre_delete, sender=PricingRule)
+def withdraw_pricing_rule(sender, instance, **kwargs):
+    # Reprices the rule's products without it, before the deletion unlinks them from it: unlinked,
+    # their discount prices would pass for ones set by hand. Too many products to reprice within
+    # a request only lose the rule's discount, and get the other rules' from apply_pricing_rules.
+    products = Product.objects.filter(promotion=instance)
+    instance._repricing_deferred = not reprices_in_request(products)
+    if instance._repricing_deferred:
+        withdraw_rule(instance)
+        return
+    rules = [rule for rule in active_rules() if rule.pk != instance.pk]
+    reprice_products(products, rules)
@@ -1,7 +1,14 @@
 var updateBtns = document.getElementsByClassName('update-cart')
 
+// Clicks are queued and sent to the server together once the user
+// stops clicking for a moment, instead of one request per click.
+var pendingOperations = []
+var flushTimer = null
+var flushDelay = 400
+
 for (i = 0; i < updateBtns.length; i++) {
-    updateBtns[i].addEventListener('click', function() {
+    updateBtns[i].addEventListener('click', function(event) {
+        event.preventDefault()
         var productId = this.dataset.product
         var action = this.dataset.action
         console.log('productId:', productId, 'Action:', action)
@@ -9,14 +16,29 @@ for (i = 0; i < updateBtns.length; i++) {
 
         if (user === 'AnonymousUser'){
         } else {
-            UpdateItems(productId, action)
+            QueueUpdate(productId, action)
         }
     })
 }
 
-function UpdateItems(productId, action) {
+function QueueUpdate(productId, action) {
+    // Coalesces repeated clicks on the same product and action into one operation
+    var last = pendingOperations[pendingOperations.length - 1]
+    if (last && last.productId === productId && last.action === action) {
+        last.qty += 1
+    } else {
+        pendingOperations.push({'productId': productId, 'action': action, 'qty': 1})
+    }
+
+    clearTimeout(flushTimer)
+    flushTimer = setTimeout(UpdateItems, flushDelay)
+}
+
+function UpdateItems() {
 
-    var url = '/update_item/'
+    var url = '/update_items/'
+    var operations = pendingOperations
+    pendingOperations = []
 
     fetch(url, {
         method: 'POST',
@@ -24,7 +46,7 @@ function UpdateItems(productId, action) {
             'Content-Type': 'application/json',
             'X-CSRFToken': csrftoken,
         },
-        body: JSON.stringify({'productId': productId, 'action': action})
+        body: JSON.stringify({'operations': operations})
     })
 
     .then((response) =>{
@@ -35,5 +57,3 @@ function UpdateItems(productId, action) {
         location.reload()
     })
 }
-
-
@@ -0,0 +1,232 @@
+import datetime
+from collections import Counter, defaultdict
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Q, Sum, Subquery, OuterRef, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from shop.models import Product, StockHold
+from shop.brand_stats import refresh_product_brands_on_commit
+from shop.catalog import invalidate_products_on_commit
+
+# Adding a product to cart holds its units for settings.STOCK_HOLD_TTL seconds. The units held
+# are counted in Product.reserved, so the stock available to other customers
+# (quantity - reserved) is read from the product row without looking at the holds.
+# Expired holds are released in bulk by release_expired_holds().
+
+# Number of expired holds released per transaction
+RELEASE_BATCH_SIZE = 1000
+
+
+class OutOfStock(Exception):
+    # Raised when there isn't enough stock left to fulfil an order line.
+
+    def __init__(self, product):
+        self.product = product
+        super().__init__(f'{product} is out of stock')
+
+
+def hold_expiry():
+    # Returns the time a hold made now expires
+    return timezone.now() + datetime.timedelta(seconds=settings.STOCK_HOLD_TTL)
+
+
+def add_to_products(products=None, **amounts):
+    # Adds to integer fields of the products (default: all of them) in one UPDATE, given the
+    # amount per product id to add to each field, e.g. add_to_products(quantity={1: -2},
+    # reserved={1: -2, 5: 1}). Returns the number of products updated.
+    product_ids = set()
+    changes = {}
+    for field, field_amounts in amounts.items():
+        field_amounts = {product_id: amount for product_id, amount in field_amounts.items() if amount}
+        if field_amounts:
+            product_ids.update(field_amounts)
+            changes[field] = F(field) + Case(
+                *[When(pk=product_id, then=Value(amount)) for product_id, amount in field_amounts.items()],
+                default=Value(0),
+                output_field=IntegerField(),
+            )
+    if not changes:
+        return 0
+    products = Product.objects.all() if products is None else products
+    return products.filter(pk__in=product_ids).update(**changes)
+
+
+class CartHolds:
+    # The units held for a cart, for changing the holds of any number of products at once. The
+    # products and the cart's holds are locked and read with a query each, holds and releases are
+    # worked out in memory in the order they are made, and save() writes them with a few bulk
+    # queries. Rows are locked in id order so concurrent carts lock them in the same order.
+    # Call it in a transaction.
+
+    def __init__(self, order, product_ids):
+        self.order = order
+        product_ids = sorted(set(product_ids))
+        # Expired holds are still counted against the products, so they go first
+        release_expired_holds(product_ids=product_ids)
+        products = Product.objects.select_for_update().filter(pk__in=product_ids).order_by('pk')
+        self.available = {pk: max(quantity - reserved, 0)
+                          for pk, quantity, reserved in products.values_list('pk', 'quantity', 'reserved')}
+        self.holds = {hold.product_id: hold for hold in
+                      StockHold.objects.select_for_update().filter(order=order, product_id__in=product_ids)}
+        self.held = {product_id: hold.quantity for product_id, hold in self.holds.items()}
+
+    def hold(self, product_id, quantity=1):
+        # Holds quantity more units of the product, returning False, holding nothing, when not
+        # enough unheld stock is left
+        if quantity > self.available.get(product_id, 0):
+            return False
+        self.available[product_id] -= quantity
+        self.held[product_id] = self.held.get(product_id, 0) + quantity
+        return True
+
+    def release(self, product_id, quantity=None):
+        # Releases quantity units (or all units when None) held for the cart
+        held = self.held.get(product_id, 0)
+        quantity = held if quantity is None else min(quantity, held)
+        self.held[product_id] = held - quantity
+        if product_id in self.available:
+            self.available[product_id] += quantity
+
+    def save(self):
+        # Writes the holds that changed and moves their units in and out of the products' reserved
+        # units, restarting the expiry of the holds written
+        expires_at = hold_expiry()
+        reserved, created, changed, emptied = {}, [], [], []
+        for product_id, quantity in self.held.items():
+            hold = self.holds.get(product_id)
+            previous = hold.quantity if hold else 0
+            if quantity == previous:
+                continue
+            reserved[product_id] = quantity - previous
+            if hold is None:
+                created.append(StockHold(order=self.order, product_id=product_id, quantity=quantity,
+                                         expires_at=expires_at))
+            elif quantity:
+                hold.quantity = quantity
+                hold.expires_at = expires_at
+                changed.append(hold)
+            else:
+                emptied.append(hold.pk)
+        StockHold.objects.bulk_create(created)
+        StockHold.objects.bulk_update(changed, ['quantity', 'expires_at'])
+        if emptied:
+            StockHold.objects.filter(pk__in=emptied).delete()
+        add_to_products(reserved=reserved)
+
+
+def hold_stock(order, product, quantity=1):
+    # Holds quantity more units of the product for the order's cart. Returns False,
+    # holding nothing, when not enough unheld stock is left.
+    with transaction.atomic():
+        holds = CartHolds(order, [product.pk])
+        held = holds.hold(product.pk, quantity)
+        holds.save()
+    return held
+
+
+def release_stock(order, product, quantity=None):
+    # Releases quantity units (or all units when None) held for the order's cart.
+    with transaction.atomic():
+        holds = CartHolds(order, [product.pk])
+        holds.release(product.pk, quantity)
+        holds.save()
+
+
+def extend_holds(order):
+    # Keeps the holds of a cart that is still being worked on from expiring
+    StockHold.objects.filter(order=order).update(expires_at=hold_expiry())
+
+
+def release_expired_holds(product_ids=None, now=None):
+    # Releases the holds that have expired, in batches, giving their units back to the
+    # products with one UPDATE per batch. Returns the number of holds released.
+    now = now or timezone.now()
+    released = 0
+    while True:
+        # Each batch is a transaction of its own, or part of the caller's
+        with transaction.atomic(savepoint=False):
+            expired = StockHold.objects.select_for_update().filter(expires_at__lte=now)
+            if product_ids is not None:
+                expired = expired.filter(product_id__in=product_ids)
+            holds = list(expired.order_by('expires_at').values_list('pk', 'product_id', 'quantity')[:RELEASE_BATCH_SIZE])
+            if not holds:
+                return released
+
+            quantities = defaultdict(int)
+            for pk, product_id, quantity in holds:
+                quantities[product_id] += quantity
+            StockHold.objects.filter(pk__in=[pk for pk, product_id, quantity in holds]).delete()
+            add_to_products(reserved={product_id: -quantity for product_id, quantity in quantities.items()})
+        released += len(holds)
+
+
+def recount_reserved():
+    # Recomputes the units reserved of every product from its holds, repairing counts
+    # left behind by holds deleted outside of this module (e.g. along with their order).
+    holds = StockHold.objects.filter(product=OuterRef('pk')).order_by().values('product')
+    held = holds.annotate(quantity=Sum('quantity')).values('quantity')
+    return Product.objects.update(reserved=Coalesce(Subquery(held), 0))
+
+
+def line_quantities(order_items):
+    # Returns the quantity ordered per product id.
+    quantities = Counter()
+    for item in order_items:
+        if item.product_id and item.quantity and item.quantity > 0:
+            quantities[item.product_id] += item.quantity
+    return quantities
+
+
+def decrement_stock(order_items):
+    # Takes the quantities of the order lines out of stock in one transaction, consuming the
+    # units held for the cart. The products are locked in id order, so concurrent checkouts lock
+    # rows in the same order, and updated with a single UPDATE that only matches a product while
+    # enough stock is left besides what other carts hold, so two buyers can never take the same
+    # pair. Raises OutOfStock and leaves stock untouched if any line can't be fulfilled.
+    order_ids = {item.order_id for item in order_items if item.order_id}
+    quantities = line_quantities(order_items)
+    with transaction.atomic():
+        holds = StockHold.objects.select_for_update().filter(order_id__in=order_ids)
+        held = Counter()
+        for product_id, quantity in holds.values_list('product_id', 'quantity'):
+            held[product_id] += quantity
+        holds.delete()
+
+        product_ids = sorted(set(quantities) | set(held))
+        locked = Product.objects.select_for_update().filter(pk__in=product_ids).order_by('pk')
+        available = {pk: quantity - (reserved - held[pk])
+                     for pk, quantity, reserved in locked.values_list('pk', 'quantity', 'reserved')}
+        in_stock = Q()
+        for product_id in product_ids:
+            if quantities[product_id]:
+                in_stock |= Q(pk=product_id, quantity__gte=F('reserved') - held[product_id] + quantities[product_id])
+            else:
+                in_stock |= Q(pk=product_id)
+        updated = add_to_products(
+            Product.objects.filter(in_stock),
+            quantity={product_id: -quantity for product_id, quantity in quantities.items()},
+            reserved={product_id: -quantity for product_id, quantity in held.items()},
+        )
+        if updated < len(product_ids):
+            # The product short of stock, as read when locking the rows
+            short = next((pk for pk in sorted(quantities) if available.get(pk, 0) < quantities[pk]),
+                         min(quantities))
+            raise OutOfStock(Product.objects.get(pk=short))
+
+        invalidate_products_on_commit(quantities)
+        # Products selling out change the in stock counts of their brands
+        refresh_product_brands_on_commit(quantities, Q(quantity__lte=0))
+
+
+def restore_stock(order_items):
+    # Puts the quantities of the order lines back in stock, e.g. when the charge fails.
+    with transaction.atomic():
+        quantities = line_quantities(order_items)
+        add_to_products(quantity=quantities)
+        invalidate_products_on_commit(quantities)
+        # As do products back in stock
+        back_in_stock = Q()
+        for product_id, quantity in quantities.items():
+            back_in_stock |= Q(pk=product_id, quantity__lte=quantity)
+        refresh_product_brands_on_commit(quantities, back_in_stock)
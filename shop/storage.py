@@ -0,0 +1,108 @@
+import hashlib
+import os
+import cloudinary.uploader
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction, IntegrityError
+from django.db.models import F
+from django.utils.deconstruct import deconstructible
+from cloudinary_storage.storage import MediaCloudinaryStorage
+from shop.models import MediaBlob
+
+# Content addressed media storage. An upload is stored under the SHA-256 of its content, so
+# uploading the same image again (for another product, or for the same one after editing it)
+# reuses the stored file instead of adding a copy. Each stored file has a MediaBlob counting
+# the references to it, which delete() decrements; the file itself is only deleted with its
+# last reference. Files stored before the storage was enabled have no blob and are deleted
+# as usual until manage.py dedupe_media adopts them.
+
+# Folder the uploads are stored in
+BLOB_DIRECTORY = 'blobs'
+
+
+def content_digest(content):
+    # Returns the SHA-256 hex digest of a file's content, reading it in chunks
+    digest = hashlib.sha256()
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    for chunk in content.chunks():
+        digest.update(chunk)
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    return digest.hexdigest()
+
+
+def blob_name(digest, name):
+    # Returns the name a file with the digest is stored under, keeping the original extension
+    extension = os.path.splitext(name)[1].lower()
+    return f'{BLOB_DIRECTORY}/{digest[:2]}/{digest}{extension}'
+
+
+class ContentAddressedStorageMixin:
+    # Adds content addressing and reference counting to a storage class
+    reference_counted = True
+
+    def save(self, name, content, max_length=None):
+        # Returns the name of the stored file with the same content, storing it if there is none
+        digest = content_digest(content)
+        existing = self.add_reference(digest)
+        if existing is not None:
+            return existing
+
+        name = blob_name(digest, name)
+        # A file left behind without a blob (e.g. by a rolled back upload) has the same content
+        if not self.exists(name):
+            name = super().save(name, content, max_length=max_length)
+        try:
+            with transaction.atomic():
+                MediaBlob.objects.create(digest=digest, name=name, size=content.size)
+        except IntegrityError:
+            # The same content was stored concurrently
+            existing = self.add_reference(digest)
+            if existing != name:
+                super().delete(name)
+            name = existing
+        return name
+
+    def add_reference(self, digest):
+        # Adds a reference to the blob with the digest, returning its name or None when there is none
+        with transaction.atomic():
+            blob = MediaBlob.objects.select_for_update().filter(digest=digest).first()
+            if blob is None:
+                return None
+            MediaBlob.objects.filter(pk=blob.pk).update(references=F('references') + 1)
+            return blob.name
+
+    def delete(self, name):
+        # Removes a reference to the file, deleting it once the last reference is gone
+        with transaction.atomic():
+            blob = MediaBlob.objects.select_for_update().filter(name=name).first()
+            if blob is not None and blob.references > 1:
+                MediaBlob.objects.filter(pk=blob.pk).update(references=F('references') - 1)
+                return
+            if blob is not None:
+                blob.delete()
+            # A file is only deleted once the blob's deletion is committed
+            transaction.on_commit(lambda: self.delete_file(name))
+
+    def delete_file(self, name):
+        # Deletes the stored file regardless of its references
+        super().delete(name)
+
+
+@deconstructible
+class ContentAddressedFileSystemStorage(ContentAddressedStorageMixin, FileSystemStorage):
+    pass
+
+
+@deconstructible
+class ContentAddressedCloudinaryStorage(ContentAddressedStorageMixin, MediaCloudinaryStorage):
+
+    def _upload(self, name, content):
+        # Uploading under the content's name rather than a randomised copy of the file name
+        options = {
+            'public_id': os.path.splitext(name)[0],
+            'overwrite': False,
+            'resource_type': self._get_resource_type(name),
+            'tags': self.TAG,
+        }
+        return cloudinary.uploader.upload(content, **options)
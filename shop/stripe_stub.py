@@ -0,0 +1,124 @@
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+# A minimal stand-in for the Stripe charges API, used by the tests and for running the shop
+# locally without Stripe. Point the Stripe client at it with STRIPE_API_BASE=<stub url>.
+# Charges with the token below are declined, every other token is charged successfully.
+# Like Stripe, requests retried with the same Idempotency-Key get the original response.
+# Setting rate_limited answers that many of the next requests with a rate limit error.
+DECLINED_TOKEN = 'tok_chargeDeclined'
+
+
+class StripeStubHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        stub = self.server.stub
+        length = int(self.headers.get('Content-Length', 0))
+        params = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode()).items()}
+
+        if stub.latency:
+            # Simulating a slow payment provider
+            time.sleep(stub.latency)
+
+        with stub.lock:
+            rate_limited = stub.rate_limited > 0
+            stub.rate_limited -= rate_limited
+        if rate_limited:
+            # Not stored under the idempotency key, as Stripe doesn't process rate limited requests
+            self.respond(429, {'error': {'type': 'invalid_request_error', 'code': 'rate_limit',
+                                         'message': 'Too many requests hit the API too quickly.'}}, store=False)
+            return
+
+        # Replaying the stored response of a request retried with the same idempotency key
+        key = self.headers.get('Idempotency-Key')
+        with stub.lock:
+            stored = stub.responses.get(key)
+        if stored:
+            self.respond(*stored)
+            return
+
+        if self.path != '/v1/charges':
+            self.respond(404, {'error': {'type': 'invalid_request_error', 'message': 'Unrecognized request URL'}})
+        elif params.get('source') == DECLINED_TOKEN:
+            self.respond(402, {'error': {
+                'type': 'card_error',
+                'code': 'card_declined',
+                'decline_code': 'generic_decline',
+                'message': 'Your card was declined.',
+            }})
+        else:
+            charge = {
+                'id': f'ch_stub_{next(stub.ids)}',
+                'object': 'charge',
+                'amount': int(params.get('amount', 0)),
+                'currency': params.get('currency'),
+                'paid': True,
+                'status': 'succeeded',
+            }
+            with stub.lock:
+                stub.charges.append(charge)
+            self.respond(200, charge)
+
+    def respond(self, status, body, store=True):
+        key = self.headers.get('Idempotency-Key')
+        if key and store:
+            with self.server.stub.lock:
+                self.server.stub.responses.setdefault(key, (status, body))
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StripeStubServer:
+    # Runs the stub in a background thread. latency is the number of seconds
+    # every request takes, to simulate a slow payment provider.
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0):
+        self.latency = latency
+        self.charges = []
+        self.responses = {}
+        self.rate_limited = 0
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), StripeStubHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.stub = self
+        self.thread = None
+
+    def reset(self):
+        # Forgets the charges made so far
+        with self.lock:
+            self.charges.clear()
+            self.responses.clear()
+            self.rate_limited = 0
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -1,15 +1,10 @@
 from django import template
-from shop.models import Order
+from shop.cart import get_cart_quantity
 
 register = template.Library()
 
 
 @register.filter
-def cart_quantity(user):
+def cart_quantity(request):
     # Returns the total quantity of products in cart.
-    if user.is_authenticated:
-        order_qs = Order.objects.filter(customer=user.customer, complete=False)
-        if order_qs.exists():
-            order = order_qs[0]
-            return sum([item.quantity for item in order.orderitem_set.all()])
-    return 0
+    return get_cart_quantity(request)
@@ -0,0 +1,34 @@
+from django import template
+from shop.images import DERIVATIVE_SIZES
+
+register = template.Library()
+
+
+def derivatives_of(product, extension):
+    # Returns (url, width) of each derivative of the product's image in the format, smallest first
+    derivatives = product.image_derivatives or {}
+    if not product.image or derivatives.get('source') != product.image.name:
+        # Not made yet, or made from a previous image
+        return []
+    sizes = sorted(
+        (derivatives[size] for size in DERIVATIVE_SIZES if extension in derivatives.get(size, {})),
+        key=lambda derivative: derivative['width'],
+    )
+    return [(product.image.storage.url(derivative[extension]), derivative['width']) for derivative in sizes]
+
+
+@register.filter
+def srcset(product, extension='jpeg'):
+    # Returns the srcset attribute value listing the product image's derivatives in the format
+    # ('webp' or 'jpeg'), or an empty string when they haven't been made yet.
+    return ', '.join(f'{url} {width}w' for url, width in derivatives_of(product, extension))
+
+
+@register.filter
+def image_url(product, size):
+    # Returns the URL of the JPEG derivative of the size, or of the original image when
+    # there is none yet.
+    derivatives = product.image_derivatives or {}
+    if derivatives.get('source') == product.image.name and 'jpeg' in derivatives.get(size, {}):
+        return product.image.storage.url(derivatives[size]['jpeg'])
+    return product.image.url if product.image else ''
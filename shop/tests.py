@@ -1,3 +1,1559 @@
-from django.test import TestCase
+import csv
+import datetime
+import gc
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import tracemalloc
+from http.cookies import SimpleCookie
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
+from django.db import close_old_connections, connection, connections, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.template import engines
+from django.template.response import TemplateResponse
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import path, reverse
+from django.utils import timezone
+from django.views import View
+from unittest import mock
+from PIL import Image
+import stripe
+from shop.models import (Product, Order, OrderItem, Payment, PaymentAttempt, MediaBlob, Address, Coupon, BrandStats,
+                         PricingRule, StockHold)
+from shop.benchmark import run_benchmark
+from shop.catalog import cache_stats, catalog_version, get_listing, get_product, invalidate_products
+from shop.images import build_derivatives
+from shop.money import Money
+from shop.page_cache import AnonymousPageCacheMixin
+from shop.payments import process_next_attempt, claim_next_attempt, requeue_stalled_attempts, run_worker
+from shop.pricing import reprice_products
+from shop.product_import import SlugAllocator, import_products
+from shop.routers import REPLICA, PIN_COOKIE
+from shop.search import SearchFilters, search_products, facet_counts
+from shop.stock import (OutOfStock, decrement_stock, restore_stock, hold_stock, release_stock, extend_holds,
+                        release_expired_holds, recount_reserved)
+from shop.stripe_stub import StripeStubServer, DECLINED_TOKEN
+from shop.storage import ContentAddressedFileSystemStorage
+from shop.templatetags.image_tags import srcset, image_url
+from shop.templatetags.cart_template_tags import cart_quantity
+from shop import timing
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class OrderTotalsTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('ama', password='password')
+        self.client.force_login(self.user)
+        self.shoe = Product.objects.create(name='Air Jordan 1', price=200, quantity=5)
+        self.guide = Product.objects.create(name='Sneaker care guide', price=10, quantity=100, digital=True)
+
+    def totals(self, order):
+        order.refresh_from_db()
+        return order.item_count, order.subtotal, order.requires_shipping
+
+    def update_item(self, product, action):
+        response = self.client.post(reverse('update-item'), json.dumps({'productId': product.id, 'action': action}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_cart_changes_keep_the_totals(self):
+        self.update_item(self.guide, 'add')
+        order = Order.objects.get(customer=self.user.customer)
+        self.assertEqual(self.totals(order), (1, 10, False))
+        self.update_item(self.shoe, 'add')
+        self.update_item(self.shoe, 'add')
+        self.assertEqual(self.totals(order), (3, 410, True))
+        self.update_item(self.shoe, 'remove')
+        self.assertEqual(self.totals(order), (2, 210, True))
+        # Deleting the line
+        self.update_item(self.shoe, 'remove')
+        self.assertEqual(self.totals(order), (1, 10, False))
+        self.assertFalse(Order.objects.stale_totals().exists())
+
+    def test_admin_changes_keep_the_totals(self):
+        self.client.force_login(User.objects.create_superuser('admin', password='secret'))
+        cart = Order.objects.create(customer=self.user.customer)
+        other = Order.objects.create()
+        self.client.post(reverse('admin:shop_orderitem_add'),
+                         {'product': self.shoe.pk, 'order': cart.pk, 'quantity': 2})
+        item = OrderItem.objects.get()
+        self.assertEqual(self.totals(cart), (2, 400, True))
+
+        # Moved to another order, changing the totals of both
+        self.client.post(reverse('admin:shop_orderitem_change', args=[item.pk]),
+                         {'product': self.shoe.pk, 'order': other.pk, 'quantity': 3})
+        self.assertEqual(self.totals(cart), (0, 0, False))
+        self.assertEqual(self.totals(other), (3, 600, True))
+
+        self.client.post(reverse('admin:shop_orderitem_delete', args=[item.pk]), {'post': 'yes'})
+        self.assertFalse(OrderItem.objects.exists())
+        self.assertEqual(self.totals(other), (0, 0, False))
+
+    def test_drifted_totals_are_rebuilt(self):
+        cart = Order.objects.create(customer=self.user.customer)
+        # Lines written without updating the totals
+        OrderItem.objects.create(order=cart, product=self.shoe, quantity=2)
+        OrderItem.objects.create(order=cart, product=self.guide, quantity=1)
+        Order.objects.create(complete=True)
+        self.assertEqual(list(Order.objects.stale_totals()), [cart])
+        with self.assertRaises(CommandError):
+            call_command('rebuild_order_totals', '--check', stdout=io.StringIO())
+
+        out = io.StringIO()
+        call_command('rebuild_order_totals', stdout=out)
+        self.assertIn('Rebuilt the totals of 1 orders', out.getvalue())
+        self.assertEqual(self.totals(cart), (3, 410, True))
+        self.assertFalse(Order.objects.stale_totals().exists())
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class StorePaginationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        # Alike products, which only their ids tell apart
+        Product.objects.bulk_create([Product(name='Stan Smith', slug=f'stan-smith-{i}', brand='Adidas', price=100)
+                                     for i in range(30)])
+        cls.ids = list(Product.objects.order_by('id').values_list('id', flat=True))
+        cls.user = User.objects.create_user('ama', password='password')
+
+    def setUp(self):
+        clear_page_caches()
+        # Signed in, for pages rendered rather than served from the page cache
+        self.client.force_login(self.user)
+
+    def page(self, after=None):
+        response = self.client.get(reverse('store'), {} if after is None else {'after': after})
+        self.assertEqual(response.status_code, 200)
+        return [product.id for product in response.context['object_list']], response.context['next_cursor'], response
+
+    def test_next_cursors_walk_the_whole_catalog(self):
+        pages = []
+        ids, after, response = self.page()
+        pages.append(ids)
+        while after is not None:
+            self.assertContains(response, f'?after={after}')
+            ids, after, response = self.page(after)
+            pages.append(ids)
+        self.assertEqual([len(ids) for ids in pages], [12, 12, 6])
+        self.assertEqual(sum(pages, []), self.ids)
+        self.assertNotContains(response, 'Next page')
+
+    def test_full_last_page_has_no_next_link(self):
+        ids, after, response = self.page(self.ids[17])
+        self.assertEqual(ids, self.ids[18:])
+        self.assertIsNone(after)
+        self.assertNotContains(response, 'Next page')
+
+        ids, after, response = self.page(self.ids[-1])
+        self.assertEqual((ids, after), ([], None))
+
+    def test_invalid_cursors_show_the_first_page(self):
+        for after in ('', 'abc', '-1', '1.5', '\u00b2', '9' * 30):
+            with self.subTest(after=after):
+                ids, next_cursor, response = self.page(after)
+                self.assertEqual(ids, self.ids[:12])
+                self.assertEqual(next_cursor, self.ids[11])
+
+
+class StockTests(TestCase):
+
+    def setUp(self):
+        self.shoe = Product.objects.create(name='Air Jordan 1', price=200, quantity=3)
+        self.sock = Product.objects.create(name='Socks', price=10, quantity=10)
+
+    def test_decrement_takes_all_lines_out_of_stock(self):
+        decrement_stock([
+            OrderItem(product=self.shoe, quantity=2),
+            OrderItem(product=self.sock, quantity=4),
+        ])
+        self.shoe.refresh_from_db()
+        self.sock.refresh_from_db()
+        self.assertEqual(self.shoe.quantity, 1)
+        self.assertEqual(self.sock.quantity, 6)
+
+    def test_decrement_leaves_stock_untouched_when_a_line_is_out_of_stock(self):
+        with self.assertRaises(OutOfStock) as raised:
+            decrement_stock([
+                OrderItem(product=self.shoe, quantity=4),
+                OrderItem(product=self.sock, quantity=4),
+            ])
+        self.assertEqual(raised.exception.product, self.shoe)
+        self.shoe.refresh_from_db()
+        self.sock.refresh_from_db()
+        self.assertEqual(self.shoe.quantity, 3)
+        self.assertEqual(self.sock.quantity, 10)
+
+    def test_restore_puts_stock_back(self):
+        items = [OrderItem(product=self.shoe, quantity=3)]
+        decrement_stock(items)
+        restore_stock(items)
+        self.shoe.refresh_from_db()
+        self.assertEqual(self.shoe.quantity, 3)
+
+
+class StockHoldTests(TestCase):
+
+    def setUp(self):
+        self.shoe = Product.objects.create(name='Air Jordan 1', price=200, quantity=3)
+        self.cart = Order.objects.create()
+        self.other_cart = Order.objects.create()
+
+    def reserved(self):
+        self.shoe.refresh_from_db()
+        return self.shoe.reserved
+
+    def test_held_units_are_not_available_to_other_carts(self):
+        self.assertTrue(hold_stock(self.cart, self.shoe, 2))
+        self.assertFalse(hold_stock(self.other_cart, self.shoe, 2))
+        self.assertTrue(hold_stock(self.other_cart, self.shoe, 1))
+        self.assertEqual(self.reserved(), 3)
+        self.assertEqual(self.shoe.available, 0)
+
+        release_stock(self.cart, self.shoe, 1)
+        self.assertEqual(self.reserved(), 2)
+        self.assertEqual(StockHold.objects.get(order=self.cart).quantity, 1)
+        release_stock(self.cart, self.shoe)
+        self.assertEqual(self.reserved(), 1)
+        self.assertFalse(StockHold.objects.filter(order=self.cart).exists())
+
+    def test_expired_holds_give_their_units_back(self):
+        hold_stock(self.cart, self.shoe, 3)
+        StockHold.objects.update(expires_at=timezone.now() - datetime.timedelta(seconds=1))
+
+        # Claiming the units releases the expired holds standing in the way
+        self.assertTrue(hold_stock(self.other_cart, self.shoe, 2))
+        self.assertFalse(StockHold.objects.filter(order=self.cart).exists())
+        self.assertEqual(self.reserved(), 2)
+
+        StockHold.objects.update(expires_at=timezone.now() - datetime.timedelta(seconds=1))
+        self.assertEqual(release_expired_holds(), 1)
+        self.assertEqual(self.reserved(), 0)
+
+    def test_extended_holds_do_not_expire(self):
+        hold_stock(self.cart, self.shoe, 1)
+        StockHold.objects.update(expires_at=timezone.now() - datetime.timedelta(seconds=1))
+        extend_holds(self.cart)
+        self.assertEqual(release_expired_holds(), 0)
+        self.assertEqual(self.reserved(), 1)
+
+    def test_recount_repairs_the_reserved_counts(self):
+        sock = Product.objects.create(name='Socks', price=10, quantity=10, reserved=4)
+        hold_stock(self.cart, self.shoe, 2)
+        Product.objects.filter(pk=self.shoe.pk).update(reserved=7)
+
+        recount_reserved()
+        sock.refresh_from_db()
+        self.assertEqual((self.reserved(), sock.reserved), (2, 0))
+
+    def test_checkout_uses_up_the_carts_own_hold(self):
+        hold_stock(self.cart, self.shoe, 2)
+        hold_stock(self.other_cart, self.shoe, 1)
+
+        decrement_stock([OrderItem(order=self.cart, product=self.shoe, quantity=2)])
+        self.shoe.refresh_from_db()
+        self.assertEqual((self.shoe.quantity, self.shoe.reserved), (1, 1))
+        self.assertFalse(StockHold.objects.filter(order=self.cart).exists())
+
+        # The last pair is held by the other cart
+        third_cart = Order.objects.create()
+        with self.assertRaises(OutOfStock):
+            decrement_stock([OrderItem(order=third_cart, product=self.shoe, quantity=1)])
+
+
+class CartUpdateTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('ama', password='password')
+        self.client.force_login(self.user)
+        self.shoe = Product.objects.create(name='Air Jordan 1', price=200, quantity=3)
+        self.sock = Product.objects.create(name='Socks', price=10, quantity=10)
+
+    def update_items(self, *operations):
+        response = self.client.post(reverse('update-items'), json.dumps({'operations': [
+            {'productId': product.id, 'action': action, 'qty': quantity} for product, action, quantity in operations
+        ]}), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return [str(message) for message in response.wsgi_request._messages]
+
+    def test_batch_holds_stock_for_every_product(self):
+        messages = self.update_items((self.shoe, 'add', 2), (self.sock, 'add', 4), (self.shoe, 'add', 2),
+                                     (self.sock, 'remove', 1))
+        self.assertEqual(messages, ['Item added to cart', 'Item added to cart', 'Out of stock', 'Item removed from cart'])
+        order = Order.objects.get(customer=self.user.customer)
+        self.assertEqual(dict(order.orderitem_set.values_list('product_id', 'quantity')),
+                         {self.shoe.id: 2, self.sock.id: 3})
+        self.assertEqual(dict(StockHold.objects.values_list('product_id', 'quantity')),
+                         {self.shoe.id: 2, self.sock.id: 3})
+        self.assertEqual(dict(Product.objects.values_list('id', 'reserved')), {self.shoe.id: 2, self.sock.id: 3})
+
+        self.update_items((self.shoe, 'clear', 1), (self.sock, 'remove', 3))
+        self.assertFalse(order.orderitem_set.exists())
+        self.assertFalse(StockHold.objects.exists())
+        self.assertEqual(dict(Product.objects.values_list('id', 'reserved')), {self.shoe.id: 0, self.sock.id: 0})
+
+    def test_removing_a_product_not_in_the_cart(self):
+        messages = self.update_items((self.shoe, 'remove', 1), (self.sock, 'clear', 1))
+        self.assertEqual(messages, ['This product is not in your cart'] * 2)
+        self.assertFalse(OrderItem.objects.exists())
+
+
+class MergeDuplicateCartsMigrationTests(TransactionTestCase):
+    # Runs migration 0009 on carts made with the models as they were before it
+    migrate_from = [('shop', '0008_media_blobs')]
+    migrate_to = [('shop', '0009_merge_duplicate_carts')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def setUp(self):
+        apps = self.migrate(self.migrate_from)
+        self.Order = apps.get_model('shop', 'Order')
+        self.OrderItem = apps.get_model('shop', 'OrderItem')
+        self.PaymentAttempt = apps.get_model('shop', 'PaymentAttempt')
+        user = apps.get_model('auth', 'User').objects.create(username='ama')
+        self.customer = apps.get_model('shop', 'Customer').objects.create(user=user)
+        Product = apps.get_model('shop', 'Product')
+        self.shoe = Product.objects.create(name='Air Jordan 1', price=200, quantity=3)
+        self.sock = Product.objects.create(name='Socks', price=10, quantity=10)
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+
+    def attempt(self, order, number, status, minutes_ago):
+        attempt = self.PaymentAttempt.objects.create(order=order, customer=self.customer, number=number,
+                                                     idempotency_key=f'order-{order.pk}-attempt-{number}',
+                                                     amount=200, token='tok_visa', status=status)
+        created = timezone.now() - datetime.timedelta(minutes=minutes_ago)
+        self.PaymentAttempt.objects.filter(pk=attempt.pk).update(created=created)
+        return attempt
+
+    def test_open_carts_are_merged_with_their_payment_attempts(self):
+        older = self.Order.objects.create(customer=self.customer)
+        latest = self.Order.objects.create(customer=self.customer)
+        self.OrderItem.objects.create(order=older, product=self.shoe, quantity=1)
+        self.OrderItem.objects.create(order=older, product=self.sock, quantity=2)
+        self.OrderItem.objects.create(order=latest, product=self.shoe, quantity=1)
+        self.attempt(older, 1, 'F', minutes_ago=30)
+        self.attempt(latest, 1, 'F', minutes_ago=20)
+        pending = self.attempt(older, 2, 'P', minutes_ago=10)
+
+        self.migrate(self.migrate_to)
+        self.assertEqual(list(self.Order.objects.values_list('pk', flat=True)), [latest.pk])
+        self.assertEqual(dict(self.OrderItem.objects.values_list('product_id', 'quantity')),
+                         {self.shoe.pk: 2, self.sock.pk: 2})
+        attempts = self.PaymentAttempt.objects.order_by('number')
+        self.assertEqual([(attempt.order_id, attempt.status) for attempt in attempts],
+                         [(latest.pk, 'F'), (latest.pk, 'F'), (latest.pk, 'P')])
+        # The attempt being charged is still the last one, with the key it is charged with
+        self.assertEqual(attempts.last().idempotency_key, pending.idempotency_key)
+
+    def test_repeated_lines_are_merged(self):
+        order = self.Order.objects.create(customer=self.customer)
+        self.OrderItem.objects.create(order=order, product=self.shoe, quantity=1)
+        self.OrderItem.objects.create(order=order, product=self.shoe, quantity=2)
+
+        self.migrate(self.migrate_to)
+        self.assertEqual(list(self.OrderItem.objects.values_list('product_id', 'quantity')), [(self.shoe.pk, 3)])
+
+
+class PaymentStockTests(TestCase):
+
+    def test_payment_fails_cleanly_when_stock_runs_out(self):
+        user = User.objects.create_user('buyer', password='password')
+        shoe = Product.objects.create(name='Air Jordan 1', price=200, quantity=1)
+        sock = Product.objects.create(name='Socks', price=10, quantity=10)
+        order = Order.objects.create(customer=user.customer)
+        OrderItem.objects.create(order=order, product=sock, quantity=2)
+        OrderItem.objects.create(order=order, product=shoe, quantity=2)
+        order.update_totals()
+
+        self.client.force_login(user)
+        response = self.client.post(reverse('payment', args=['stripe']), {'stripeToken': 'tok_visa'})
+
+        self.assertRedirects(response, reverse('cart'), fetch_redirect_response=False)
+        order.refresh_from_db()
+        sock.refresh_from_db()
+        self.assertFalse(order.complete)
+        self.assertEqual(sock.quantity, 10)
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class PaymentWorkerTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.stripe = StripeStubServer().start()
+        cls.api_base = mock.patch.object(stripe, 'api_base', cls.stripe.url)
+        cls.api_base.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.api_base.stop()
+        cls.stripe.stop()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.stripe.reset()
+        self.user = User.objects.create_user('buyer', password='password')
+        self.shoe = Product.objects.create(name='Air Jordan 1', price=200, quantity=5)
+        self.order = Order.objects.create(customer=self.user.customer)
+        OrderItem.objects.create(order=self.order, product=self.shoe, quantity=2)
+        self.order.update_totals()
+        self.client.force_login(self.user)
+
+    def pay(self, token):
+        response = self.client.post(reverse('payment', args=['stripe']), {'stripeToken': token})
+        attempt = PaymentAttempt.objects.get(order=self.order)
+        self.assertRedirects(response, reverse('payment-status', args=[attempt.pk]), fetch_redirect_response=False)
+        return attempt
+
+    def test_checkout_returns_before_the_charge_is_made(self):
+        attempt = self.pay('tok_visa')
+
+        response = self.client.get(reverse('payment-status', args=[attempt.pk]))
+        self.assertContains(response, 'Processing your payment')
+        self.assertEqual(self.stripe.charges, [])
+
+    def test_worker_charges_and_completes_the_order(self):
+        attempt = self.pay('tok_visa')
+        process_next_attempt()
+
+        attempt.refresh_from_db()
+        self.order.refresh_from_db()
+        self.shoe.refresh_from_db()
+        self.assertEqual(attempt.status, 'S')
+        self.assertTrue(self.order.complete)
+        self.assertEqual(self.order.payment.charge_id, self.stripe.charges[-1]['id'])
+        self.assertEqual(self.stripe.charges[-1]['amount'], 40000)
+        self.assertEqual(self.shoe.quantity, 3)
+        self.assertEqual(self.order.orderitem_set.get().price, 200)
+
+        response = self.client.get(reverse('payment-status', args=[attempt.pk]))
+        self.assertRedirects(response, reverse('store'), fetch_redirect_response=False)
+
+    def test_declined_charge_puts_stock_back(self):
+        attempt = self.pay(DECLINED_TOKEN)
+        process_next_attempt()
+
+        attempt.refresh_from_db()
+        self.order.refresh_from_db()
+        self.shoe.refresh_from_db()
+        self.assertEqual(attempt.status, 'F')
+        self.assertEqual(attempt.error_message, 'Your card was declined.')
+        self.assertFalse(self.order.complete)
+        self.assertEqual(self.shoe.quantity, 5)
+
+        response = self.client.get(reverse('payment-status', args=[attempt.pk]))
+        self.assertRedirects(response, reverse('checkout'), fetch_redirect_response=False)
+
+    def test_double_submission_queues_a_single_attempt(self):
+        first = self.pay('tok_visa')
+        second = self.pay('tok_visa')
+
+        self.shoe.refresh_from_db()
+        self.assertEqual(first, second)
+        self.assertEqual(self.shoe.quantity, 3)
+
+    def test_retried_attempt_is_charged_once(self):
+        attempt = self.pay('tok_visa')
+        process_next_attempt()
+        # Processing the attempt again, as after a worker crashed before recording the result
+        PaymentAttempt.objects.filter(pk=attempt.pk).update(status='P')
+        process_next_attempt()
+
+        self.assertEqual(len(self.stripe.charges), 1)
+        self.assertEqual(Payment.objects.count(), 1)
+
+    def test_claimed_attempt_is_not_taken_for_stalled(self):
+        attempt = self.pay('tok_visa')
+        # The attempt waited in the queue for longer than a worker may take to process it
+        timeout = datetime.timedelta(seconds=settings.PAYMENT_ATTEMPT_TIMEOUT + 1)
+        PaymentAttempt.objects.filter(pk=attempt.pk).update(updated=timezone.now() - timeout)
+
+        self.assertEqual(claim_next_attempt(), attempt)
+        self.assertEqual(requeue_stalled_attempts(), 0)
+        self.assertIsNone(claim_next_attempt())
+
+        # Until the worker processing it stops for good
+        PaymentAttempt.objects.filter(pk=attempt.pk).update(updated=timezone.now() - timeout)
+        self.assertEqual(requeue_stalled_attempts(), 1)
+        self.assertEqual(claim_next_attempt(), attempt)
+
+    def test_rate_limited_charge_is_retried_later(self):
+        attempt = self.pay('tok_visa')
+        self.stripe.rate_limited = 1
+        process_next_attempt()
+
+        attempt.refresh_from_db()
+        self.shoe.refresh_from_db()
+        self.assertEqual((attempt.status, attempt.retries), ('P', 1))
+        self.assertEqual(self.shoe.quantity, 3)
+        # Waiting for the retry delay to pass
+        self.assertIsNone(process_next_attempt())
+
+        PaymentAttempt.objects.filter(pk=attempt.pk).update(retry_at=timezone.now())
+        process_next_attempt()
+        attempt.refresh_from_db()
+        self.assertEqual(attempt.status, 'S')
+        self.assertEqual(len(self.stripe.charges), 1)
+
+    @override_settings(PAYMENT_MAX_RETRIES=1, PAYMENT_RETRY_DELAY=0)
+    def test_charge_fails_once_out_of_retries(self):
+        attempt = self.pay('tok_visa')
+        self.stripe.rate_limited = 2
+        process_next_attempt()
+        process_next_attempt()
+
+        attempt.refresh_from_db()
+        self.shoe.refresh_from_db()
+        self.assertEqual((attempt.status, attempt.retries), ('F', 1))
+        self.assertEqual(attempt.error_message, 'Rate Limit Error')
+        self.assertEqual(self.shoe.quantity, 5)
+
+    def test_submitting_a_paid_order_again_returns_its_attempt(self):
+        attempt = self.pay('tok_visa')
+        process_next_attempt()
+
+        response = self.client.post(reverse('payment', args=['stripe']), {'stripeToken': 'tok_visa'})
+        self.assertRedirects(response, reverse('payment-status', args=[attempt.pk]), fetch_redirect_response=False)
+        self.assertEqual(len(self.stripe.charges), 1)
+
+
+class OrderExportTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('ama', email='ama@example.com', password='secret')
+        shoe = Product.objects.create(name='Air Jordan 1', price=200, discount_price=180, quantity=5)
+        sock = Product.objects.create(name='Socks', price=10, quantity=10)
+        address = Address.objects.create(customer=self.user.customer, country='GH', city='Accra',
+                                         street_address='1 Oxford Street', address_type='S')
+        self.orders = []
+        for day, quantity in ((1, 1), (2, 2), (3, 3)):
+            payment = Payment.objects.create(charge_id=f'ch_{day}', customer=self.user.customer, amount=200)
+            paid = datetime.datetime(2021, 3, day, 12, tzinfo=datetime.timezone.utc)
+            Payment.objects.filter(pk=payment.pk).update(timestamp=paid)
+            order = Order.objects.create(customer=self.user.customer, complete=True, payment=payment,
+                                         shipping_address=address, transaction_id=f'2021-{day}')
+            OrderItem.objects.create(order=order, product=shoe, quantity=quantity)
+            OrderItem.objects.create(order=order, product=sock, quantity=1)
+            order.orderitem_set.record_prices()
+            self.orders.append(order)
+        # Price changes after checkout don't change the orders
+        Product.objects.filter(pk=shoe.pk).update(discount_price=150)
+        # An open cart isn't exported
+        OrderItem.objects.create(order=Order.objects.create(customer=self.user.customer), product=shoe, quantity=1)
+
+    def export(self, *args):
+        out = io.StringIO()
+        call_command('export_orders', *args, stdout=out)
+        return out.getvalue()
+
+    def test_csv_export_has_a_row_per_order_line(self):
+        rows = list(csv.DictReader(io.StringIO(self.export('--chunk-size', '2'))))
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows[0]['transaction_id'], '2021-1')
+        self.assertEqual(rows[0]['customer'], 'ama')
+        self.assertEqual(rows[0]['shipping_city'], 'Accra')
+        self.assertEqual(rows[0]['shipping_country'], 'GH')
+        self.assertEqual(rows[0]['payment_charge_id'], 'ch_1')
+        self.assertEqual(rows[2]['product'], 'Air Jordan 1')
+        self.assertEqual(float(rows[2]['unit_price']), 180)
+        self.assertEqual(float(rows[2]['line_total']), 360)
+
+    def test_export_is_filtered_by_payment_date(self):
+        lines = self.export('--format', 'jsonl', '--since', '2021-03-02', '--until', '2021-03-02').splitlines()
+        rows = [json.loads(line) for line in lines]
+        self.assertEqual({row['transaction_id'] for row in rows}, {'2021-2'})
+        self.assertEqual(len(rows), 2)
+
+    def test_chunked_export_without_server_side_cursors(self):
+        with mock.patch.dict(connection.settings_dict, DISABLE_SERVER_SIDE_CURSORS=True):
+            rows = list(csv.DictReader(io.StringIO(self.export('--chunk-size', '4'))))
+        self.assertEqual([row['line_id'] for row in rows],
+                         [str(pk) for pk in OrderItem.objects.filter(order__complete=True).order_by('id')
+                          .values_list('id', flat=True)])
+
+    def test_admin_action_streams_the_selected_orders(self):
+        self.user.is_staff = self.user.is_superuser = True
+        self.user.save()
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('admin:shop_order_changelist'), {
+            'action': 'export_orders_jsonl',
+            '_selected_action': [self.orders[0].pk, self.orders[2].pk],
+        })
+        self.assertTrue(response.streaming)
+        self.assertIn('attachment', response['Content-Disposition'])
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row['transaction_id'] for row in rows], ['2021-1', '2021-1', '2021-3', '2021-3'])
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class SearchTests(TestCase):
+
+    def setUp(self):
+        clear_page_caches()
+        for name, brand, price, discount_price, digital, description in (
+            ('Air Jordan 1', 'Nike', 200, 180, False, 'Leather basketball sneakers'),
+            ('Air Max 90', 'Nike', 120, None, False, 'Running shoes with visible air cushioning'),
+            ('Gazelle', 'Adidas', 90, 70, False, 'Suede classic'),
+            ('Ultraboost', 'Adidas', 180, None, False, 'Running shoes'),
+            ('Sneaker care guide', None, 10, None, True, 'How to clean leather sneakers'),
+        ):
+            Product.objects.create(name=name, brand=brand, price=price, discount_price=discount_price,
+                                   digital=digital, description=description, quantity=5)
+
+    def names(self, products):
+        return {product.name for product in products}
+
+    def test_words_are_matched_in_name_brand_and_description(self):
+        self.assertEqual(self.names(search_products('nike')), {'Air Jordan 1', 'Air Max 90'})
+        self.assertEqual(self.names(search_products('running adidas')), {'Ultraboost'})
+        self.assertEqual(self.names(search_products('leath sneak')), {'Air Jordan 1', 'Sneaker care guide'})
+        self.assertEqual(self.names(search_products('"; DROP TABLE --')), set())
+        # Name matches rank above description matches
+        self.assertEqual(search_products('sneaker')[0].name, 'Sneaker care guide')
+
+    def test_index_follows_product_changes(self):
+        product = Product.objects.get(name='Gazelle')
+        product.name = 'Samba'
+        product.save()
+        self.assertEqual(self.names(search_products('samba')), {'Samba'})
+        self.assertEqual(self.names(search_products('gazelle')), set())
+        product.delete()
+        self.assertEqual(self.names(search_products('samba')), set())
+
+    def test_facets_are_counted_in_one_query(self):
+        filters = SearchFilters(brands=['Adidas'], price='50-100')
+        with self.assertNumQueries(1):
+            facets = facet_counts(Product.objects.all(), filters)
+        self.assertEqual(facets['total'], 1)
+        # The count of a facet's choices leaves out the choice made for it, not the others
+        self.assertEqual(facets['brands'], [('Adidas', 1)])
+        self.assertEqual(facets['prices'], {'under-50': 0, '50-100': 1, '100-200': 1, '200-up': 0})
+        self.assertEqual(facets['discounted'], 1)
+        self.assertEqual(facets['digital'], 0)
+
+        facets = facet_counts(search_products('running'), SearchFilters())
+        self.assertEqual(facets['total'], 2)
+        self.assertEqual(facets['brands'], [('Adidas', 1), ('Nike', 1)])
+
+    def test_search_page(self):
+        response = self.client.get(reverse('search'), {'q': 'running', 'price': '100-200'})
+        self.assertContains(response, 'Air Max 90')
+        self.assertContains(response, 'Ultraboost')
+        self.assertContains(response, '<strong>2</strong> results')
+        response = self.client.get(reverse('search'), {'q': 'running', 'brand': 'Nike'})
+        self.assertContains(response, 'Air Max 90')
+        self.assertNotContains(response, 'Ultraboost')
+
+
+class ProductImportTests(TestCase):
+
+    def setUp(self):
+        clear_page_caches()
+        self.jordan = Product.objects.create(sku='NK-1', name='Air Jordan 1', brand='Nike', price=200, quantity=3,
+                                             description='Leather basketball sneakers')
+
+    def import_csv(self, text, *args):
+        path = os.path.join(tempfile.mkdtemp(), 'catalog.csv')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            f.write(text)
+        out, err = io.StringIO(), io.StringIO()
+        call_command('import_products', path, *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_rows_create_and_update_products_by_sku(self):
+        out, err = self.import_csv(
+            'sku,name,brand,price,discount_price,quantity\n'
+            'NK-1,Air Jordan 1,Nike,190,,7\n'
+            'AD-1,Gazelle,Adidas,90,70,4\n'
+            'AD-2,Samba,Adidas,not a price,,1\n'
+            'AD-3,,Adidas,100,,1\n'
+            'AD-4,Superstar,Adidas,85,,2\n',
+            '--chunk-size', '2',
+        )
+        self.assertIn('5 rows', out)
+        self.assertIn('2 created, 1 updated, 0 unchanged, 2 invalid', out)
+        self.assertIn('Line 4: price:', err)
+        self.assertIn('Line 5: name: is required', err)
+
+        self.jordan.refresh_from_db()
+        self.assertEqual((self.jordan.price, self.jordan.quantity), (190, 7))
+        # Columns left out keep their values
+        self.assertEqual(self.jordan.description, 'Leather basketball sneakers')
+        gazelle = Product.objects.get(sku='AD-1')
+        self.assertEqual((gazelle.slug, gazelle.discount_price, gazelle.digital), ('gazelle', 70, False))
+        self.assertEqual(self.names(search_products('adidas')), {'Gazelle', 'Superstar'})
+        self.assertEqual(BrandStats.objects.get(brand='Adidas').product_count, 2)
+
+        out, err = self.import_csv('sku,price\nNK-1,190\n')
+        self.assertIn('0 created, 0 updated, 1 unchanged', out)
+
+    def names(self, products):
+        return {product.name for product in products}
+
+    def test_slugs_are_made_unique_like_autoslug_does(self):
+        Product.objects.create(name='Air Jordan 1 2', price=10)
+        lines = [json.dumps({'sku': f'JD-{i}', 'name': 'Air Jordan 1', 'price': 200}) for i in range(4)]
+        lines.append(json.dumps({'sku': 'JD-9', 'name': 'Air Jordan 1 3', 'price': 200}))
+        report = import_products(lines, 'jsonl', chunk_size=2)
+        self.assertEqual(report.created, 5)
+        self.assertEqual(
+            list(Product.objects.filter(sku__startswith='JD-').order_by('sku').values_list('slug', flat=True)),
+            ['air-jordan-1-3', 'air-jordan-1-4', 'air-jordan-1-5', 'air-jordan-1-6', 'air-jordan-1-3-2'],
+        )
+
+        allocator = SlugAllocator()
+        long_name = 'x' * 60
+        Product.objects.create(name=long_name, price=10)
+        self.assertEqual(allocator.allocate([long_name] * 2), ['x' * 48 + '-2', 'x' * 48 + '-3'])
+
+    def test_repricing_rebuilds_open_carts(self):
+        user = User.objects.create_user('ama', password='secret')
+        cart = Order.objects.create(customer=user.customer)
+        OrderItem.objects.create(order=cart, product=self.jordan, quantity=2)
+        Order.objects.filter(pk=cart.pk).rebuild_totals()
+        import_products([json.dumps({'sku': 'NK-1', 'discount_price': 150})], 'jsonl')
+        cart.refresh_from_db()
+        self.assertEqual(cart.subtotal, 300)
+
+    def test_quantities_are_whole_numbers_of_zero_or_more(self):
+        lines = [json.dumps({'sku': 'NK-1', 'quantity': quantity}) for quantity in (3.7, -1, True, '-2', 4.0)]
+        report = import_products(lines, 'jsonl')
+        self.assertEqual((report.updated, report.invalid), (1, 4))
+        self.assertEqual([message for line, message in report.errors], [
+            'quantity: 3.7 is not a whole number',
+            'quantity: -1 is not a quantity',
+            'quantity: True is not a whole number',
+            "quantity: '-2' is not a quantity",
+        ])
+        self.jordan.refresh_from_db()
+        self.assertEqual(self.jordan.quantity, 4)
+
+    @override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_admin_upload(self):
+        User.objects.create_superuser('admin', password='secret')
+        self.client.login(username='admin', password='secret')
+        upload = ContentFile(b'{"sku": "AD-1", "name": "Gazelle", "price": 90}\n{"sku": "AD-2"}\n',
+                             name='catalog.jsonl')
+        response = self.client.post(reverse('admin:shop_product_import'), {'file': upload, 'format': 'jsonl'},
+                                    follow=True)
+        self.assertContains(response, '1 created')
+        self.assertContains(response, 'Line 2: name, price: required for a new product')
+        self.assertTrue(Product.objects.filter(sku='AD-1', slug='gazelle').exists())
+
+        # Larger catalogs are left to the import command
+        upload = ContentFile(b'{"sku": "AD-1", "name": "Gazelle", "price": 90}\n', name='catalog.jsonl')
+        with self.settings(PRODUCT_IMPORT_MAX_UPLOAD_SIZE=10):
+            response = self.client.post(reverse('admin:shop_product_import'), {'file': upload, 'format': 'jsonl'})
+        self.assertContains(response, 'Import it with manage.py import_products instead.')
+
+
+class PricingRuleTests(TestCase):
+
+    def setUp(self):
+        clear_page_caches()
+        self.jordan = Product.objects.create(name='Air Jordan 1', brand='Nike', price=200)
+        self.max = Product.objects.create(name='Air Max 90', brand='Nike', price=120)
+        self.cortez = Product.objects.create(name='Cortez', brand='Nike', price=80, discount_price=75)
+        self.gazelle = Product.objects.create(name='Gazelle', brand='Adidas', price=90)
+
+    def discounts(self):
+        return dict(Product.objects.values_list('name', 'discount_price'))
+
+    def test_best_running_rule_sets_the_discount_price(self):
+        now = timezone.now()
+        nike = PricingRule.objects.create(name='Nike week', brand='Nike', percent_off=10)
+        PricingRule.objects.create(name='Premium', min_price=150, percent_off=25)
+        PricingRule.objects.create(name='Later', percent_off=50, starts_at=now + datetime.timedelta(days=1))
+        PricingRule.objects.create(name='Over', percent_off=50, ends_at=now - datetime.timedelta(days=1))
+        self.assertEqual(reprice_products(), 2)
+        # The discount set by hand is kept
+        self.assertEqual(self.discounts(), {'Air Jordan 1': 150, 'Air Max 90': 108, 'Cortez': 75, 'Gazelle': None})
+        self.assertEqual(Product.objects.get(name='Air Max 90').promotion, nike)
+        self.assertEqual(BrandStats.objects.get(brand='Nike').min_price, 75)
+        self.assertEqual(reprice_products(), 0)
+
+        nike.active = False
+        nike.save()
+        self.assertEqual(reprice_products(), 1)
+        self.assertEqual(self.discounts()['Air Max 90'], None)
+
+        PricingRule.objects.get(name='Premium').delete()
+        self.assertEqual(self.discounts()['Air Jordan 1'], None)
+
+    def test_repricing_writes_a_product_per_price_point_at_once(self):
+        Product.objects.bulk_create([Product(name=f'Samba {i}', slug=f'samba-{i}', brand='Adidas', price=100 + i % 2)
+                                     for i in range(20)])
+        PricingRule.objects.create(name='Adidas week', brand='Adidas', percent_off=20)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(reprice_products(), 21)
+        updates = [query['sql'] for query in queries if query['sql'].startswith('UPDATE "shop_product"')]
+        self.assertEqual(len(updates), 3)
+
+    def test_repricing_rebuilds_open_carts(self):
+        user = User.objects.create_user('ama', password='secret')
+        cart = Order.objects.create(customer=user.customer)
+        OrderItem.objects.create(order=cart, product=self.jordan, quantity=2)
+        PricingRule.objects.create(name='Nike week', brand='Nike', percent_off=10)
+        reprice_products()
+        cart.refresh_from_db()
+        self.assertEqual(cart.subtotal, 360)
+
+    @override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_imported_and_edited_products_follow_the_rules(self):
+        PricingRule.objects.create(name='Adidas week', brand='Adidas', percent_off=10)
+        import_products([json.dumps({'sku': 'AD-1', 'name': 'Samba', 'brand': 'Adidas', 'price': 100})], 'jsonl')
+        self.assertEqual(Product.objects.get(sku='AD-1').discount_price, 90)
+        report = import_products([json.dumps({'sku': 'AD-1', 'discount_price': None})], 'jsonl')
+        self.assertEqual(report.unchanged, 1)
+
+        User.objects.create_superuser('admin', password='secret')
+        self.client.login(username='admin', password='secret')
+        # The form keeps the current image
+        Product.objects.filter(pk=self.gazelle.pk).update(image='gazelle.jpg')
+        url = reverse('admin:shop_product_change', args=[self.gazelle.pk])
+        data = {'name': 'Gazelle', 'brand': 'Adidas', 'price': 80, 'quantity': 1, 'reserved': 0}
+        self.client.post(url, data)
+        self.assertEqual(self.discounts()['Gazelle'], 72)
+        self.client.post(url, {**data, 'discount_price': 60})
+        self.assertEqual(self.discounts()['Gazelle'], 60)
+        self.assertIsNone(Product.objects.get(name='Gazelle').promotion)
+
+
+class PricingRuleSaveTests(TransactionTestCase):
+    # Saving a rule reprices its products once the change commits
+
+    def setUp(self):
+        clear_page_caches()
+        self.jordan = Product.objects.create(name='Air Jordan 1', brand='Nike', price=200)
+        self.max = Product.objects.create(name='Air Max 90', brand='Nike', price=120)
+        self.gazelle = Product.objects.create(name='Gazelle', brand='Adidas', price=90)
+
+    def discounts(self):
+        return dict(Product.objects.values_list('name', 'discount_price'))
+
+    def test_only_pricing_changes_reprice_the_rules_products(self):
+        rule = PricingRule.objects.create(name='Nike week', brand='Nike', percent_off=10)
+        self.assertEqual(self.discounts(), {'Air Jordan 1': 180, 'Air Max 90': 108, 'Gazelle': None})
+
+        rule.name = 'Nike days'
+        with CaptureQueriesContext(connection) as queries:
+            rule.save()
+        self.assertFalse([query for query in queries if query['sql'].startswith('UPDATE "shop_product"')])
+
+        # Products of the brand it no longer applies to lose their discount
+        rule.brand = 'Adidas'
+        rule.save()
+        self.assertEqual(self.discounts(), {'Air Jordan 1': None, 'Air Max 90': None, 'Gazelle': 81})
+
+    @override_settings(PRICING_RULE_REPRICE_LIMIT=1)
+    def test_large_repricing_is_left_to_the_command(self):
+        rule = PricingRule.objects.create(name='Nike week', brand='Nike', percent_off=10)
+        self.assertTrue(rule._repricing_deferred)
+        self.assertEqual(self.discounts()['Air Jordan 1'], None)
+
+        call_command('apply_pricing_rules', stdout=io.StringIO())
+        self.assertEqual(self.discounts(), {'Air Jordan 1': 180, 'Air Max 90': 108, 'Gazelle': None})
+
+    def test_large_withdrawal_is_left_to_the_command(self):
+        PricingRule.objects.create(name='Premium', min_price=150, percent_off=25)
+        rule = PricingRule.objects.create(name='Nike week', brand='Nike', percent_off=30)
+        cart = Order.objects.create()
+        OrderItem.objects.create(order=cart, product=self.max, quantity=1)
+        cart.update_totals()
+        self.assertEqual(self.discounts(), {'Air Jordan 1': 140, 'Air Max 90': 84, 'Gazelle': None})
+
+        with self.settings(PRICING_RULE_REPRICE_LIMIT=1):
+            rule.delete()
+        self.assertTrue(rule._repricing_deferred)
+        # Its products lose its discount right away, and get the other rules' from the command
+        self.assertEqual(self.discounts(), {'Air Jordan 1': None, 'Air Max 90': None, 'Gazelle': None})
+        self.assertFalse(Product.objects.filter(promotion__isnull=False).exists())
+        cart.refresh_from_db()
+        self.assertEqual(cart.subtotal, 120)
+
+        call_command('apply_pricing_rules', stdout=io.StringIO())
+        self.assertEqual(self.discounts(), {'Air Jordan 1': 150, 'Air Max 90': None, 'Gazelle': None})
+
+
+class MoneyTests(TestCase):
+
+    def test_amounts_are_whole_cents(self):
+        self.assertEqual(Money.parse('19.995'), Money(2000))
+        self.assertEqual(Money.parse(0.1) + Money.parse(0.2), Money.parse('0.3'))
+        self.assertEqual(Money.parse('19.99') * 3, Money(5997))
+        self.assertEqual(Money.parse('19.99') * 0.85, Money(1699))
+        self.assertEqual((str(Money(5)), f'{Money(123456):.2f}'), ('0.05', '1234.56'))
+        self.assertEqual(Money(19000), 190)
+        with self.assertRaises(ValueError):
+            Money.parse('nan')
+
+    def test_cart_totals_are_summed_in_cents(self):
+        order = Order.objects.create(coupon=Coupon.objects.create(code='TENTH', amount=0.1))
+        for name, price in (('Laces', 0.1), ('Insoles', 0.2), ('Socks', 19.99)):
+            product = Product.objects.create(name=name, price=price, image=f'{name}.jpg')
+            OrderItem.objects.create(order=order, product=product, quantity=3)
+        order.update_totals()
+
+        self.assertEqual(order.subtotal, Money.parse('60.87'))
+        self.assertEqual(order.cart_total(), Money.parse('60.77'))
+        self.assertFalse(Order.objects.stale_totals().exists())
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT subtotal FROM shop_order WHERE id = %s', [order.pk])
+            self.assertEqual(cursor.fetchone(), (6087,))
+
+
+class ImageDerivativeTests(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings = override_settings(
+            MEDIA_ROOT=self.media_root,
+            DEFAULT_FILE_STORAGE='django.core.files.storage.FileSystemStorage',
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.product = Product.objects.create(name='Air Jordan 1', price=200)
+        self.upload('shoe.jpg', (1200, 900))
+
+    def upload(self, name, size):
+        content = io.BytesIO()
+        Image.new('RGB', size, 'red').save(content, 'JPEG')
+        self.product.image.save(name, ContentFile(content.getvalue()))
+
+    def test_builds_every_size_in_webp_and_jpeg(self):
+        self.assertTrue(build_derivatives(self.product.pk))
+        self.product.refresh_from_db()
+        derivatives = self.product.image_derivatives
+        self.assertEqual(derivatives['source'], 'shoe.jpg')
+        self.assertEqual(
+            [derivatives[size]['width'] for size in ('thumb', 'card', 'detail')],
+            [150, 400, 800],
+        )
+        with Image.open(os.path.join(self.media_root, derivatives['card']['webp'])) as img:
+            self.assertEqual((img.format, img.size), ('WEBP', (400, 300)))
+        with Image.open(os.path.join(self.media_root, derivatives['card']['jpeg'])) as img:
+            self.assertEqual((img.format, img.size), ('JPEG', (400, 300)))
+        self.assertFalse(build_derivatives(self.product.pk))
+
+    def test_template_filters_fall_back_to_the_original(self):
+        self.assertEqual(srcset(self.product), '')
+        self.assertEqual(image_url(self.product, 'card'), self.product.image.url)
+
+        build_derivatives(self.product.pk)
+        self.product.refresh_from_db()
+        self.assertEqual(
+            srcset(self.product, 'webp'),
+            '/shoecommerce/shoe_thumb.webp 150w, /shoecommerce/shoe_card.webp 400w, '
+            '/shoecommerce/shoe_detail.webp 800w',
+        )
+        self.assertEqual(image_url(self.product, 'thumb'), '/shoecommerce/shoe_thumb.jpeg')
+
+    def test_new_image_replaces_the_derivatives(self):
+        build_derivatives(self.product.pk)
+        self.product.refresh_from_db()
+        self.upload('boot.jpg', (600, 600))
+        self.assertEqual(srcset(self.product), '')
+
+        self.assertTrue(build_derivatives(self.product.pk))
+        self.assertEqual(
+            sorted(os.listdir(self.media_root)),
+            ['boot.jpg', 'boot_card.jpeg', 'boot_card.webp', 'boot_detail.jpeg', 'boot_detail.webp',
+             'boot_thumb.jpeg', 'boot_thumb.webp', 'shoe.jpg'],
+        )
+
+
+class ContentAddressedStorageTests(TransactionTestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        self.storage = ContentAddressedFileSystemStorage(location=self.media_root)
+
+    def test_same_content_is_stored_once(self):
+        first = self.storage.save('vans.jpg', ContentFile(b'vans'))
+        second = self.storage.save('vans_copy.jpg', ContentFile(b'vans'))
+        other = self.storage.save('vans.jpg', ContentFile(b'other vans'))
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, other)
+        self.assertEqual(MediaBlob.objects.get(name=first).references, 2)
+        self.assertEqual(len(os.listdir(os.path.dirname(self.storage.path(first)))), 1)
+
+    def test_file_is_deleted_with_its_last_reference(self):
+        name = self.storage.save('vans.jpg', ContentFile(b'vans'))
+        self.storage.save('vans.jpg', ContentFile(b'vans'))
+
+        self.storage.delete(name)
+        self.assertTrue(self.storage.exists(name))
+        self.storage.delete(name)
+        self.assertFalse(self.storage.exists(name))
+        self.assertFalse(MediaBlob.objects.exists())
+
+
+class BenchmarkTests(TransactionTestCase):
+
+    def setUp(self):
+        # The benchmark's catalog, in a database of its own, shares the caches of the tests
+        clear_page_caches()
+        self.addCleanup(clear_page_caches)
+
+    def test_checkout_funnel_runs_without_errors(self):
+        storage = settings.STATICFILES_STORAGE
+        report = run_benchmark(concurrency=1, rounds=1, products=30, log=lambda message: None)
+        self.assertEqual((report['concurrency'], report['rounds'], report['database']), (1, 1, connection.vendor))
+        self.assertEqual(set(report['endpoints']), {'store', 'update-item', 'cart', 'checkout', 'checkout-post',
+                                                    'payment-post', 'payment-status'})
+        for name, endpoint in report['endpoints'].items():
+            with self.subTest(endpoint=name):
+                self.assertEqual(endpoint['errors'], 0)
+                self.assertGreater(endpoint['requests'], 0)
+                self.assertLessEqual(endpoint['p50_ms'], endpoint['max_ms'])
+        self.assertEqual(report['endpoints']['update-item']['requests'], 3)
+
+        # The settings are restored, and the tests' database in use again
+        self.assertEqual(settings.STATICFILES_STORAGE, storage)
+        self.assertEqual(connection.settings_dict['NAME'], settings.DATABASES['default']['TEST']['NAME'])
+        self.assertFalse(Product.objects.exists())
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class TimingTests(TestCase):
+
+    def setUp(self):
+        timing.stats.reset()
+        self.user = User.objects.create_user('kofi', password='secret')
+        self.client.force_login(self.user)
+
+    def test_requests_are_timed_per_view(self):
+        response = self.client.get(reverse('cart'))
+        self.client.get(reverse('cart'))
+        header = response['Server-Timing']
+        self.assertRegex(header, r'^db;dur=[\d.]+;desc="\d+ queries", tpl;dur=[\d.]+;desc="Templates", total;dur=[\d.]+$')
+
+        stats = timing.stats.summary()
+        self.assertEqual(stats['cart']['requests'], 2)
+        self.assertGreater(stats['cart']['queries']['mean'], 0)
+        self.assertGreater(stats['cart']['template_ms']['p50'], 0)
+
+    def test_stats_are_for_staff_only(self):
+        self.assertEqual(self.client.get(reverse('timing-stats')).status_code, 302)
+        self.user.is_staff = True
+        self.user.save()
+        self.client.get(reverse('cart'))
+        self.assertEqual(self.client.get(reverse('timing-stats')).json()['cart']['requests'], 1)
+
+
+class QueryBudgetMixin:
+    # Fails a test when a view or method makes more queries, or allocates more memory, than its
+    # budget. Budgets are the current costs, so raise one only along with the change that makes
+    # it necessary. Memory budgets are the peak traced by tracemalloc in KiB, measured on CPython
+    # 3.11 plus a tenth. One-off costs (compiled templates and regexes, lazily imported modules,
+    # registries growing) would make the peak depend on the tests run before, so the call is
+    # made once to warm them up, rolled back and with caches of its own, and measured the second
+    # time. The function measured must not change its arguments.
+
+    def assertWithinBudget(self, queries, kib, func, *args, **kwargs):
+        cookies = SimpleCookie(self.client.cookies)
+        with override_settings(CACHES=warm_up_caches()), transaction.atomic():
+            func(*args, **kwargs)
+            transaction.set_rollback(True)
+        self.client.cookies = cookies
+        # Collecting first, and none during the call, as a collection empties the interpreter's
+        # free lists (which objects are then allocated anew) and frees cycles midway
+        gc.collect()
+        gc.disable()
+        tracemalloc.start()
+        try:
+            with CaptureQueriesContext(connection) as captured:
+                result = func(*args, **kwargs)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+            gc.enable()
+        made = [query['sql'] for query in captured.captured_queries]
+        self.assertLessEqual(len(made), queries, f'{len(made)} queries over a budget of {queries}:\n' + '\n'.join(made))
+        self.assertLessEqual(peak, kib * 1024, f'{peak / 1024:.0f} KiB allocated over a budget of {kib} KiB')
+        return result
+
+
+def warm_up_caches():
+    # Empty caches, so that the warm-up call leaves the ones measured as they were
+    return {
+        alias: {**config, 'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': f'warm-up-{alias}'}
+        for alias, config in settings.CACHES.items()
+    }
+
+
+def clear_page_caches():
+    for alias in ('catalog', 'template_fragments', 'pages'):
+        caches[alias].clear()
+
+
+class CatalogPageView(AnonymousPageCacheMixin, View):
+    # A page cached under the default key
+    template = '{{ count }} products'
+
+    def get(self, request):
+        template = engines.all()[0].from_string(self.template)
+        return TemplateResponse(request, template, {'count': Product.objects.count()})
+
+
+class CatalogFormView(CatalogPageView):
+    # A page whose first rendering sets a CSRF cookie
+    template = '<form>{% csrf_token %}</form>{{ count }} products'
+
+
+urlpatterns = [
+    path('catalog/', CatalogPageView.as_view()),
+    path('catalog/form/', CatalogFormView.as_view()),
+]
+
+
+@override_settings(ROOT_URLCONF='shop.tests')
+class PageCacheTests(TestCase):
+
+    def setUp(self):
+        clear_page_caches()
+
+    def get(self, url='/catalog/'):
+        return Client().get(url)
+
+    def test_default_key_expires_with_the_catalog(self):
+        self.assertEqual(self.get().content, b'0 products')
+        shoe = Product.objects.create(name='Air Jordan 1', price=200, quantity=3)
+        self.assertEqual(self.get().content, b'0 products')
+
+        invalidate_products([shoe.pk])
+        self.assertEqual(self.get().content, b'1 products')
+
+    def test_pages_setting_cookies_are_not_stored(self):
+        first = self.get('/catalog/form/')
+        self.assertIn('csrftoken', first.cookies)
+        self.assertTrue(first.content.endswith(b'0 products'))
+        Product.objects.create(name='Air Jordan 1', price=200, quantity=3)
+
+        # Rendered again, with the visitor's own token
+        second = self.get('/catalog/form/')
+        self.assertIn('csrftoken', second.cookies)
+        self.assertTrue(second.content.endswith(b'1 products'))
+
+
+class CatalogCacheTests(TransactionTestCase):
+    # Products are invalidated once their changes commit
+
+    def setUp(self):
+        clear_page_caches()
+        self.shoe = Product.objects.create(name='Air Jordan 1', sku='NK-1', brand='Nike', price=200, quantity=3)
+        self.rule = PricingRule.objects.create(name='Nike week', brand='Nike', percent_off=10)
+
+    def test_products_are_read_through(self):
+        before = cache_stats()
+        with self.assertNumQueries(1):
+            get_product('air-jordan-1')
+        with self.assertNumQueries(0):
+            product = get_product('air-jordan-1')
+        self.assertEqual((product.pk, product.sku, product.price, product.discount_price, product.promotion_id),
+                         (self.shoe.pk, 'NK-1', 200, 180, self.rule.pk))
+        self.assertFalse(product._state.adding)
+        with self.assertRaises(Product.DoesNotExist):
+            get_product('air-max-90')
+
+        stats = cache_stats()
+        self.assertEqual((stats['hits'] - before['hits'], stats['misses'] - before['misses']), (1, 2))
+        self.assertGreater(stats['hit_rate'], 0)
+
+    def test_saves_and_deletes_invalidate_products(self):
+        get_product('air-jordan-1')
+        self.shoe.refresh_from_db()
+        self.shoe.price = 210
+        self.shoe.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(get_product('air-jordan-1').price, 210)
+
+        self.shoe.delete()
+        with self.assertRaises(Product.DoesNotExist):
+            get_product('air-jordan-1')
+
+    def test_stale_slugs_are_not_served(self):
+        get_product('air-jordan-1')
+        self.shoe.slug = 'jordan-1'
+        self.shoe.save()
+        self.assertEqual(get_product('jordan-1').pk, self.shoe.pk)
+        # The old slug still points at the product, whose record now has the new slug
+        with self.assertRaises(Product.DoesNotExist):
+            get_product('air-jordan-1')
+
+    def test_product_changes_expire_listings(self):
+        def load():
+            return Product.objects.order_by('pk')
+
+        version = catalog_version()
+        self.assertEqual([product.name for product in get_listing('all', load, ('id', 'name'))], ['Air Jordan 1'])
+        Product.objects.create(name='Air Max 90', brand='Nike', price=120)
+        self.assertEqual(catalog_version(), version + 1)
+        with self.assertNumQueries(1):
+            listing = get_listing('all', load, ('id', 'name'))
+        self.assertEqual([product.name for product in listing], ['Air Jordan 1', 'Air Max 90'])
+        with self.assertNumQueries(0):
+            get_listing('all', load, ('id', 'name'))
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class QueryBudgetTests(QueryBudgetMixin, TestCase):
+    # The catalog, carts and address books are sized like a busy shop's, so costs growing with
+    # the number of products, lines or addresses (N+1 queries) blow the budgets.
+    products = 200
+    cart_lines = 30
+    addresses = 20
+
+    @classmethod
+    def setUpTestData(cls):
+        Product.objects.bulk_create([
+            Product(name=f'Sneaker {i}', slug=f'sneaker-{i}', brand=f'Brand {i % 8}', price=100 + i, quantity=50,
+                    discount_price=90 + i if i % 3 == 0 else None, digital=i % 10 == 0, image=f'sneaker{i}.jpg')
+            for i in range(cls.products)
+        ])
+        # bulk_create() doesn't index the products for search
+        call_command('rebuild_search_index', stdout=io.StringIO())
+        cls.catalog = list(Product.objects.order_by('id'))
+        cls.user = User.objects.create_user('ama', password='password')
+        cls.customer = cls.user.customer
+        cls.coupon = Coupon.objects.create(code='SUMMER', amount=20)
+        cls.order = Order.objects.create(customer=cls.customer, coupon=cls.coupon)
+        OrderItem.objects.bulk_create([
+            OrderItem(order=cls.order, product=product, quantity=i % 3 + 1)
+            for i, product in enumerate(cls.catalog[:cls.cart_lines])
+        ])
+        cls.order.update_totals()
+        Address.objects.bulk_create([
+            Address(customer=cls.customer, country='GH', street_address=f'{i} Oxford Street', city='Accra',
+                    address_type='SB'[i % 2], default=i < 2)
+            for i in range(cls.addresses)
+        ])
+        for i in range(10):
+            Order.objects.create(customer=cls.customer, complete=True, transaction_id=f'20210{i}')
+
+    def setUp(self):
+        clear_page_caches()
+        self.client.force_login(self.user)
+        # The first page viewed stores the cart badge in the session, as it would have for a shopper
+        self.client.get(reverse('store'))
+        clear_page_caches()
+
+    def get(self, url, status=200):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status)
+        return response
+
+    def post_json(self, url, data):
+        response = self.client.post(url, json.dumps(data), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_store_page(self):
+        self.assertWithinBudget(4, 160, self.get, reverse('store'))
+        # Served from the catalog cache and the cached product cards
+        self.assertWithinBudget(3, 110, self.get, reverse('store'))
+        self.assertWithinBudget(4, 165, self.get, reverse('store') + f'?after={self.catalog[100].id}')
+
+    def test_search_page(self):
+        # The results, and every facet count in one query that also counts the results
+        response = self.assertWithinBudget(4, 215, self.get, reverse('search') + '?q=sneaker&brand=Brand+1&price=100-200')
+        self.assertEqual(len(response.context['object_list']), 12)
+
+    def test_store_page_for_anonymous_visitors(self):
+        self.client.logout()
+        self.assertWithinBudget(2, 155, self.get, reverse('store'))
+        # Served from the page cache
+        self.assertWithinBudget(0, 35, self.get, reverse('store'))
+
+    def test_product_page(self):
+        url = self.catalog[5].get_absolute_url()
+        self.assertWithinBudget(3, 75, self.get, url)
+        self.assertWithinBudget(2, 65, self.get, url)
+
+    def test_cart_page(self):
+        self.assertWithinBudget(5, 305, self.get, reverse('cart'))
+
+    def test_checkout_page(self):
+        # Most of the memory is the test client's copies of the context of every template rendered,
+        # one per option of the two country selects
+        self.assertWithinBudget(7, 3360, self.get, reverse('checkout'))
+
+    def test_payment_page(self):
+        self.assertWithinBudget(5, 205, self.get, reverse('payment', args=['stripe']))
+
+    def test_payment_submission(self):
+        # Stock is taken, and the prices of the lines recorded, for all the lines with an UPDATE each
+        response = self.assertWithinBudget(18, 400, self.client.post, reverse('payment', args=['stripe']),
+                                           {'stripeToken': 'tok_visa'})
+        attempt = PaymentAttempt.objects.get(order=self.order)
+        self.assertRedirects(response, reverse('payment-status', args=[attempt.pk]), fetch_redirect_response=False)
+        self.assertWithinBudget(4, 75, self.get, reverse('payment-status', args=[attempt.pk]))
+
+    def test_update_item(self):
+        url = reverse('update-item')
+        self.assertWithinBudget(21, 405, self.post_json, url, {'productId': self.catalog[0].id, 'action': 'add'})
+        self.assertWithinBudget(21, 405, self.post_json, url, {'productId': self.catalog[150].id, 'action': 'add'})
+
+    def test_update_items(self):
+        # Stock is held for the whole batch at once, so this costs the same as adding a single product
+        operations = [{'productId': product.id, 'action': 'add', 'qty': 1} for product in self.catalog[20:60]]
+        self.assertWithinBudget(23, 495, self.post_json, reverse('update-items'), {'operations': operations})
+
+    def test_cart_quantity_badge(self):
+        request = self.get(reverse('store')).wsgi_request
+        # Read from the session once stored there
+        self.assertEqual(self.assertWithinBudget(0, 4, cart_quantity, request), self.order.item_count)
+
+    def test_cart_methods(self):
+        order = self.assertWithinBudget(1, 35, Order.objects.select_related('coupon').get, pk=self.order.pk)
+        # The totals are read from the order itself
+        self.assertWithinBudget(0, 4, order.cart_total)
+        self.assertWithinBudget(0, 4, order.cart_items)
+        self.assertWithinBudget(0, 4, order.shipping)
+        items = self.assertWithinBudget(1, 95, lambda: list(order.orderitem_set.with_totals()))
+        self.assertWithinBudget(0, 4, lambda: [item.total() for item in items])
+        self.assertWithinBudget(2, 110, order.update_totals)
+
+
+class ConnectionHealthCheckTests(TransactionTestCase):
+    # Requests start with close_old_connections(), as does every poll of the payment worker
+
+    def test_reused_connections_are_checked_on_first_use(self):
+        database = connections['default']
+        Product.objects.exists()
+        opened = database.connection
+        with mock.patch.object(database, 'is_usable', return_value=True) as is_usable:
+            close_old_connections()
+            is_usable.assert_not_called()
+            Product.objects.exists()
+            Product.objects.exists()
+            is_usable.assert_called_once_with()
+        self.assertIs(database.connection, opened)
+
+        close_old_connections()
+        with mock.patch.object(database, 'is_usable', return_value=False):
+            self.assertFalse(Product.objects.exists())
+        # Reopened
+        self.assertIsNotNone(database.connection)
+        self.assertIsNot(database.connection, opened)
+
+    def test_new_and_unused_connections_are_not_checked(self):
+        database = connections['default']
+        database.close()
+        with mock.patch.object(database, 'is_usable') as is_usable:
+            Product.objects.exists()
+            close_old_connections()
+            is_usable.assert_not_called()
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class ReplicaRoutingTests(TransactionTestCase):
+    # The primary is the test database and the replica a second SQLite database holding a copy
+    # of it taken by replicate(), which lags behind until the next copy.
+
+    def setUp(self):
+        replica_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, replica_dir)
+        connections.databases[REPLICA] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(replica_dir, 'replica.sqlite3'),
+        }
+        self.addCleanup(self.remove_replica)
+        clear_page_caches()
+
+        self.product = Product.objects.create(name='Air Jordan 1', slug='air-jordan-1', price=200, quantity=5,
+                                              image='aj1.jpg', image_derivatives={'source': 'aj1.jpg'})
+        self.user = User.objects.create_user('kofi', password='secret')
+        self.replicate()
+        # A change the replica hasn't received yet, made without going through the catalog cache
+        Product.objects.filter(pk=self.product.pk).update(name='Air Jordan 1 Retro')
+        clear_page_caches()
+
+    def remove_replica(self):
+        connections[REPLICA].close()
+        del connections[REPLICA]
+        del connections.databases[REPLICA]
+
+    def replicate(self):
+        connections[REPLICA].ensure_connection()
+        connections['default'].connection.backup(connections[REPLICA].connection)
+
+    def product_page(self):
+        caches['pages'].clear()
+        caches['template_fragments'].clear()
+        return self.client.get(reverse('product', args=[self.product.slug])).content.decode()
+
+    def test_catalog_pages_read_the_replica(self):
+        self.assertNotIn('Retro', self.product_page())
+        response = self.client.get(reverse('store'))
+        self.assertNotIn('Retro', response.content.decode())
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+
+    def test_cart_writes_pin_the_customer_to_the_primary(self):
+        self.client.force_login(self.user)
+        self.assertNotIn('Retro', self.product_page())
+
+        response = self.client.post(reverse('update-item'), {'productId': self.product.pk, 'action': 'add'},
+                                    content_type='application/json')
+        self.assertEqual(response.cookies[PIN_COOKIE]['max-age'], 5)
+        caches['catalog'].clear()
+        self.assertIn('Retro', self.product_page())
+        # Orders are never read from the replica, which has no cart yet
+        self.assertContains(self.client.get(reverse('cart')), 'Air Jordan 1 Retro')
+
+    def test_product_changes_keep_catalog_reads_on_the_primary(self):
+        self.product.refresh_from_db()
+        self.product.price = 180
+        self.product.save()
+        self.assertIn('Retro', self.product_page())
+
+        # Once the pin expires
+        caches['catalog'].clear()
+        self.assertNotIn('Retro', self.product_page())
+
+
+class BrandStatsTests(TransactionTestCase):
+    # Stats are refreshed once changes commit, which TestCase never does
+
+    def stats(self, brand):
+        return BrandStats.objects.filter(brand=brand).values(
+            'product_count', 'in_stock_count', 'discounted_count', 'min_price', 'max_price').first()
+
+    def test_stats_follow_product_changes(self):
+        jordan = Product.objects.create(name='Air Jordan 1', brand='Nike', price=200, discount_price=180, quantity=1)
+        Product.objects.create(name='Air Max 90', brand='Nike', price=120, quantity=0)
+        Product.objects.create(name='Gazelle', brand='Adidas', price=90, quantity=3)
+        self.assertEqual(self.stats('Nike'), {'product_count': 2, 'in_stock_count': 1, 'discounted_count': 1,
+                                              'min_price': 120, 'max_price': 180})
+
+        jordan.brand = 'Jordan'
+        jordan.save()
+        self.assertEqual(self.stats('Nike'), {'product_count': 1, 'in_stock_count': 0, 'discounted_count': 0,
+                                              'min_price': 120, 'max_price': 120})
+        self.assertEqual(self.stats('Jordan')['product_count'], 1)
+
+        jordan.delete()
+        self.assertIsNone(self.stats('Jordan'))
+
+    def test_selling_out_updates_the_in_stock_count(self):
+        gazelle = Product.objects.create(name='Gazelle', brand='Adidas', price=90, quantity=2)
+        items = [OrderItem(product_id=gazelle.pk, quantity=2)]
+        decrement_stock(items)
+        self.assertEqual(self.stats('Adidas')['in_stock_count'], 0)
+        restore_stock(items)
+        self.assertEqual(self.stats('Adidas')['in_stock_count'], 1)
+
+    def test_refresh_command_recomputes_every_brand(self):
+        Product.objects.create(name='Gazelle', brand='Adidas', price=90, quantity=2)
+        # Bulk changes don't send signals
+        Product.objects.update(brand='Puma')
+        call_command('refresh_brand_stats', stdout=io.StringIO())
+        self.assertEqual(list(BrandStats.objects.values_list('brand', 'product_count')), [('Puma', 1)])
+
+
+class ConcurrentStockTests(TransactionTestCase):
+    buyers = 24
+    stock = 10
+
+    def test_parallel_buyers_never_oversell(self):
+        product = Product.objects.create(name='Air Jordan 1', price=200, quantity=self.stock)
+        start = threading.Barrier(self.buyers)
+        sold = []
+
+        def buy():
+            start.wait()
+            try:
+                decrement_stock([OrderItem(product_id=product.id, quantity=1)])
+                sold.append(1)
+            except OutOfStock:
+                pass
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=buy) for _ in range(self.buyers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        product.refresh_from_db()
+        self.assertEqual(len(sold), self.stock)
+        self.assertEqual(product.quantity, 0)
+
+
+class ConcurrentCheckoutTests(TransactionTestCase):
+    # Customers racing for the last pairs, while the payment worker charges those who got one
+    buyers = 12
+    stock = 5
+
+    def test_parallel_checkouts_never_fail_or_oversell(self):
+        shoe = Product.objects.create(name='Air Jordan 1', price=200, quantity=self.stock)
+        clients = []
+        for i in range(self.buyers):
+            client = Client()
+            client.force_login(User.objects.create_user(f'buyer{i}', password='password'))
+            clients.append(client)
+        start = threading.Barrier(self.buyers)
+        statuses, errors = [], []
+
+        def shop(client):
+            start.wait()
+            try:
+                response = client.post(reverse('update-items'), json.dumps({'operations': [
+                    {'productId': shoe.id, 'action': 'add', 'qty': 1},
+                ]}), content_type='application/json')
+                statuses.append(response.status_code)
+                if response.json()['items']:
+                    response = client.post(reverse('payment', args=['stripe']), {'stripeToken': 'tok_visa'})
+                    statuses.append(response.status_code)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        def work(stop):
+            while not stop.is_set():
+                try:
+                    run_worker(poll_interval=0, once=True)
+                except Exception as e:
+                    errors.append(e)
+                    return
+                finally:
+                    connection.close()
+
+        stop = threading.Event()
+        threads = [threading.Thread(target=shop, args=[client]) for client in clients]
+        worker = threading.Thread(target=work, args=[stop])
+        with StripeStubServer() as stub, mock.patch.object(stripe, 'api_base', stub.url):
+            worker.start()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            stop.set()
+            worker.join()
+
+        self.assertEqual(errors, [])
+        self.assertTrue(set(statuses) <= {200, 302}, statuses)
+        shoe.refresh_from_db()
+        self.assertEqual((shoe.quantity, shoe.reserved), (0, 0))
+        self.assertEqual(PaymentAttempt.objects.filter(status__in=['P', 'R', 'S']).count(), self.stock)
 
-# Create your tests here.
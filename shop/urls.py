@@ -1,15 +1,21 @@
 from django.urls import path, include
-from shop.views import StoreListView, ProductView, CheckoutView, CartView, update_item, PaymentView, AddCouponView, RefundView
+from shop.views import StoreListView, ProductView, SearchView, CheckoutView, CartView, update_item, update_items, PaymentView, PaymentStatusView, AddCouponView, RefundView, \
+    catalog_cache_stats, timing_stats
 
 
 urlpatterns = [
     path('', StoreListView.as_view(), name='store'),
     path('product/<slug>', ProductView.as_view(), name='product'),
+    path('search/', SearchView.as_view(), name='search'),
     path('cart/', CartView.as_view(), name='cart'),
     path('update_item/', update_item, name='update-item'),
+    path('update_items/', update_items, name='update-items'),
     path('checkout/', CheckoutView.as_view(), name='checkout'),
     path('payment/<payment_option>', PaymentView.as_view(), name='payment'),
+    path('payment_status/<int:pk>', PaymentStatusView.as_view(), name='payment-status'),
     path('coupon/', AddCouponView.as_view(), name='add_coupon'),
     path('refund_request/', RefundView.as_view(), name='refund-request'),
+    path('catalog/cache_stats/', catalog_cache_stats, name='catalog-cache-stats'),
+    path('timing/stats/', timing_stats, name='timing-stats'),
 
 ]
@@ -1,29 +1,153 @@
 from django.shortcuts import render, get_object_or_404
-from .models import Product, Order, OrderItem, Address, Payment, Coupon, Refund
+from .models import Product, Order, OrderItem, Address, PaymentAttempt, Coupon, Refund, BrandStats
 from django.views.generic import ListView, DetailView, View
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
 from django.core.exceptions import ObjectDoesNotExist
-from django.http import JsonResponse
+from django.http import JsonResponse, Http404
 from django.contrib import messages
 from django.shortcuts import redirect
 from shop.forms import AddressForm, CouponForm, RefundForm
+from shop.cart import set_cart_quantity, update_cart, parse_cart_operations, cart_summary_data
+from shop.stock import OutOfStock
+from shop.payments import submit_payment
+from shop.catalog import get_product, get_listing, cache_stats
+from shop.page_cache import AnonymousPageCacheMixin
+from shop.routers import ReplicaReadMixin
+from shop.search import PRICE_BANDS, SearchFilters, search_products, facet_counts
+from shop import timing
 import json
-import datetime
-import stripe
+import re
 
-stripe.api_key = settings.STRIPE_SECRET_KEY
 
+def cart_orders():
+    # Orders fetched together with their coupon, so rendering the cart totals
+    # costs no further queries.
+    return Order.objects.select_related('coupon')
 
-class StoreListView(ListView):
+
+class StoreListView(ReplicaReadMixin, AnonymousPageCacheMixin, ListView):
     model = Product
     template_name = 'shop/store.html'
+    page_size = 12
+    # Only the columns rendered by the product cards in store.html
+    card_fields = ('id', 'name', 'slug', 'price', 'discount_price', 'image', 'image_derivatives', 'updated')
+
+    def cursor(self):
+        # Returns the product id the page starts after, or None for the first page, which is
+        # also shown for cursors that can't be a product id (e.g. edited by hand)
+        after = self.request.GET.get('after', '')
+        if re.fullmatch(r'[0-9]{1,18}', after):
+            return int(after)
+        return None
+
+    def get_queryset(self):
+        # Keyset pagination: seeks past the last product id of the previous page
+        # so a page costs the same no matter how deep into the catalog it is.
+        queryset = Product.objects.only(*self.card_fields).order_by('id')
+        after = self.cursor()
+        if after is not None:
+            queryset = queryset.filter(id__gt=after)
+        return queryset
+
+    def get_context_data(self, **kwargs):
+        # Fetching one extra row tells us whether a next page exists without a COUNT query.
+        # Pages are served from the catalog cache until a product changes.
+        after = self.cursor()
+        products = get_listing(
+            f'store:{"" if after is None else after}:{self.page_size}',
+            lambda: self.object_list[:self.page_size + 1],
+            self.card_fields,
+        )
+        has_next = len(products) > self.page_size
+        products = products[:self.page_size]
+
+        context = super().get_context_data(object_list=products, **kwargs)
+        context['next_cursor'] = products[-1].id if has_next else None
+        context['is_first_page'] = after is None
+        # The brand filters, read from the precomputed stats (see shop.brand_stats)
+        context['brands'] = BrandStats.objects.filter(product_count__gt=0).order_by('brand')
+        return context
 
 
-class ProductView(DetailView):
+class ProductView(ReplicaReadMixin, AnonymousPageCacheMixin, DetailView):
     model = Product
     template_name = 'shop/product.html'
 
+    def page_cache_key(self):
+        # Only changes of the product expire its cached page
+        product = self.get_object()
+        return f'product:{product.pk}:{product.updated.timestamp()}'
+
+    def get_object(self, queryset=None):
+        # Reading the product through the catalog cache
+        try:
+            return get_product(self.kwargs['slug'])
+        except Product.DoesNotExist:
+            raise Http404('No product found matching the query')
+
+
+def toggled(params, name, value):
+    # Returns the query string with the facet value chosen, or unchosen when it was, back on page 1
+    params = params.copy()
+    params.pop('page', None)
+    values = params.getlist(name)
+    params.setlist(name, [v for v in values if v != value] if value in values else
+                   values + [value] if name == 'brand' else [value])
+    return params.urlencode()
+
+
+def with_page(params, number):
+    params = params.copy()
+    params['page'] = number
+    return params.urlencode()
+
+
+class SearchView(ReplicaReadMixin, ListView):
+    model = Product
+    template_name = 'shop/search.html'
+    paginate_by = 12
+
+    def get_queryset(self):
+        self.query = self.request.GET.get('q', '').strip()
+        self.filters = SearchFilters.from_query(self.request.GET)
+        products = Product.objects.only(*StoreListView.card_fields)
+        if self.query:
+            self.matches = search_products(self.query, products)
+        else:
+            # Browsing by facets alone, e.g. from the brand filters of the store
+            self.matches = products.order_by('id') if self.filters.conditions() else products.none()
+        self.facets = facet_counts(self.matches, self.filters)
+        return self.filters.apply(self.matches)
+
+    def get_paginator(self, queryset, per_page, **kwargs):
+        # The facet counts include the result count, saving the paginator's COUNT query
+        paginator = super().get_paginator(queryset, per_page, **kwargs)
+        paginator.count = self.facets['total']
+        return paginator
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        params = self.request.GET
+        facets = self.facets
+        context.update({
+            'query': self.query,
+            'filtered': bool(self.filters.conditions()),
+            'total': facets['total'],
+            'brand_facets': [(brand, count, brand in self.filters.brands, toggled(params, 'brand', brand))
+                             for brand, count in facets['brands']],
+            'price_facets': [(label, facets['prices'][key], key == self.filters.price, toggled(params, 'price', key))
+                             for key, (label, low, high) in PRICE_BANDS.items()],
+            'discounted_facet': (facets['discounted'], self.filters.discounted, toggled(params, 'discounted', '1')),
+            'digital_facet': (facets['digital'], self.filters.digital, toggled(params, 'digital', '1')),
+        })
+        page = context['page_obj']
+        if page.has_previous():
+            context['previous_page'] = with_page(params, page.previous_page_number())
+        if page.has_next():
+            context['next_page'] = with_page(params, page.next_page_number())
+        return context
+
 
 class CartView(ListView):
     model = OrderItem
@@ -33,8 +157,8 @@ class CartView(ListView):
         try:
             # Returning items in cart of a registered customer
             customer = self.request.user.customer
-            order, created = Order.objects.get_or_create(customer=customer, complete=False)
-            cart_items = order.orderitem_set.all()
+            self.order, created = cart_orders().get_or_create(customer=customer, complete=False)
+            cart_items = self.order.orderitem_set.with_totals()
             return cart_items
         except AttributeError:
             # Assigning cart items to an empty list if customer is not logged in.
@@ -45,12 +169,9 @@ class CartView(ListView):
 
     def get_context_data(self, **kwargs):
         # Adding order to the context
+        context = super().get_context_data(**kwargs)
         try:
-            context = super().get_context_data(**kwargs)
-            customer = self.request.user.customer
-            order = get_object_or_404(Order, customer=customer, complete=False)
-            context['order'] = order
-            return context
+            context['order'] = self.order
 
         except AttributeError:
             # Data displayed when the user is not a registered customer.
@@ -60,7 +181,7 @@ class CartView(ListView):
             }
 
             context['order'] = order
-            return context
+        return context
 
 
 def is_valid_form(values):
@@ -79,8 +200,8 @@ class CheckoutView(LoginRequiredMixin, View):
         customer = self.request.user.customer
 
         # Gets customer's order with items or creates one if none available
-        order = get_object_or_404(Order, customer=customer, complete=False)
-        items = order.orderitem_set.all()
+        order = get_object_or_404(cart_orders(), customer=customer, complete=False)
+        items = order.orderitem_set.with_totals()
 
         context = {
             'items': items,
@@ -93,17 +214,17 @@ class CheckoutView(LoginRequiredMixin, View):
             customer=customer,
             address_type='S',
             default=True,
-        )
-        if shipping_address.exists():
-            context.update({'default_shipping_address': shipping_address[0]})
+        ).first()
+        if shipping_address:
+            context.update({'default_shipping_address': shipping_address})
 
         billing_address = Address.objects.filter(
             customer=customer,
             address_type='B',
             default=True,
-        )
-        if billing_address.exists():
-            context.update({'default_billing_address': billing_address[0]})
+        ).first()
+        if billing_address:
+            context.update({'default_billing_address': billing_address})
 
         return render(self.request, 'shop/checkout.html', context)
 
@@ -263,8 +384,8 @@ class PaymentView(LoginRequiredMixin, View):
 
     def get(self, *args, **kwargs):
         customer = self.request.user.customer
-        order = get_object_or_404(Order, customer=customer, complete=False)
-        items = order.orderitem_set.all()
+        order = get_object_or_404(cart_orders(), customer=customer, complete=False)
+        items = order.orderitem_set.with_totals()
 
         context = {
             'items': items,
@@ -274,91 +395,45 @@ class PaymentView(LoginRequiredMixin, View):
         return render(self.request, 'shop/payment.html', context)
 
     def post(self, *args, **kwargs):
-        order = Order.objects.get(customer=self.request.user.customer, complete=False)
-        amount = int(order.cart_total() * 100)   # Multiply by 100 because stripe amount is in cents
+        customer = self.request.user.customer
         token = self.request.POST.get('stripeToken')
-        order_items = order.orderitem_set.all()
-
-        try:
-            # Creates a stripe charge
-            charge = stripe.Charge.create(
-                amount=amount,
-                currency="usd",
-                source=token,
-            )
-
-            # Creating a payment
-            payment = Payment()
-            payment.charge_id = charge['id']
-            payment.customer = self.request.user.customer
-            payment.amount = order.cart_total()
-            payment.save()
-
-            # Creating a transaction id
-            time = datetime.datetime.now()
-            year = time.strftime('%Y')
-            month = time.strftime('%m')
-            transaction_id = f'{year}{month}{order.id}'
-
-            # Changing the status of the order after completion
-            order.payment = payment
-            order.transaction_id = transaction_id
-            order.complete = True
-            order.save()
-
-            # Associating coupon with customer so it can't be used by same customer again
-            customer = self.request.user.customer
-            customer.coupons.add(order.coupon)
-            customer.save()
+        order = cart_orders().filter(customer=customer, complete=False).first()
 
-            # Changing product quantity after transaction
-            for order_item in order_items:
-                order_item.product.quantity -= order_item.quantity
-                order_item.product.save()
-
-            # Display message if payment is successful
-            # messages.success(self.request, f'Your payment of Gh\u20b5{amount/100:,.2f} was successful. '
-            #                                f'Thank you for shopping with us.')
-            messages.success(self.request, 'Your payment was successful')
-            return redirect('store')
+        if order is None:
+            # A repeated submission of an order that has already been paid
+            attempt = PaymentAttempt.objects.filter(customer=customer).order_by('-created').first()
+            if attempt:
+                return redirect('payment-status', pk=attempt.pk)
+            messages.warning(self.request, 'You do not have an active order')
+            return redirect('cart')
 
-        except stripe.error.CardError as e:
-            # Since it's a decline, stripe.error.CardError will be caught
-            messages.error(self.request, f'{e.user_message}')
-            return redirect('checkout')
+        try:
+            # The charge is made by the payment worker, see shop.payments. Submitting the same
+            # order again while it is being paid returns the attempt already in flight.
+            attempt = submit_payment(order, token)
+        except OutOfStock as e:
+            messages.warning(self.request, f'Sorry, {e.product} is out of stock')
+            return redirect('cart')
+        return redirect('payment-status', pk=attempt.pk)
 
-        except stripe.error.RateLimitError as e:
-            # Too many requests made to the API too quickly
-            messages.warning(self.request, 'Rate Limit Error')
-            return redirect('checkout')
 
-        except stripe.error.InvalidRequestError as e:
-            # Invalid parameters were supplied to Stripe's API
-            messages.warning(self.request, 'Invalid Parameters')
-            return redirect('checkout')
+class PaymentStatusView(LoginRequiredMixin, View):
 
-        except stripe.error.AuthenticationError as e:
-            # Authentication with Stripe's API failed
-            # (maybe you changed API keys recently)
-            messages.warning(self.request, 'Not Authenticated')
-            return redirect('checkout')
+    def get(self, *args, **kwargs):
+        attempt = get_object_or_404(PaymentAttempt, pk=kwargs['pk'], customer=self.request.user.customer)
 
-        except stripe.error.APIConnectionError as e:
-            # Network communication with Stripe failed
-            messages.warning(self.request, 'Network Error')
-            return redirect('checkout')
+        if attempt.in_progress:
+            # Page reloads itself until the payment worker is done with the charge
+            return render(self.request, 'shop/payment_status.html', {'attempt': attempt})
 
-        except stripe.error.StripeError as e:
-            # Display a very generic error to the user, and maybe send
-            # yourself an email
-            messages.warning(self.request, 'Something went wrong, you were not charged. Please try again.')
-            return redirect('checkout')
+        if attempt.status == 'S':
+            set_cart_quantity(self.request, 0)
+            # Display message if payment is successful
+            messages.success(self.request, 'Your payment was successful')
+            return redirect('store')
 
-        except Exception as e:
-            # Something else happened, completely unrelated to Stripe
-            # Send an e-mail to myself.
-            messages.warning(self.request, 'An error occurred. We have ben notified')
-            return redirect('checkout')
+        messages.warning(self.request, attempt.error_message)
+        return redirect('checkout')
 
 
 class RefundView(View):
@@ -403,36 +478,36 @@ def update_item(request):
     product_id = data['productId']
     action = data["action"]
 
-    customer = request.user.customer
-    product = Product.objects.get(id=product_id)
+    update_cart(request, [(int(product_id), action, 1)])
 
-    # Gets customer's order with items or creates one if none available
-    order, created = Order.objects.get_or_create(customer=customer, complete=False)
-    # Gets or creates an order item with order(if available) or create one
-    item, created = OrderItem.objects.get_or_create(order=order, product=product)
-
-    if action == "add":
-        if item.quantity < product.quantity:
-            item.quantity += 1
-            messages.info(request, 'Item added to cart')
-        else:
-            messages.warning(request, 'Out of stock')
-
-    elif action == 'remove':
-        item.quantity -= 1
-        messages.info(request, 'Item removed from cart')
-
-    elif action == 'clear':
-        item.quantity = 0
+    return JsonResponse("Updated cart", safe=False)
 
-    item.save()
 
-    if item.quantity <= 0:
-        item.delete()
+def update_items(request):
+    # Applies the batch of operations coalesced by cart.js in one transaction
+    # and returns the updated cart summary.
+    try:
+        data = json.loads(request.body)
+        operations = parse_cart_operations(data.get('operations'))
+    except (ValueError, AttributeError) as e:
+        return JsonResponse({'error': str(e)}, status=400)
 
-    return JsonResponse("Updated cart", safe=False)
+    order = update_cart(request, operations)
 
+    return JsonResponse(cart_summary_data(order))
 
 
+@staff_member_required
+def catalog_cache_stats(request):
+    # Returns the catalog cache counters of the process serving the request
+    return JsonResponse(cache_stats())
 
 
+@staff_member_required
+def timing_stats(request):
+    # Returns the request count, mean and percentiles of the query count, database, template
+    # and total time per view, for the requests served by this process. ?reset=1 starts over.
+    summary = timing.stats.summary()
+    if request.GET.get('reset'):
+        timing.stats.reset()
+    return JsonResponse(summary)
@@ -1,3 +1,22 @@
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from shop.tests import QueryBudgetMixin
 
-# Create your tests here.
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class RegisterQueryBudgetTests(QueryBudgetMixin, TestCase):
+
+    def test_register_page(self):
+        response = self.assertWithinBudget(0, 150, self.client.get, reverse('register'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_registration(self):
+        response = self.assertWithinBudget(4, 55, self.client.post, reverse('register'), {
+            'username': 'kwame',
+            'email': 'kwame@example.com',
+            'password1': 'a-long-password-1',
+            'password2': 'a-long-password-1',
+        })
+        self.assertRedirects(response, reverse('store'), fetch_redirect_response=False)
+        self.assertTrue(User.objects.get(username='kwame').customer)